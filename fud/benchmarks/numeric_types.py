@@ -0,0 +1,59 @@
+"""
+Micro-benchmark for constructing numbers with the `Bitnum` and `FixedPoint`
+constructors and with the memoizing `bitnum` and `fixed_point` factories.
+
+Usage:
+    python benchmarks/numeric_types.py [--size N] [--distinct K]
+
+The values are drawn from `K` distinct numbers to mimic memories that
+repeat the same few values (zeros, quantized weights).
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from fud.stages.verilator.numeric_types import (
+    Bitnum,
+    FixedPoint,
+    bitnum,
+    fixed_point,
+)
+
+
+def measure(name, construct, values):
+    """Construct a number for each value and report the time taken and the
+    memory retained by the numbers."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    numbers = [construct(v) for v in values]
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<24}{elapsed:>10.3f}{retained / 2**20:>16.1f}{peak / 2**20:>12.1f}")
+    return numbers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=50_000)
+    parser.add_argument("--distinct", type=int, default=1_000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    ints = [str(rng.randrange(-(2**15), 2**15)) for _ in range(args.distinct)]
+    fixed = [str(rng.randrange(-(2**11), 2**11) / 2**4) for _ in range(args.distinct)]
+    ints = [rng.choice(ints) for _ in range(args.size)]
+    fixed = [rng.choice(fixed) for _ in range(args.size)]
+
+    print(f"{args.size} values, {args.distinct} distinct")
+    print(f"{'':<24}{'time (s)':>10}{'retained (MiB)':>16}{'peak (MiB)':>12}")
+    measure("Bitnum", lambda v: Bitnum(v, 16, True), ints)
+    measure("bitnum", lambda v: bitnum(v, 16, True), ints)
+    measure("FixedPoint", lambda v: FixedPoint(v, 16, 12, True), fixed)
+    measure("fixed_point", lambda v: fixed_point(v, 16, 12, True), fixed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+Benchmarks for the overhead of fud itself: loading the configuration,
+planning paths, constructing computation graphs, converting data between
+steps, and converting memories to and from the formats of the simulators.
+
+Usage:
+    python benchmarks/overhead.py [--runs N] [--sizes N ...] [-k NAME]
+                                  [--save FILE] [--compare FILE]
+
+No external tools are needed. Pipelines are executed with stub stages that
+run `cat` and `cp`, and memories are generated for every size and numeric
+format. For every benchmark, the median time of `N` runs is reported along
+with the throughput and the peak size of the Python heap, which is measured
+in a separate run.
+
+`--save` writes the results to a JSON file and `--compare` fails if a
+benchmark is slower, or uses more memory, than in a saved file by more than
+`--tolerance`. Use them to check changes to `json_to_dat.py`,
+`interpreter.py`, or `registry.py` for regressions.
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import simplejson as sjson  # type: ignore
+
+# Formats of the generated memories.
+FORMATS = {
+    "bitnum32": {"numeric_type": "bitnum", "is_signed": False, "width": 32},
+    "bitnum64s": {"numeric_type": "bitnum", "is_signed": True, "width": 64},
+    "fixed32": {
+        "numeric_type": "fixed_point",
+        "is_signed": True,
+        "width": 32,
+        "int_width": 16,
+    },
+}
+
+
+def memory(fmt, size, rng):
+    """A memory of `size` random values in the format `fmt`."""
+    format = FORMATS[fmt]
+    width = format["width"]
+    if format["numeric_type"] == "fixed_point":
+        # Multiples of 1/16 are printed exactly.
+        bound = 2 ** (format["int_width"] + 3)
+        data = (rng.integers(-bound, bound, size) / 16).tolist()
+    elif format["is_signed"]:
+        bound = 2 ** (width - 1)
+        data = rng.integers(-bound, bound, size, dtype=np.int64).tolist()
+    else:
+        data = rng.integers(0, 2**width, size, dtype=np.uint64).tolist()
+    return {"data": data, "format": format}
+
+
+def stub_stages(tmp):
+    """Stages that stream their input through `cat` and copy it with `cp`."""
+    from fud.stages import Stage, SourceType
+    from fud.utils import shell
+
+    class CatStage(Stage):
+        name = "bench-cat"
+
+        def __init__(self, src, target):
+            super().__init__(
+                src_state=src,
+                target_state=target,
+                input_type=SourceType.Stream,
+                output_type=SourceType.Stream,
+                description="Stream the input through `cat`",
+            )
+
+        def _define_steps(self, stream, builder, config):
+            @builder.step()
+            def cat(inp: SourceType.Stream) -> SourceType.Stream:
+                """Stream the input through `cat`."""
+                return shell("cat", stdin=inp, stream=True)
+
+            return cat(stream)
+
+    class CopyStage(Stage):
+        name = "bench-cp"
+
+        def __init__(self, src, target):
+            super().__init__(
+                src_state=src,
+                target_state=target,
+                input_type=SourceType.Path,
+                output_type=SourceType.Path,
+                description="Copy the input with `cp`",
+            )
+
+        def _define_steps(self, path, builder, config):
+            @builder.step()
+            def copy(inp: SourceType.Path) -> SourceType.Path:
+                """Copy the input with `cp`."""
+                out = Path(tempfile.mkstemp(dir=tmp)[1])
+                shell(f"cp {inp} {out}")
+                return out
+
+            return copy(path)
+
+    return [
+        CatStage("bench-in", "bench-a"),
+        CopyStage("bench-a", "bench-b"),
+        CatStage("bench-b", "bench-out"),
+    ]
+
+
+def benchmarks(sizes, tmp, selected):
+    """
+    The benchmarks as (name, run) pairs. `run` executes the benchmark once
+    and returns the number of bytes it processed. Other return values are
+    ignored. Benchmarks that need to be set up are only set up when
+    `selected(name)` holds.
+    """
+    from fud.config import Configuration
+    from fud.exec import RunConf, chain_stages, execute
+    from fud.main import build_registry
+    from fud.stages import Source, SourceType
+    from fud.stages.interpreter import convert_to_json, parse_from_json
+    from fud.stages.verilator.json_to_dat import (
+        convert2dat,
+        convert2json,
+        load_memories,
+    )
+
+    def load():
+        cfg = Configuration()
+        build_registry(cfg)
+        return cfg
+
+    cfg = load()
+    for stage in stub_stages(tmp):
+        cfg.registry.register(stage)
+    plans = [("calyx", "dat"), ("calyx", "vcd"), ("dahlia", "verilog")]
+    states = set(cfg.registry.graph)
+    plans = [(src, dst) for (src, dst) in plans if {src, dst} <= states]
+
+    def plan():
+        for src, dst in plans:
+            cfg.registry.make_path(src, dst)
+
+    pipeline = cfg.registry.make_path("bench-in", "bench-out")
+
+    yield "config", load
+    yield "plan", plan
+    yield "graph", lambda: chain_stages(pipeline, cfg)
+
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        text = os.urandom(size * 8).hex()
+        for src in [SourceType.Path, SourceType.String]:
+            for dst in [SourceType.Stream, SourceType.String, SourceType.Path]:
+                if src == dst:
+                    continue
+
+                def convert(src=src, dst=dst):
+                    if src == SourceType.Path:
+                        path = Path(tmp, "input")
+                        path.write_text(text)
+                        Source.path(path).convert_to(dst)
+                    else:
+                        Source(text, src).convert_to(dst)
+                    return len(text)
+
+                yield f"convert-{src.name}-{dst.name}-{size}".lower(), convert
+
+        input = Path(tmp, f"pipeline-{size}")
+        input.write_text(text)
+        conf = RunConf.from_dict(
+            {
+                "source": "bench-in",
+                "dest": "bench-out",
+                "input_file": str(input),
+                "quiet_run": True,
+            }
+        )
+
+        def run_pipeline(conf=conf):
+            output, _ = execute(conf, cfg, pipeline)
+            return len(output.convert_to(SourceType.Bytes).data)
+
+        yield f"pipeline-{size}", run_pipeline
+
+        for fmt in FORMATS:
+            mems = {"mem0": memory(fmt, size, rng), "mem1": memory(fmt, size, rng)}
+            data = json.dumps(mems).encode()
+            data_file = Path(tmp, f"{fmt}-{size}.json")
+            data_file.write_bytes(data)
+            dat_dir = Path(tmp, f"{fmt}-{size}-dat")
+            dat_dir.mkdir()
+            interp_dir = Path(tmp, f"{fmt}-{size}-interp")
+            interp_dir.mkdir()
+
+            def to_dat(data=data, dat_dir=dat_dir):
+                convert2dat(dat_dir, load_memories(io.BytesIO(data)), "dat", False)
+                return len(data)
+
+            def from_dat(data=data, dat_dir=dat_dir):
+                sjson.dumps(convert2json(dat_dir, "out"), use_decimal=True)
+                return len(data)
+
+            def to_interp(data=data, interp_dir=interp_dir):
+                convert_to_json(interp_dir, load_memories(io.BytesIO(data)), False)
+                return len(data)
+
+            def from_interp(data=data, interp_dir=interp_dir, data_file=data_file):
+                encoded = json.loads(Path(interp_dir, "data.json").read_text())
+                output = json.dumps({"memories": {"main": encoded}})
+                parse_from_json(io.StringIO(output), data_file)
+                return len(data)
+
+            yield f"json-to-dat-{fmt}-{size}", to_dat
+            if selected(f"dat-to-json-{fmt}-{size}"):
+                # Write the memories back as the outputs of a simulation.
+                to_dat()
+                for mem in mems:
+                    Path(dat_dir, f"{mem}.dat").rename(Path(dat_dir, f"{mem}.out"))
+                yield f"dat-to-json-{fmt}-{size}", from_dat
+            yield f"json-to-interp-{fmt}-{size}", to_interp
+            if selected(f"interp-to-json-{fmt}-{size}"):
+                to_interp()
+                yield f"interp-to-json-{fmt}-{size}", from_interp
+
+
+def measure(run, runs):
+    """The median time of `runs` runs of `run`, the bytes it processed, and
+    the peak size of the Python heap in an additional run."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        processed = run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if not isinstance(processed, int):
+        processed = None
+    return {"time": statistics.median(times), "bytes": processed, "peak": peak}
+
+
+def compare(results, baseline, tolerance):
+    """The benchmarks that regressed compared to `baseline`."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ["time", "peak"]:
+            old, new = baseline[name][key], result[key]
+            if old and new > old * (1 + tolerance):
+                regressions.append(f"{name}: {key} {old:.4g} -> {new:.4g}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000])
+    parser.add_argument(
+        "-k", dest="filter", help="only run the benchmarks whose name contains this"
+    )
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results to this JSON file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction a benchmark may regress by before --compare fails",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Use an empty configuration and cache.
+        os.environ["XDG_CONFIG_HOME"] = str(Path(tmp, "config"))
+        os.environ["XDG_CACHE_HOME"] = str(Path(tmp, "cache"))
+        Path(tmp, "config", "fud").mkdir(parents=True)
+        Path(tmp, "config", "fud", "config.toml").write_text(
+            f'[global]\nroot = "{tmp}"\n'
+        )
+
+        print(f"{'benchmark':<36}{'time (ms)':>10}{'MB/s':>10}{'peak (MiB)':>12}")
+        results = {}
+
+        def selected(name):
+            return not args.filter or args.filter in name
+
+        for name, run in benchmarks(args.sizes, tmp, selected):
+            if not selected(name):
+                continue
+            result = measure(run, args.runs)
+            results[name] = result
+            throughput = (
+                f"{result['bytes'] / result['time'] / 1e6:>10.1f}"
+                if result["bytes"]
+                else f"{'':>10}"
+            )
+            print(
+                f"{name:<36}{result['time'] * 1000:>10.2f}{throughput}"
+                f"{result['peak'] / 2**20:>12.2f}"
+            )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:", *regressions, sep="\n  ")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark for the startup time of the `fud` command line.
+
+Usage:
+    python benchmarks/startup.py [--runs N]
+
+Each command runs in a fresh interpreter with an empty configuration and
+cache directory, so the numbers include the import of fud and its
+dependencies.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+FUD = "import sys; from fud.main import main; sys.argv[0] = 'fud'; main()"
+
+COMMANDS = {
+    "--help": ["--help"],
+    "info": ["info"],
+    "exec -n --to verilog": ["exec", "{prog}", "--to", "verilog", "-n", "-q"],
+    "exec -n --to dat": ["exec", "{prog}", "--to", "dat", "-n", "-q"],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            XDG_CONFIG_HOME=str(Path(tmp, "config")),
+            XDG_CACHE_HOME=str(Path(tmp, "cache")),
+            PYTHONPATH=str(Path(__file__).resolve().parent.parent),
+        )
+        prog = Path(tmp, "prog.futil")
+        prog.write_text("component main() -> () { cells {} wires {} control {} }\n")
+
+        def fud(cmd):
+            cmd = [arg.format(prog=prog) for arg in cmd]
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-c", FUD] + cmd,
+                env=env,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            return time.perf_counter() - start
+
+        fud(["config", "--create", "global.root", tmp])
+
+        print(f"{'command':<24}{'min (ms)':>10}{'median (ms)':>13}")
+        for name, cmd in COMMANDS.items():
+            times = [fud(cmd) for _ in range(args.runs)]
+            print(
+                f"{name:<24}{min(times) * 1000:>10.0f}"
+                f"{statistics.median(times) * 1000:>13.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark for building and simulating designs with Verilator on one thread
+against building and simulating them on several threads.
+
+Usage:
+    python benchmarks/verilator_threads.py [--threads N] [--runs N]
+                                           [-k NAME] [FUTIL ...]
+
+Uses the configured `calyx` and `verilog` stages. By default, runs the
+designs in `examples/tutorial`, `examples/sync`, and
+`examples/futil/memory-by-reference`, each with the data used by its tests.
+For every design, the median time of `N` runs of the Verilator build and of
+the simulation is reported with a single thread and a single build job, and
+with `--threads` of both (the number of CPUs by default).
+"""
+
+import argparse
+import os
+import statistics
+from pathlib import Path
+
+# Directories of the designs and the data files for the designs in them.
+# `{}` stands for the design.
+EXAMPLES = {
+    "examples/tutorial": "examples/tutorial/data.json",
+    "examples/sync": "{}.data",
+    "examples/futil/memory-by-reference": "{}.data",
+}
+
+STEPS = {
+    "build": "verilog.compile_with_verilator",
+    "simulate": "verilog.simulate",
+}
+
+
+def designs(root, files):
+    """The designs to run and their data files."""
+    if files:
+        for file in files:
+            data = Path(f"{file}.data")
+            yield Path(file), data if data.exists() else None
+        return
+    for dir, data in EXAMPLES.items():
+        for file in sorted(Path(root, dir).glob("*.futil")):
+            yield file, Path(root, data.format(file))
+
+
+def run(cfg, design, data):
+    """The durations of the steps of the verilog stage for one run."""
+    from fud.exec import RunConf, execute
+
+    cfg[["stages", "verilog", "data"]] = str(data) if data else None
+    conf = RunConf.from_dict(
+        {
+            "source": "calyx",
+            "dest": "dat",
+            "input_file": str(design),
+            "through": ["verilog"],
+            "profiled_stages": [],
+            "quiet_run": True,
+        }
+    )
+    _, durations = execute(conf, cfg)
+    return {step: durations[name] for step, name in STEPS.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("designs", nargs="*", help="designs to run instead")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "-k", dest="filter", help="only run the designs whose name contains this"
+    )
+    args = parser.parse_args()
+
+    from fud.main import load_configuration
+
+    cfg = load_configuration()
+    # Build and simulate every time.
+    cfg.cache = None
+    cfg[["stages", "verilog", "reuse_build"]] = False
+    cfg[["stages", "verilog", "cycle_limit"]] = 500
+    cfg[["stages", "calyx", "flags"]] = " -d tdst"
+
+    settings = {"1": 1, str(args.threads): args.threads}
+    print(
+        f"{'design':<36}{'threads':>8}"
+        + "".join(f"{step + ' (s)':>14}" for step in STEPS)
+    )
+    root = cfg.get(["global", "root"]) or Path(__file__).resolve().parents[2]
+    for design, data in designs(root, args.designs):
+        if args.filter and args.filter not in design.name:
+            continue
+        for label, threads in settings.items():
+            cfg[["stages", "verilog", "threads"]] = threads
+            cfg[["stages", "verilog", "build_jobs"]] = threads
+            runs = [run(cfg, design, data) for _ in range(args.runs)]
+            times = "".join(
+                f"{statistics.median(r[step] for r in runs):>14.3f}" for step in STEPS
+            )
+            print(f"{design.stem:<36}{label:>8}{times}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+from typing import Any, Dict, List, Optional
+
+import csv
+import glob
+import json
+import logging as log
+import multiprocessing
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import simplejson as sjson  # type: ignore
+
+from . import errors
+from .config import Configuration
+from .exec import RunConf, execute, write_output
+
+# Runner set before the worker processes fork. Workers inherit it so that
+# the configuration, registry, and paths are only built once.
+_RUNNER: Optional["BatchRunner"] = None
+
+
+@dataclass
+class Job:
+    """A single execution of fud in a batch"""
+
+    # Name of the job. Also the name of its output file.
+    name: str
+    # Input file of the job
+    input_file: str
+    # Data file for the job
+    data: Optional[str] = None
+    # Stage configuration overrides for this job, e.g. `verilog.cycle_limit`
+    stage_config: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, dic, idx):
+        """Build a Job from one entry of a manifest"""
+        if "input" not in dic:
+            raise errors.Malformed("Manifest", f"Entry {idx} has no `input' key")
+        return cls(
+            dic.get("name", Path(dic["input"]).stem),
+            dic["input"],
+            dic.get("data", None),
+            dic.get("config", {}),
+        )
+
+
+def collect_jobs(inputs: List[str], manifest=None, data_suffix=None) -> List[Job]:
+    """
+    Build the list of jobs from a manifest and a list of input files or glob
+    patterns. When `data_suffix` is set, every input `f` is paired with the
+    data file `f + data_suffix`.
+    """
+    jobs = []
+    if manifest is not None:
+        with Path(manifest).open() as f:
+            entries = json.load(f)
+        if not isinstance(entries, list):
+            raise errors.Malformed("Manifest", "Expected a list of jobs")
+        jobs += [Job.from_dict(e, idx) for idx, e in enumerate(entries)]
+
+    for pattern in inputs:
+        files = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for file in files:
+            data = file + data_suffix if data_suffix else None
+            jobs.append(Job(Path(file).stem, file, data))
+
+    # Make names unique so that jobs don't overwrite each other's outputs.
+    seen: Dict[str, int] = {}
+    for job in jobs:
+        if job.name in seen:
+            seen[job.name] += 1
+            job.name = f"{job.name}-{seen[job.name]}"
+        else:
+            seen[job.name] = 0
+    return jobs
+
+
+@contextmanager
+def overrides(config: Configuration, values: Dict[str, Any]):
+    """
+    Temporarily override stage configuration `values` in `config`.
+    """
+    saved = []
+    for key, value in values.items():
+        keys = ["stages"] + key.split(".")
+        saved.append((keys, config.get(keys)))
+        config[keys] = value
+    try:
+        yield
+    finally:
+        for keys, value in reversed(saved):
+            if value is None:
+                del config[keys]
+            else:
+                config[keys] = value
+
+
+class BatchRunner:
+    """
+    Run many jobs along the same path. Paths are computed once for every
+    input state and reused by all jobs.
+    """
+
+    def __init__(self, args, config: Configuration):
+        self.source = args.source
+        self.dest = args.dest
+        self.through = args.through
+        self.data_key = args.data_key
+        self.out_dir = Path(args.out_dir)
+        self.step_jobs = args.step_jobs
+        self.config = config
+        self._paths: Dict[str, List] = {}
+
+    def path(self, input_file):
+        source = self.source
+        if source is None:
+            source = self.config.discover_implied_states(input_file)
+        if source not in self._paths:
+            self._paths[source] = self.config.construct_path(
+                source, self.dest, through=self.through
+            )
+        return self._paths[source]
+
+    def run(self, job: Job) -> Dict[str, Any]:
+        """
+        Run `job` and return its summary. Failures are reported in the
+        summary instead of being raised.
+        """
+        result: Dict[str, Any] = {
+            "name": job.name,
+            "input": job.input_file,
+            "data": job.data,
+            "output": None,
+            "status": "ok",
+            "error": None,
+        }
+        start = time.time()
+        durations: Dict[str, float] = {}
+        try:
+            if job.data is not None and not Path(job.data).exists():
+                raise FileNotFoundError(f"Data file doesn't exist: '{job.data}'")
+            conf = RunConf(
+                self.source,
+                self.dest,
+                self.through,
+                job.input_file,
+                None,
+                dry_run=False,
+                quiet=True,
+                csv=False,
+                profiled_stages=[],
+                jobs=self.step_jobs,
+            )
+            values = dict(job.stage_config)
+            if job.data is not None:
+                values[self.data_key] = job.data
+            with overrides(self.config, values):
+                output, durations = execute(
+                    conf, self.config, self.path(job.input_file)
+                )
+                if output is not None:
+                    out_file = self.out_dir / job.name
+                    write_output(output, out_file)
+                    result["output"] = str(out_file)
+        except (errors.FudError, OSError) as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+        except Exception as e:
+            # Unexpected errors of a stage only fail its job.
+            log.debug(f"{job.name} failed", exc_info=True)
+            result["status"] = "failed"
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["elapsed"] = time.time() - start
+        result["steps"] = durations
+        return result
+
+
+def _run_job(job: Job) -> Dict[str, Any]:
+    assert _RUNNER is not None, "Worker started without a runner"
+    return _RUNNER.run(job)
+
+
+def write_summary(results: List[Dict[str, Any]], out_dir: Path):
+    """
+    Write the results of all jobs to `summary.json` and `summary.csv` in
+    `out_dir`. The CSV file has one column for every step that executed.
+    """
+    with (out_dir / "summary.json").open("w") as f:
+        sjson.dump(results, f, indent=2)
+
+    steps: List[str] = []
+    for res in results:
+        steps += [s for s in res["steps"] if s not in steps]
+    header = ["name", "input", "data", "output", "status", "error", "elapsed"]
+    with (out_dir / "summary.csv").open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header + steps)
+        for res in results:
+            writer.writerow(
+                [res[h] for h in header] + [res["steps"].get(s, "") for s in steps]
+            )
+
+
+def run_batch(args, config: Configuration):
+    """
+    Run every job described by `args` and write their outputs and a summary
+    to the output directory.
+    """
+    global _RUNNER
+    jobs = collect_jobs(args.inputs, args.manifest, args.data_suffix)
+    if not jobs:
+        raise errors.FudError("No jobs to run. Provide input files or --manifest.")
+
+    runner = BatchRunner(args, config)
+    runner.out_dir.mkdir(parents=True, exist_ok=True)
+    # Compute the paths before forking so that the workers inherit them.
+    # Failures are reported by the jobs that need the path.
+    for job in jobs:
+        try:
+            runner.path(job.input_file)
+        except errors.FudError:
+            pass
+
+    log.info(f"Running {len(jobs)} jobs on {args.jobs} processes")
+    config.workers = max(args.jobs, 1)
+    if args.jobs <= 1:
+        results = [runner.run(job) for job in jobs]
+    else:
+        _RUNNER = runner
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(args.jobs) as pool:
+            results = pool.map(_run_job, jobs, chunksize=1)
+        _RUNNER = None
+
+    write_summary(results, runner.out_dir)
+    failed = [res for res in results if res["status"] != "ok"]
+    for res in failed:
+        log.error(f"{res['name']}: {res['error']}")
+    print(
+        f"{len(results) - len(failed)} of {len(results)} jobs succeeded."
+        f" Summary written to {runner.out_dir / 'summary.json'}"
+    )
+    if failed:
+        exit(-1)
@@ -0,0 +1,337 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import fcntl
+import hashlib
+import json
+import logging as log
+import os
+import re
+import shlex
+import shutil
+import threading
+from pathlib import Path
+
+import appdirs  # type: ignore
+
+from . import __version__
+
+# Default upper bound on the size of the result cache (1 GiB).
+DEFAULT_MAX_SIZE = 1 << 30
+# Default upper bound on the number of persistent build directories.
+DEFAULT_MAX_BUILDS = 16
+
+
+def file_digest(path) -> Optional[str]:
+    """
+    Returns the SHA-256 digest of the file at `path` or None if `path` is
+    not set or doesn't exist.
+    """
+    if not path or not Path(path).is_file():
+        return None
+    h = hashlib.sha256()
+    with Path(path).open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Files referred to by Calyx and Dahlia programs, like `import "core.futil";`
+# or `extern "core.sv" { ... }`.
+IMPORT = re.compile(rb'\b(?:import|extern)\s+(?:\w+\s*\(\s*)?"([^"]+)"')
+
+
+def import_digests(data: bytes, dirs) -> Dict[str, Optional[str]]:
+    """
+    The digests of the files imported by the program `data`, directly or
+    through other imported files. Imports are looked up in `dirs` and in
+    the directory of the importing file. Imports that are not found have no
+    digest.
+    """
+    dirs = [Path(d) for d in dirs]
+    digests: Dict[str, Optional[str]] = {}
+    pending = [(data, dirs)]
+    while pending:
+        src, search = pending.pop()
+        for name in IMPORT.findall(src):
+            name = name.decode()
+            found = [d / name for d in search if (d / name).is_file()]
+            if not found:
+                digests.setdefault(name, None)
+            for path in found:
+                path = path.resolve()
+                if str(path) not in digests:
+                    digests[str(path)] = file_digest(path)
+                    pending.append((path.read_bytes(), [path.parent, *dirs]))
+    return digests
+
+
+def library_dirs(flags: Optional[str]) -> List[str]:
+    """The library paths passed with `-l` in the command line `flags`."""
+    args = shlex.split(flags or "")
+    return [path for flag, path in zip(args, args[1:]) if flag in ("-l", "--lib-path")]
+
+
+def tool_fingerprint(exec_cmd) -> Optional[Dict[str, Any]]:
+    """
+    Cheap stand-in for the version of the tool invoked by `exec_cmd`.
+    Rebuilding or upgrading a tool changes the size or modification time
+    of its binary which invalidates the cached outputs it produced.
+    """
+    if not isinstance(exec_cmd, str) or not exec_cmd.strip():
+        return None
+    binary = shutil.which(exec_cmd.split()[0])
+    if binary is None:
+        return None
+    st = os.stat(binary)
+    return {"path": binary, "size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+class ResultCache:
+    """
+    A persistent, content-addressed cache for the outputs of stages.
+
+    Entries are keyed by a hash of the input to a stage, the stage itself,
+    the configuration it reads, and the version of the tools it uses. The
+    total size of the cache is bounded by `max_size`; when it is exceeded,
+    the least recently used entries are evicted first.
+    """
+
+    def __init__(self, location, max_size: int = DEFAULT_MAX_SIZE):
+        self.location = Path(location)
+        self.max_size = max_size
+        self._entries = self.location / "entries"
+        self._stats_file = self.location / "stats.json"
+
+    @classmethod
+    def from_config(cls, config) -> "ResultCache":
+        """Build a cache using the `cache` table of the configuration."""
+        max_size = config.get(["cache", "max_size"])
+        return cls(
+            cache_location(config), int(max_size) if max_size else DEFAULT_MAX_SIZE
+        )
+
+    def key(self, stage, config, data: bytes, input_dir=None) -> str:
+        """
+        Compute the key for running `stage` on the input `data`. `input_dir`
+        is the directory of the file given to fud, if any.
+        """
+        material = {
+            "fud": __version__,
+            "stage": f"{type(stage).__module__}.{type(stage).__qualname__}",
+            "attrs": {
+                k: v
+                for k, v in sorted(vars(stage).items())
+                if isinstance(v, (str, int, float, bool, type(None)))
+            },
+            "inputs": stage.cache_inputs(config),
+            "dependencies": stage.cache_dependencies(config, data, input_dir),
+        }
+        h = hashlib.sha256()
+        h.update(json.dumps(material, sort_keys=True, default=str).encode("UTF-8"))
+        h.update(hashlib.sha256(data).digest())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self._entries / key[:2] / key
+
+    def get(self, key: str) -> Optional[Path]:
+        """
+        Return the path of the entry for `key` if it exists and mark it as
+        recently used.
+        """
+        path = self._path(key)
+        if not path.exists():
+            self._record("misses")
+            return None
+        # Entries are evicted in order of their modification times.
+        os.utime(path)
+        self._record("hits")
+        return path
+
+    def put(self, key: str, data: bytes):
+        """
+        Add an entry for `key` and evict old entries if the cache has grown
+        too large.
+        """
+        if len(data) > self.max_size:
+            log.debug(f"Not caching {key}: entry larger than the cache")
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so that concurrent readers never
+        # observe partially written entries.
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        self.evict()
+
+    def _all_entries(self):
+        if not self._entries.exists():
+            return []
+        return [p for p in self._entries.glob("*/*") if not p.name.endswith(".tmp")]
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in
+        `max_size` bytes.
+        """
+        entries = []
+        total = 0
+        for p in self._all_entries():
+            st = p.stat()
+            entries.append((st.st_mtime_ns, st.st_size, p))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, p in entries:
+            if total <= self.max_size:
+                break
+            log.debug(f"Evicting cache entry {p.name}")
+            p.unlink(missing_ok=True)
+            total -= size
+
+    def _read_stats(self) -> Dict[str, int]:
+        try:
+            return json.loads(self._stats_file.read_text())
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0}
+
+    def _record(self, counter: str):
+        stats = self._read_stats()
+        stats[counter] = stats.get(counter, 0) + 1
+        self.location.mkdir(parents=True, exist_ok=True)
+        tmp = self._stats_file.with_name(
+            f"stats.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        tmp.write_text(json.dumps(stats))
+        os.replace(tmp, self._stats_file)
+
+    def stats(self) -> Dict[str, Any]:
+        """Summary of the current state of the cache."""
+        entries = self._all_entries()
+        return {
+            "location": str(self.location),
+            "entries": len(entries),
+            "size": sum(p.stat().st_size for p in entries),
+            "max_size": self.max_size,
+            **self._read_stats(),
+        }
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        shutil.rmtree(self._entries, ignore_errors=True)
+        self._stats_file.unlink(missing_ok=True)
+
+
+def cache_location(config) -> Path:
+    """The root of the cache directory configured in `config`."""
+    location = config.get(["cache", "location"])
+    return Path(location if location else appdirs.user_cache_dir("fud"))
+
+
+class BuildCache:
+    """
+    Persistent build directories, such as compiled simulators, keyed by a
+    digest of everything that went into the build. Builds that are used
+    again skip compilation entirely. At most `max_builds` directories are
+    kept; the least recently used ones are removed first.
+    """
+
+    def __init__(self, location, max_builds: int = DEFAULT_MAX_BUILDS):
+        self.location = Path(location)
+        self.max_builds = max_builds
+
+    @classmethod
+    def from_config(cls, config, name: str = "builds") -> "BuildCache":
+        """
+        Build a cache in the directory `name` using the `cache` table of the
+        configuration.
+        """
+        max_builds = config.get(["cache", "max_builds"])
+        return cls(
+            cache_location(config) / name,
+            int(max_builds) if max_builds else DEFAULT_MAX_BUILDS,
+        )
+
+    @staticmethod
+    def key(**parts) -> str:
+        """Compute the key for a build from the values in `parts`."""
+        material = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(material.encode("UTF-8")).hexdigest()
+
+    def get_or_build(self, key: str, build: Callable[[str], Any]) -> Path:
+        """
+        Return the build directory for `key`. If it doesn't exist, call
+        `build` with the name of an empty directory to populate it.
+        """
+        path = self.location / key
+        if path.is_dir():
+            log.debug(f"Reusing build {path}")
+            os.utime(path)
+            return path
+
+        # Build in a private directory and atomically move it into place so
+        # that concurrent runs never observe incomplete builds.
+        self.location.mkdir(parents=True, exist_ok=True)
+        tmp = self.location / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        try:
+            build(str(tmp))
+            os.rename(tmp, path)
+        except OSError:
+            # Another run finished the same build first.
+            if not path.is_dir():
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return path
+
+    @contextmanager
+    def persistent(self, name: str) -> Iterator[Path]:
+        """
+        Lock the build directory `name`, creating it if needed, and yield it.
+        Unlike the directories of `get_or_build`, it is updated by every
+        build so that later builds can reuse its files.
+        """
+        path = self.location / name
+        path.mkdir(parents=True, exist_ok=True)
+        with (self.location / f"{name}.lock").open("w") as lock:
+            # Wait for other runs building in the same directory.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                os.utime(path)
+                yield path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.evict()
+
+    def _all_builds(self):
+        if not self.location.exists():
+            return []
+        return [p for p in self.location.iterdir() if p.is_dir() and p.suffix != ".tmp"]
+
+    def evict(self):
+        """Remove least recently used builds until at most `max_builds` remain."""
+        builds = sorted(self._all_builds(), key=lambda p: p.stat().st_mtime_ns)
+        for p in builds[: max(0, len(builds) - self.max_builds)]:
+            log.debug(f"Removing build {p.name}")
+            shutil.rmtree(p, ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Summary of the current state of the cache."""
+        builds = self._all_builds()
+        return {
+            "location": str(self.location),
+            "builds": len(builds),
+            "size": sum(
+                f.stat().st_size for b in builds for f in b.rglob("*") if f.is_file()
+            ),
+            "max_builds": self.max_builds,
+        }
+
+    def clear(self):
+        """Remove all builds."""
+        shutil.rmtree(self.location, ignore_errors=True)
@@ -25,13 +25,6 @@ VERSIONS = {
         "help": "Try building from source: "
         + "https://www.veripool.org/projects/verilator/wiki/Installing",
     },
-    "vcd": {
-        "flag": "--version",
-        "extract": lambda out: out.split(" ")[1],
-        "version": "0.1.2",
-        "compare": ">=",
-        "help": "Run `cargo install vcdump` to update.",
-    },
     "vivado": {
         "flag": "-version",
         "extract": lambda out: out.split(" ")[1],
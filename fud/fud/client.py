@@ -0,0 +1,82 @@
+"""
+Forwards `fud exec` commands to the `fud server` listening on the socket
+named by the `FUD_SERVER` environment variable. The server is opt-in: without
+the variable, `fud.main` executes all commands in its own process.
+
+This module only imports the standard library modules needed to talk to
+the server.
+"""
+
+from typing import List, Optional
+
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+from . import __version__
+
+# Length of the JSON request that follows it.
+HEADER = struct.Struct("<Q")
+# Subcommands that are executed by the server.
+FORWARDED = ["exec", "e", "ex"]
+
+
+def forward(path: str, argv: List[str]) -> Optional[int]:
+    """
+    Execute the command line `argv` on the fud server listening on `path`.
+    Returns the exit status of the command, or None if the server can't
+    execute it.
+    """
+    request = json.dumps(
+        {
+            "version": __version__,
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }
+    ).encode("UTF-8")
+
+    # Passing file descriptors requires Python 3.9.
+    if not hasattr(socket, "send_fds"):
+        print("[fud] The fud server requires Python 3.9 or later", file=sys.stderr)
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        socket.send_fds(sock, [HEADER.pack(len(request))], [0, 1, 2])
+        sock.sendall(request)
+        response = b""
+        while not response.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("Connection closed by the server")
+            response += chunk
+    except OSError as e:
+        print(f"[fud] Cannot use the fud server at {path}: {e}", file=sys.stderr)
+        return None
+    except KeyboardInterrupt:
+        return 128 + signal.SIGINT
+    finally:
+        sock.close()
+
+    msg = json.loads(response)
+    if "error" in msg:
+        print(f"[fud] The fud server at {path}: {msg['error']}", file=sys.stderr)
+        return None
+    return msg["status"]
+
+
+def run_on_server(argv: List[str]) -> Optional[int]:
+    """
+    Execute the command line `argv` on the server named by `FUD_SERVER`, if
+    it is set and the command is forwarded. Returns the exit status of the
+    command, or None if it must be executed in this process.
+    """
+    server = os.environ.get("FUD_SERVER")
+    if server and argv and argv[0] in FORWARDED:
+        return forward(server, argv)
+    return None
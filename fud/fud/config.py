@@ -10,7 +10,7 @@ from pprint import PrettyPrinter
 from . import stages
 
 from .utils import eprint
-from . import errors, external, registry
+from . import cache, errors, external, registry
 
 # Key for the root folder
 ROOT = "root"
@@ -25,6 +25,12 @@ WIZARD_DATA = {
 DEFAULT_CONFIGURATION = {
     "global": {},
     "externals": {},
+    "cache": {
+        "enabled": False,
+        "location": None,
+        "max_size": 1 << 30,
+        "max_builds": 16,
+    },
     "stages": {
         "calyx": {
             "exec": "./target/debug/calyx",
@@ -49,8 +55,24 @@ DEFAULT_CONFIGURATION = {
             "cycle_limit": int(5e8),
             "round_float_to_fixed": True,
             "data": None,
+            "reuse_build": False,
+            "data_format": "dat",
+            "trace_scopes": None,
+            "trace_start": None,
+            "trace_end": None,
+            "outputs": None,
+            "build_jobs": None,
+            "threads": 1,
+            "opt_level": None,
+            "incremental": False,
+        },
+        "vcd": {
+            "file_extensions": [".vcd"],
+            "signals": None,
+            "start": None,
+            "end": None,
+            "format": "nested",
         },
-        "vcd": {"exec": "vcdump", "file_extensions": [".vcd"]},
         "vcd_json": {"file_extensions": [".json"]},
         "jq": {"exec": "jq", "flags": None},
         "dat": {"file_extensions": [".dat"]},
@@ -202,6 +224,11 @@ class Configuration:
            for the verilog stage.
         3. externals: A table with (name, path) pairs for scripts that define
            external stages.
+        4. cache: Configuration for the result cache. `enabled` turns it on,
+           `location` overrides the cache directory, and `max_size` bounds
+           its size in bytes. `max_builds` bounds the number of simulator
+           builds kept for stages with `reuse_build` set, and the number of
+           object directories kept for stages with `incremental` set.
     """
 
     def __init__(self):
@@ -216,6 +243,11 @@ class Configuration:
             self.config_file.touch()
 
         self.registry: registry.Registry = None
+        # Result cache for stage outputs. Only set when caching is enabled.
+        self.cache: Optional[cache.ResultCache] = None
+        # Number of runs of fud that execute at the same time, like the jobs
+        # of `fud exec-many`. Stages share the CPUs between them.
+        self.workers = 1
 
         # load the configuration file
         self.config = DynamicDict(toml.load(self.config_file))
@@ -1,14 +1,14 @@
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 
+import json
 import logging as log
 import shutil
 import sys
+from io import BytesIO
 from pathlib import Path
 from dataclasses import dataclass
 
-from halo import Halo  # type: ignore
-
-from . import errors, utils, executor
+from . import errors, utils, executor, scheduler
 from .config import Configuration
 from .stages import Source, SourceType, ComputationGraph, Stage
 
@@ -29,6 +29,15 @@ class RunConf:
     quiet: bool
     csv: bool
     profiled_stages: Optional[List[str]]
+    # Maximum number of steps to execute in parallel
+    jobs: int = 1
+    # Execute the steps with the asyncio engine
+    use_async: bool = False
+    # Files to write a Chrome trace and a JSON summary of the profiled run to
+    trace_file: Optional[str] = None
+    profile_file: Optional[str] = None
+    # Also profile the memory and I/O usage of every step
+    profile_memory: bool = False
 
     @classmethod
     def from_args(cls, args):
@@ -43,6 +52,21 @@ class RunConf:
             args.quiet,
             args.csv,
             args.profiled_stages,
+            args.jobs,
+            args.use_async,
+            args.trace_file,
+            args.profile_file,
+            args.profile_memory,
+        )
+
+    @property
+    def profiled(self) -> bool:
+        """Whether the execution is profiled."""
+        return (
+            self.profiled_stages is not None
+            or self.trace_file is not None
+            or self.profile_file is not None
+            or self.profile_memory
         )
 
     @classmethod
@@ -58,18 +82,40 @@ class RunConf:
             dic.get("quiet_run", False),
             dic.get("csv", False),
             dic.get("profiled_stages", None),
+            dic.get("jobs", 1),
+            dic.get("async", False),
+            dic.get("trace_file", None),
+            dic.get("profile_file", None),
+            dic.get("profile_memory", False),
         )
 
 
-def report_profiling(durations: Dict[str, float], is_csv: bool):
+def report_profiling(
+    durations: Dict[str, float],
+    is_csv: bool,
+    usage: Optional[Dict[str, Dict[str, int]]] = None,
+):
     """
     Report profiling information collected during execution.
     """
     data = Source(None, SourceType.String)
-    data.data = utils.profile_stages(durations, is_csv)
+    data.data = utils.profile_stages(durations, is_csv, usage)
     return data
 
 
+def write_profiles(args: RunConf, exec: executor.Executor):
+    """
+    Write the Chrome trace and the summary of a profiled run, including runs
+    that failed, to the files requested by `args`.
+    """
+    if args.trace_file is not None:
+        with Path(args.trace_file).open("w") as f:
+            json.dump(exec.chrome_trace(), f)
+    if args.profile_file is not None:
+        with Path(args.profile_file).open("w") as f:
+            json.dump(exec.profile_summary(), f, indent=2)
+
+
 def chain_stages(
     path: List[Stage], config: Configuration, builder: Optional[ComputationGraph] = None
 ) -> ComputationGraph:
@@ -94,10 +140,13 @@ def run_fud_from_args(args, config: Configuration):
     return run_fud(RunConf.from_args(args), config)
 
 
-def get_fud_output(args: RunConf, config: Configuration):
+def prepare(
+    args: RunConf, config: Configuration, path: Optional[List[Stage]] = None
+) -> Optional[Tuple[ComputationGraph, Source, executor.Executor]]:
     """
-    Execute all the stages implied by the passed `args`,
-    and get an output `Source` object
+    Construct the computation graph for all the stages implied by the passed
+    `args` (or along `path`, if it is given) along with its input and the
+    executor that runs it. Returns None for dry runs.
     """
     # check if input_file exists
     input_file = None
@@ -106,9 +155,10 @@ def get_fud_output(args: RunConf, config: Configuration):
         if not input_file.exists():
             raise FileNotFoundError(input_file)
 
-    path = config.construct_path(
-        args.source, args.dest, args.input_file, args.output_file, args.through
-    )
+    if path is None:
+        path = config.construct_path(
+            args.source, args.dest, args.input_file, args.output_file, args.through
+        )
 
     # check if input is needed
     inp_type = path[0].input_type
@@ -127,20 +177,23 @@ def get_fud_output(args: RunConf, config: Configuration):
     if args.dry_run:
         print("fud will perform the following steps:")
         staged.dry_run()
-        return
+        return None
 
     # spinner is disabled if we are in debug mode, doing a dry_run, or are in quiet mode
     spinner_enabled = not (utils.is_debug() or args.quiet)
     # Execute the path transformation specification.
     if spinner_enabled:
+        from halo import Halo  # type: ignore
+
         sp = Halo(
             spinner="dots", color="cyan", stream=sys.stderr, enabled=spinner_enabled
         )
     else:
         sp = None
 
-    enable_profile = args.profiled_stages is not None
-    exec = executor.Executor(sp, log.getLogger().level <= log.INFO, enable_profile)
+    exec = executor.Executor(
+        sp, log.getLogger().level <= log.INFO, args.profiled, args.profile_memory
+    )
 
     # construct a source object for the input
     input = None
@@ -152,30 +205,128 @@ def get_fud_output(args: RunConf, config: Configuration):
     else:
         input = Source.path(input_file)
 
+    return staged, input, exec
+
+
+def _drain(staged: ComputationGraph, exec: executor.Executor):
+    """
+    Read the rest of the final output if a tool is still streaming it. This
+    reports the failure of the tool and charges the time it ran to the step
+    that started it. Used for profiled executions, whose reports are
+    produced before the output is written.
+    """
+    output = staged.output
+    if output is not None and isinstance(output.data, utils.ShellStream):
+        output.data = BytesIO(output.data.read())
+    exec.end_streams()
+
+
+def _execute(
+    args: RunConf, config: Configuration, path: Optional[List[Stage]] = None
+) -> Tuple[Optional[Source], Optional[executor.Executor]]:
+    """
+    Execute all the stages implied by the passed `args`. Returns the output of
+    the last stage along with the executor that holds the profiling
+    information, which is None for dry runs.
+    """
+    if args.use_async:
+        # Only import asyncio when it is used since it slows down startup.
+        import asyncio
+
+        return asyncio.run(_execute_async(args, config, path))
+
+    prepared = prepare(args, config, path)
+    if prepared is None:
+        return None, None
+    staged, input, exec = prepared
+
     # Execute the generated path
-    with exec:
-        for step in staged.get_steps(input):
-            if step.output.typ == SourceType.Terminal:
-                exec.disable_spinner()
-            # Execute step within the stage
-            with exec.context(step.name):
-                step()
+    try:
+        with exec:
+            scheduler.run(staged, input, exec, args.jobs)
+            if args.profiled:
+                _drain(staged, exec)
+    finally:
+        staged.cleanup()
+        write_profiles(args, exec)
+
+    return staged.output, exec
+
+
+async def _execute_async(
+    args: RunConf, config: Configuration, path: Optional[List[Stage]] = None
+) -> Tuple[Optional[Source], Optional[executor.Executor]]:
+    prepared = prepare(args, config, path)
+    if prepared is None:
+        return None, None
+    staged, input, exec = prepared
+
+    try:
+        with exec:
+            await scheduler.run_async(staged, input, exec, args.jobs)
+            if args.profiled:
+                _drain(staged, exec)
+    finally:
+        staged.cleanup()
+        write_profiles(args, exec)
+
+    return staged.output, exec
+
+
+def execute(
+    args: RunConf, config: Configuration, path: Optional[List[Stage]] = None
+) -> Tuple[Optional[Source], Dict[str, float]]:
+    """
+    Execute all the stages implied by the passed `args` (or along `path`, if
+    it is given). Returns the output of the last stage along with the
+    duration of each step when profiling is enabled.
+    """
+    output, exec = _execute(args, config, path)
+    return output, exec.durations if exec is not None else {}
+
+
+async def execute_async(
+    args: RunConf, config: Configuration, path: Optional[List[Stage]] = None
+) -> Tuple[Optional[Source], Dict[str, float]]:
+    """
+    Like `execute`, but execute the steps on the running asyncio event loop
+    so that several executions can share one process.
+    """
+    output, exec = await _execute_async(args, config, path)
+    return output, exec.durations if exec is not None else {}
+
+
+def get_fud_output(args: RunConf, config: Configuration):
+    """
+    Execute all the stages implied by the passed `args`,
+    and get an output `Source` object
+    """
+    output, exec = _execute(args, config)
+    if args.dry_run:
+        return
 
     # Report profiling information if flag was provided.
-    if enable_profile:
-        output = Source(None, SourceType.String)
+    if args.profiled_stages is not None:
+        durations = exec.durations
         if args.profiled_stages:
             durations = dict(
-                filter(lambda kv: kv[0] in args.profiled_stages, exec.durations.items())
+                filter(lambda kv: kv[0] in args.profiled_stages, durations.items())
             )
-        else:
-            durations = exec.durations
-        output.data = utils.profile_stages(durations, args.csv)
-    else:
-        output = staged.output
+        return report_profiling(durations, args.csv, exec.usage)
     return output
 
 
+def write_output(output: Source, output_file):
+    """
+    Place `output` in `output_file`.
+    """
+    if output.typ == SourceType.Directory:
+        shutil.move(output.data.name, output_file)
+    else:
+        with Path(output_file).open("wb") as f:
+            f.write(output.convert_to(SourceType.Bytes).data)
+
+
 def run_fud(args: RunConf, config: Configuration):
     """
     Execute all the stages implied by the passed `args`,
@@ -186,10 +337,6 @@ def run_fud(args: RunConf, config: Configuration):
     output = get_fud_output(args, config)
     # output the data or profiling information.
     if args.output_file is not None:
-        if output.typ == SourceType.Directory:
-            shutil.move(output.data.name, args.output_file)
-        else:
-            with Path(args.output_file).open("wb") as f:
-                f.write(output.convert_to(SourceType.Bytes).data)
+        write_output(output, args.output_file)
     elif output:
         print(output.convert_to(SourceType.String).data)
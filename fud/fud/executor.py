@@ -1,6 +1,15 @@
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
+import os
+import threading
 import time
+import tracemalloc
+from contextvars import ContextVar
+
+try:
+    import resource
+except ModuleNotFoundError:
+    resource = None  # type: ignore
 
 
 class DummySpinner:
@@ -25,25 +34,194 @@ class DummySpinner:
         pass
 
 
+class Span:
+    """
+    An interval of time spent in a stage, a step, or a tool (process) started
+    by a step. Times are in nanoseconds from `time.perf_counter_ns`.
+    """
+
+    def __init__(self, name: str, kind: str, start: int):
+        self.name = name
+        # One of "stage", "step", or "process".
+        self.kind = kind
+        self.start = start
+        self.end = start
+        # The thread the span executed on.
+        self.thread = threading.get_ident()
+        # Nested spans: the steps of a stage and the tools started by a step.
+        self.children: List[Span] = []
+        # Additional information, such as resource usage.
+        self.args: Dict[str, Any] = {}
+        self.failed = False
+        # Resource usage of the exited tools when a process span started.
+        self.usage = None
+        # Whether the span ended. A tool that streams its output may still
+        # run once all steps finished.
+        self.finished = True
+
+    @property
+    def duration(self) -> float:
+        """Duration of the span in seconds."""
+        return (self.end - self.start) / 1e9
+
+    def summary(self) -> Dict[str, Any]:
+        out = {"name": self.name, "duration": self.duration}
+        if self.failed:
+            out["failed"] = True
+        if not self.finished:
+            out["finished"] = False
+        out.update(self.args)
+        if self.children:
+            key = "steps" if self.kind == "stage" else "processes"
+            out[key] = [c.summary() for c in self.children]
+        return out
+
+
+# The span of the step executing in the current context, if it is profiled.
+# Tools started by the step with `utils.shell` are recorded under it.
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def _children_usage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def start_process(cmd: str) -> Optional[Span]:
+    """
+    Start the span of a tool started by the step executing in the current
+    context. Returns None when the step isn't profiled.
+    """
+    step = current_span.get()
+    if step is None:
+        return None
+    span = Span(cmd, "process", time.perf_counter_ns())
+    span.finished = False
+    span.usage = _children_usage()
+    step.children.append(span)
+    return span
+
+
+def end_process(span: Optional[Span], returncode: Optional[int], usage=None):
+    """
+    End the span of a tool once it exited. `usage` is the resource usage of the
+    tool itself, if it is known. Otherwise, resource usage is measured over
+    all the tools that exited in the meantime, so it is only exact when no
+    other tool runs at the same time.
+    """
+    if span is None:
+        return
+    span.end = time.perf_counter_ns()
+    span.failed = bool(returncode)
+    span.finished = True
+    if usage is not None:
+        span.args["user_cpu"] = usage.ru_utime
+        span.args["system_cpu"] = usage.ru_stime
+        span.args["max_rss_kb"] = usage.ru_maxrss
+        return
+    before, after = span.usage, _children_usage()
+    if after is not None:
+        span.args["user_cpu"] = after.ru_utime - before.ru_utime
+        span.args["system_cpu"] = after.ru_stime - before.ru_stime
+        # Peak resident set size of the largest tool so far, in kilobytes.
+        span.args["max_rss_kb"] = after.ru_maxrss
+
+
+def wait_process(proc, span: Optional[Span]):
+    """
+    Wait for the `subprocess.Popen` object `proc` and end its span. When the
+    tool is profiled, it is reaped with `os.wait4` to record its own resource
+    usage.
+    """
+    if span is None or not hasattr(os, "wait4") or proc.returncode is not None:
+        proc.wait()
+        end_process(span, proc.returncode)
+        return
+    _, status, usage = os.wait4(proc.pid, 0)
+    # Like `os.waitstatus_to_exitcode`, which requires Python 3.9.
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    end_process(span, proc.returncode, usage)
+
+
+def _count(key: str, amount: int):
+    span = current_span.get()
+    if span is not None:
+        span.args[key] = span.args.get(key, 0) + amount
+
+
+def record_io(read: int = 0, written: int = 0, copied: int = 0):
+    """
+    Count the bytes read into memory, written to files, and copied in total
+    by the source conversions of the step executing in the current context,
+    if it is profiled.
+    """
+    _count("read_bytes", read)
+    _count("written_bytes", written)
+    _count("copied_bytes", copied)
+
+
+def record_conversion(steps: int):
+    """
+    Count a source conversion made of `steps` primitive conversions for the
+    step executing in the current context, if it is profiled.
+    """
+    _count("conversions", steps)
+
+
+def record_objects(reused: int, compiled: int):
+    """
+    Count the object files that the step executing in the current context
+    reused from an earlier build and compiled, if it is profiled.
+    """
+    _count("reused_objects", reused)
+    _count("compiled_objects", compiled)
+
+
+# The memory and I/O usage recorded for each step when profiling memory.
+USAGE_KEYS = ["heap_peak_bytes", "max_rss_kb", "read_bytes", "written_bytes"]
+
+
 class Profiler:
     """
     Interface for profiling runtime
     """
 
-    def __init__(self):
-        self._current_time = None
+    def __init__(self, name, memory=False):
+        self.name = name
+        self.span = None
+        # Measure the peak size of the Python heap. Requires `tracemalloc` to
+        # be tracing.
+        self.memory = memory
 
     def start(self):
-        assert self._current_time is None, "Attempt to start multiple measurements"
-        self._current_time = time.time()
+        assert self.span is None, "Attempt to start multiple measurements"
+        self.span = Span(self.name, "step", time.perf_counter_ns())
+        self._token = current_span.set(self.span)
+        if self.memory:
+            if hasattr(tracemalloc, "reset_peak"):
+                self._heap = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            else:
+                # Python 3.8 can only reset the peak along with the traces.
+                tracemalloc.clear_traces()
+                self._heap = 0
 
     def end(self):
-        assert (
-            self._current_time is not None
-        ), "Attempt to end measurement before it starts"
-        t = self._current_time
-        self._current_time = None
-        return time.time() - t
+        assert self.span is not None, "Attempt to end measurement before it starts"
+        self.span.end = time.perf_counter_ns()
+        current_span.reset(self._token)
+        if self.memory:
+            # Memory allocated by the step on top of what was already in use.
+            peak = tracemalloc.get_traced_memory()[1]
+            self.span.args["heap_peak_bytes"] = max(peak - self._heap, 0)
+            rss = [p.args["max_rss_kb"] for p in self.span.children if p.finished]
+            if rss:
+                self.span.args["max_rss_kb"] = max(rss)
+        return self.span.duration
 
 
 class DummyProfiler:
@@ -52,7 +230,7 @@ class DummyProfiler:
     """
 
     def __init__(self):
-        pass
+        self.span = None
 
     def start(self):
         pass
@@ -66,64 +244,200 @@ class Executor:
     Executor for paths.
     """
 
-    def __init__(self, spinner, persist=False, profile=False):
+    def __init__(self, spinner, persist=False, profile=False, memory=False):
         # Persist outputs from the spinner
         self._persist = persist
         # Spinner object
         self._spinner = DummySpinner() if spinner is None else spinner
-        # Profiler for this executor
-        self._profiler = Profiler() if profile else DummyProfiler()
-
-        # Current context
-        self.ctx: Optional[str] = None
+        # Profile the contexts of this executor
+        self._profile = profile or memory
+        # Also profile the memory used by the contexts
+        self._memory = memory
+        self._started_tracing = False
+
+        # Currently active contexts. Contexts are only active at the same time
+        # when steps execute in parallel.
+        self.active: List[str] = []
+        # Guards the spinner and the state of the executor
+        self._lock = threading.Lock()
 
         # Disable spinner outputs
         self._no_spinner = False
         # Mapping from stage -> step -> duration
         self.durations = {}
+        # Spans of the profiled steps in the order they finished
+        self.spans: List[Span] = []
+        # Mapping from step -> memory and I/O usage when profiling memory
+        self.usage: Dict[str, Dict[str, int]] = {}
 
     def __enter__(self):
+        if self._memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self._spinner.stop()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
 
     # Control spinner behavior
     def disable_spinner(self):
         """
         Stop and disable the spinner
         """
-        self._spinner.stop()
-        self._no_spinner = True
+        with self._lock:
+            self._spinner.stop()
+            self._no_spinner = True
 
     def enable_spinner(self):
         self._no_spinner = False
 
     def context(self, name):
-        return ContextExecutor(self, name, self._profiler)
+        if self._profile:
+            profiler = Profiler(name, self._memory)
+        else:
+            profiler = DummyProfiler()
+        return ContextExecutor(self, name, profiler)
 
     def _update(self):
         if not self._no_spinner:
-            self._spinner.start(self.ctx)
+            self._spinner.start(", ".join(self.active) if self.active else None)
 
     # Mark context boundaries
     def _start_ctx(self, name):
-        assert self.ctx is None, "Attempted to start a nested execution"
-        self.ctx = name
-        self._update()
-
-    def _end_ctx(self, is_err, profiling_data=None):
-        msg = self.ctx
-        if profiling_data:
-            self.durations[self.ctx] = profiling_data
-            msg += f" ({profiling_data:.3f} ms)"
-        if self._persist:
-            if is_err:
-                self._spinner.fail(msg)
-            else:
-                self._spinner.succeed(msg)
-        self.ctx = None
-        self._update()
+        with self._lock:
+            assert name not in self.active, "Attempted to start a nested execution"
+            self.active.append(name)
+            self._update()
+
+    def _end_ctx(self, name, is_err, profiling_data=None, span=None):
+        with self._lock:
+            msg = name
+            if span is not None:
+                span.failed = is_err
+                self.spans.append(span)
+                if self._memory:
+                    self.usage[name] = {
+                        key: span.args.get(key, 0) for key in USAGE_KEYS
+                    }
+            if profiling_data:
+                self.durations[name] = profiling_data
+                msg += f" ({profiling_data:.3f} s)"
+            if self._persist:
+                if is_err:
+                    self._spinner.fail(msg)
+                else:
+                    self._spinner.succeed(msg)
+            self.active.remove(name)
+            self._update()
+
+    def end_streams(self):
+        """
+        Extend the spans and durations of the steps whose tools kept streaming
+        their output after the step returned to the exit of those tools, and
+        record the memory usage of those tools when profiling memory.
+        """
+        with self._lock:
+            for span in self.spans:
+                end = max((p.end for p in span.children if p.finished), default=0)
+                if end > span.end:
+                    span.end = end
+                    if span.name in self.durations:
+                        self.durations[span.name] = span.duration
+                if not self._memory:
+                    continue
+                rss = [p.args["max_rss_kb"] for p in span.children if p.finished]
+                if rss:
+                    span.args["max_rss_kb"] = max(rss)
+                    self.usage[span.name]["max_rss_kb"] = max(rss)
+
+    def stage_spans(self) -> List[Span]:
+        """
+        Group the spans of the profiled steps by stage. The span of a stage
+        covers all of its steps.
+        """
+        stages: Dict[str, Span] = {}
+        for step in sorted(self.spans, key=lambda s: s.start):
+            name = step.name.split(".")[0]
+            if name not in stages:
+                stages[name] = Span(name, "stage", step.start)
+                stages[name].thread = step.thread
+            stage = stages[name]
+            stage.end = max(stage.end, step.end)
+            stage.failed |= step.failed
+            stage.children.append(step)
+        return list(stages.values())
+
+    def profile_summary(self) -> Dict[str, Any]:
+        """
+        A machine-readable summary of the profiled run: the duration of every
+        stage, step, and tool in seconds along with the CPU time and memory
+        used by the tools.
+        """
+        stages = self.stage_spans()
+        total = 0.0
+        if stages:
+            total = (max(s.end for s in stages) - stages[0].start) / 1e9
+        return {"duration": total, "stages": [s.summary() for s in stages]}
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """
+        The spans of the profiled run in the Chrome trace event format, which
+        can be viewed with `chrome://tracing` or https://ui.perfetto.dev.
+        Stages are shown on their own track above the threads that executed
+        the steps.
+        """
+        stages = self.stage_spans()
+        if not stages:
+            return {"traceEvents": []}
+        origin = stages[0].start
+        pid = os.getpid()
+        threads = {}
+        events = []
+
+        def name_track(tid: int, name: str):
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+
+        def add(span: Span, tid: int):
+            args = dict(span.args)
+            if span.failed:
+                args["failed"] = True
+            if not span.finished:
+                args["finished"] = False
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.kind,
+                    "ph": "X",
+                    "ts": (span.start - origin) / 1e3,
+                    "dur": (span.end - span.start) / 1e3,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+
+        name_track(0, "stages")
+        for stage in stages:
+            add(stage, 0)
+            for step in stage.children:
+                if step.thread not in threads:
+                    threads[step.thread] = len(threads) + 1
+                    name_track(threads[step.thread], f"thread {threads[step.thread]}")
+                add(step, threads[step.thread])
+                for proc in step.children:
+                    add(proc, threads[step.thread])
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
 
 
 class ContextExecutor(object):
@@ -141,4 +455,7 @@ class ContextExecutor(object):
         self.parent_exec._start_ctx(self.ctx)
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.parent_exec._end_ctx(exc_type is not None, self.profiler.end())
+        span = self.profiler.span
+        self.parent_exec._end_ctx(
+            self.ctx, exc_type is not None, self.profiler.end(), span
+        )
@@ -1,7 +1,15 @@
+from typing import List
+
+import functools
 import importlib.util
+import json
+import logging as log
+import os
 from pathlib import Path
 
 from fud import errors
+from fud.cache import cache_location
+from fud.registry import LazyStage
 
 
 def validate_external_stage(stage, cfg):
@@ -30,3 +38,84 @@ def validate_external_stage(stage, cfg):
         )
 
     return mod
+
+
+def construct_stage(ext, location, stage_class):
+    """Construct a stage exported by the external script `ext`."""
+    try:
+        return stage_class()
+    except Exception as e:
+        raise errors.InvalidExternalStage(
+            ext,
+            "\n".join(
+                [
+                    f"In {stage_class.name} from '{location}':",
+                    "```",
+                    str(e),
+                    "```",
+                ]
+            ),
+        ) from e
+
+
+def external_stages(ext, cfg) -> List[LazyStage]:
+    """
+    The stages exported by the external script `ext`.
+    The name, states, and description of the stages are stored in
+    `externals.json` in the cache directory along with the modification time
+    of the script. The script is only imported when it has changed or when
+    one of its stages is used.
+    """
+    location = cfg["externals", ext]
+    metadata_file = cache_location(cfg) / "externals.json"
+    try:
+        stat = os.stat(location)
+        version = [stat.st_mtime_ns, stat.st_size]
+    except OSError:
+        version = None
+
+    try:
+        metadata = json.loads(metadata_file.read_text())
+    except (OSError, ValueError):
+        metadata = {}
+
+    module = functools.lru_cache(maxsize=None)(
+        lambda: validate_external_stage(ext, cfg)
+    )
+
+    def load(idx):
+        return lambda: construct_stage(ext, location, module().__STAGES__[idx])
+
+    entry = metadata.get(location)
+    if version is not None and entry is not None and entry["version"] == version:
+        return [
+            LazyStage(name, src, target, description, load(idx))
+            for idx, (name, src, target, description) in enumerate(entry["stages"])
+        ]
+
+    # Import the script to find out which stages it exports.
+    constructed = [
+        construct_stage(ext, location, stage_class)
+        for stage_class in module().__STAGES__
+    ]
+    metadata[location] = {
+        "version": version,
+        "stages": [
+            [st.name, st.src_state, st.target_state, st.description]
+            for st in constructed
+        ],
+    }
+    try:
+        metadata_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = metadata_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(metadata, default=str))
+        os.replace(tmp, metadata_file)
+    except OSError as e:
+        log.debug(f"Cannot store the stages of `{ext}': {e}")
+
+    return [
+        LazyStage(
+            st.name, st.src_state, st.target_state, st.description, lambda st=st: st
+        )
+        for st in constructed
+    ]
@@ -1,157 +1,259 @@
+from typing import List, Optional
+
 import argparse
 import logging as log
+import sys
 from sys import exit
 import os
 
 import toml
 
-from . import check, errors, exec, utils, external
+from . import errors, exec, utils, external
+from .cache import BuildCache, ResultCache
+from .objcache import COMPILED_OBJECTS, OBJECT_DIRS
 from .config import Configuration
-from .registry import Registry
-from .stages import (
-    dahlia,
-    futil,
-    interpreter,
-    relay,
-    systolic,
-    vcdump,
-    jq,
-    verilator,
-    vivado,
-    xilinx,
-)
+from .registry import LazyStage, Registry, factory
 
 
 def register_stages(registry):
     """
     Register stages and command line flags required to generate the results.
+    Stages are registered with their name, states, and description. The
+    module that implements a stage is only imported when the stage is used.
     """
-    # Dahlia
-    registry.register(
-        dahlia.DahliaStage(
-            "calyx", "-b calyx --lower -l error", "Compile Dahlia to Calyx"
-        )
-    )
-    registry.register(
-        dahlia.DahliaStage(
-            "vivado-hls",
-            "--memory-interface ap_memory",
-            "Compile Dahlia to Vivado C++",
+
+    def register(path, name, src, target, description, *args):
+        registry.register(
+            LazyStage(name, src, target, description, factory(path, *args))
         )
+
+    # Dahlia
+    dahlia = "fud.stages.dahlia:DahliaStage"
+    register(
+        dahlia,
+        "dahlia",
+        "dahlia",
+        "calyx",
+        "Compile Dahlia to Calyx",
+        "calyx",
+        "-b calyx --lower -l error",
+        "Compile Dahlia to Calyx",
+    )
+    register(
+        dahlia,
+        "dahlia",
+        "dahlia",
+        "vivado-hls",
+        "Compile Dahlia to Vivado C++",
+        "vivado-hls",
+        "--memory-interface ap_memory",
+        "Compile Dahlia to Vivado C++",
     )
 
     # Relay
-    registry.register(relay.RelayStage())
+    register(
+        "fud.stages.relay:RelayStage",
+        "relay",
+        "relay",
+        "calyx",
+        "Generates the Calyx program from the TVM Relay IR.",
+    )
     # Systolic Array
-    registry.register(systolic.SystolicStage())
+    register(
+        "fud.stages.systolic:SystolicStage",
+        "systolic",
+        "systolic",
+        "calyx",
+        "Generates a matrix multiply using a systolic array architecture",
+    )
     # Calyx
-    registry.register(
-        futil.CalyxStage(
+    for target, flags, description in [
+        (
             "verilog",
             "-b verilog",
             "Compile Calyx to Verilog instrumented for simulation",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "mlir",
             "-b mlir -p well-formed -p lower-guards",
             "Compile Calyx to MLIR",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "synth-verilog",
             "-b verilog --synthesis -p external --disable-verify",
             "Compile Calyx to synthesizable Verilog",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "calyx-lowered",
             "-b calyx",
             "Compile Calyx to Calyx to remove all control and inline groups",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "calyx-noinline",
             "-b calyx -d hole-inliner",
             "Compile Calyx to Calyx to remove all control and inline groups",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "calyx-externalize",
             "-b calyx -p externalize",
             "Compile Calyx to Calyx to externalize all external memory primitives",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "axi-wrapper",
             "-b xilinx",
             "Generate the AXI wrapper for Calyx",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "xilinx-xml",
             "-b xilinx-xml",
             "Generate the XML metadata for Xilinx",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "interpreter",
             "-p none",
             "Compile Calyx for interpretation with CIDR",
-        )
-    )
-    registry.register(
-        futil.CalyxStage(
+        ),
+        (
             "resources",
             "-b resources",
             "Generate a CSV that estimates a Calyx program's resource usage",
+        ),
+    ]:
+        register(
+            "fud.stages.futil:CalyxStage",
+            "calyx",
+            "calyx",
+            target,
+            description,
+            target,
+            flags,
+            description,
         )
-    )
 
     # Data conversion
-    registry.register(verilator.JsonToDat())
-    registry.register(verilator.DatToJson())
+    verilator = "fud.stages.verilator.stage"
+    register(
+        f"{verilator}:JsonToDat",
+        "to-dat",
+        "mem-json",
+        "mem-dat",
+        "Converts JSON data to Dat.",
+    )
+    register(
+        f"{verilator}:DatToJson",
+        "to-json",
+        "mem-dat",
+        "mem-json",
+        "Converts JSON data to Dat.",
+    )
 
     # Verilator
-    registry.register(
-        verilator.VerilatorStage("vcd", "Generate a VCD file from Verilog simulation")
-    )
-    registry.register(
-        verilator.VerilatorStage(
-            "dat", "Generate a JSON file with final state of all memories"
+    for target, description in [
+        ("vcd", "Generate a VCD file from Verilog simulation"),
+        ("dat", "Generate a JSON file with final state of all memories"),
+    ]:
+        register(
+            f"{verilator}:VerilatorStage",
+            "verilog",
+            "verilog",
+            target,
+            description,
+            target,
+            description,
         )
-    )
 
     # # Vivado / vivado hls
-    registry.register(vivado.VivadoStage())
-    registry.register(vivado.VivadoExtractStage())
-    registry.register(vivado.VivadoHLSStage())
-    registry.register(vivado.VivadoHLSExtractStage())
-
-    # Vcdump
-    registry.register(vcdump.VcdumpStage())
+    vivado = "fud.stages.vivado.stage"
+    register(
+        f"{vivado}:VivadoStage",
+        "synth-verilog",
+        "synth-verilog",
+        "synth-files",
+        "Produces synthesis files from a Verilog program",
+    )
+    register(
+        f"{vivado}:VivadoExtractStage",
+        "synth-files",
+        "synth-files",
+        "resource-estimate",
+        "Extracts information from Vivado synthesis files",
+    )
+    register(
+        f"{vivado}:VivadoHLSStage",
+        "vivado-hls",
+        "vivado-hls",
+        "hls-files",
+        "Produces synthesis files from a Vivado C++ program",
+    )
+    register(
+        f"{vivado}:VivadoHLSExtractStage",
+        "hls-files",
+        "hls-files",
+        "hls-estimate",
+        "Extracts information from Vivado HLS synthesis files",
+    )
+
+    # VCD reader
+    register(
+        "fud.stages.vcdump:VcdumpStage",
+        "vcd",
+        "vcd",
+        "vcd_json",
+        "Transform VCD file to JSON",
+    )
 
     # Jq
-    registry.register(jq.JqStage("vcd_json"))
-    registry.register(jq.JqStage("dat"))
-    registry.register(jq.JqStage("interpreter-out"))
+    for src in ["vcd_json", "dat", "interpreter-out"]:
+        register(
+            "fud.stages.jq:JqStage", "jq", src, "jq", "Run `jq` on a JSON file", src
+        )
 
     # Xilinx
-    registry.register(xilinx.XilinxStage())
-    registry.register(xilinx.HwExecutionStage())
+    register(
+        "fud.stages.xilinx.xclbin:XilinxStage",
+        "xclbin",
+        "calyx",
+        "xclbin",
+        "compiles Calyx programs to Xilinx bitstreams",
+    )
+    register(
+        "fud.stages.xilinx.execution:HwExecutionStage",
+        "fpga",
+        "xclbin",
+        "fpga",
+        "Run an xclbin on an fpga, or emulate hardware execution",
+    )
 
     # Interpreter
-    registry.register(interpreter.InterpreterStage("", "", "Run the interpreter"))
-    registry.register(interpreter.InterpreterStage.debugger("", "", "Run the debugger"))
-    registry.register(interpreter.InterpreterStage.data_converter())
+    interpreter = "fud.stages.interpreter:InterpreterStage"
+    register(
+        interpreter,
+        "interpreter",
+        "interpreter",
+        "interpreter-out",
+        "Run the interpreter",
+        "",
+        "",
+        "Run the interpreter",
+    )
+    register(
+        f"{interpreter}.debugger",
+        "interpreter",
+        "interpreter",
+        "debugger",
+        "Run the debugger",
+        "",
+        "",
+        "Run the debugger",
+    )
+    register(
+        f"{interpreter}.data_converter",
+        "interpreter",
+        "interpreter",
+        "interpreter-data",
+        "convert data files for the interpreter use. "
+        "Meant for internal interp dev use.",
+    )
 
 
 def register_external_stages(cfg, registry):
@@ -167,25 +269,9 @@ def register_external_stages(cfg, registry):
     if not ["externals"] in cfg:
         return
 
-    for ext, location in cfg[["externals"]].items():
-        mod = external.validate_external_stage(ext, cfg)
-
-        # register the discovered stages
-        for stage_class in mod.__STAGES__:
-            try:
-                registry.register(stage_class())
-            except Exception as e:
-                raise errors.InvalidExternalStage(
-                    ext,
-                    "\n".join(
-                        [
-                            f"In {stage_class.name} from '{location}':",
-                            "```",
-                            str(e),
-                            "```",
-                        ]
-                    ),
-                ) from e
+    for ext in cfg[["externals"]].keys():
+        for stage in external.external_stages(ext, cfg):
+            registry.register(stage)
 
 
 def display_or_edit_config(args, cfg):
@@ -236,9 +322,59 @@ def display_or_edit_config(args, cfg):
     cfg.commit()
 
 
-def main():
-    """Builds the command line argument parser,
-    parses the arguments, and returns the results."""
+def display_or_clear_cache(args, cfg):
+    """Print statistics about the result cache or empty it"""
+    cache = ResultCache.from_config(cfg)
+    builds = BuildCache.from_config(cfg)
+    object_dirs = BuildCache.from_config(cfg, OBJECT_DIRS)
+    objects = ResultCache(cache.location / COMPILED_OBJECTS, cache.max_size)
+    if args.action == "clear":
+        log.info(f"Removing cache entries in {cache.location}")
+        cache.clear()
+        builds.clear()
+        object_dirs.clear()
+        objects.clear()
+        return
+
+    stats = cache.stats()
+    enabled = "enabled" if cfg.get(["cache", "enabled"]) else "disabled"
+    print(f"Cache location: {stats['location']} ({enabled})")
+    print(f"Entries: {stats['entries']}")
+    print(
+        f"Size: {stats['size'] / (1 << 20):.2f} MiB"
+        f" (max: {stats['max_size'] / (1 << 20):.2f} MiB)"
+    )
+    print(f"Hits: {stats['hits']}, misses: {stats['misses']}")
+    build_stats = builds.stats()
+    print(
+        f"Builds: {build_stats['builds']} (max: {build_stats['max_builds']}),"
+        f" {build_stats['size'] / (1 << 20):.2f} MiB"
+    )
+    dir_stats, object_stats = object_dirs.stats(), objects.stats()
+    print(
+        f"Object directories: {dir_stats['builds']}, compiled objects:"
+        f" {object_stats['entries']}, {object_stats['size'] / (1 << 20):.2f} MiB"
+        f" (hits: {object_stats['hits']}, misses: {object_stats['misses']})"
+    )
+
+
+def build_registry(cfg):
+    """Register all stages in a new registry for `cfg`."""
+    cfg.registry = Registry(cfg)
+    register_stages(cfg.registry)
+    register_external_stages(cfg, cfg.registry)
+
+
+def load_configuration() -> Configuration:
+    """Load the configuration and register all stages."""
+    cfg = Configuration()
+    build_registry(cfg)
+    return cfg
+
+
+def build_parser():
+    """Builds the command line argument parser. Returns the parser and the
+    parser of the `exec` subcommand."""
 
     parser = argparse.ArgumentParser(
         description="Driver to execute Calyx and supporting toolchains"
@@ -284,8 +420,55 @@ def main():
             description="Register external stages.",
         )
     )
+    config_exec_many(
+        subparsers.add_parser(
+            "exec-many",
+            help="Execute the same path for many inputs",
+            description="Execute the same path for many inputs and data files"
+            + " on a pool of processes.",
+        )
+    )
+    config_cache(
+        subparsers.add_parser(
+            "cache",
+            help="Inspect or clear the result cache.",
+            description="Inspect or clear the result cache.",
+        )
+    )
+    config_server(
+        subparsers.add_parser(
+            "server",
+            help="Execute commands sent by fud clients.",
+            description="Keep the configuration and stages loaded and execute"
+            + " the `exec' commands of fud processes started with FUD_SERVER set"
+            + " to the socket of the server.",
+        )
+    )
+
+    return parser, run_parser
+
+
+def main():
+    """Builds the command line argument parser,
+    parses the arguments, and returns the results."""
+    # Forward the command to the fud server if one is set in FUD_SERVER.
+    if os.environ.get("FUD_SERVER"):
+        from .client import run_on_server
+
+        status = run_on_server(sys.argv[1:])
+        if status is not None:
+            exit(status)
+    execute(sys.argv[1:])
+
 
-    args = parser.parse_args()
+def execute(argv: List[str], cfg: Optional[Configuration] = None):
+    """
+    Execute the command line `argv`. `fud server` provides a configuration
+    `cfg` with a registry that is already built.
+    """
+    parser, run_parser = build_parser()
+
+    args = parser.parse_args(argv)
     # Setup logging
     utils.logging_setup(args)
 
@@ -294,7 +477,8 @@ def main():
         exit(-1)
 
     try:
-        cfg = Configuration()
+        if cfg is None:
+            cfg = Configuration()
 
         # Only allow either config_file or dynamic configurations
         if ("stage_dynamic_config" in args and args.stage_dynamic_config) and (
@@ -324,10 +508,13 @@ def main():
             cfg.update_all({"stages": override})
 
         # Build the registry if stage information is going to be used.
-        if args.command in ("exec", "info"):
-            cfg.registry = Registry(cfg)
-            register_stages(cfg.registry)
-            register_external_stages(cfg, cfg.registry)
+        if args.command in ("exec", "exec-many", "info") and cfg.registry is None:
+            build_registry(cfg)
+
+        # Reuse outputs of earlier executions if the cache is enabled.
+        if args.command in ("exec", "exec-many") and cfg.get(["cache", "enabled"]):
+            if not args.no_cache:
+                cfg.cache = ResultCache.from_config(cfg)
 
         if args.command == "exec":
             if not (args.input_file or args.source):
@@ -340,6 +527,12 @@ def main():
                 )
 
             exec.run_fud_from_args(args, cfg)
+        elif args.command == "exec-many":
+            if not args.dest:
+                parser.error("Please provide a --to option")
+            from . import batch
+
+            batch.run_batch(args, cfg)
         elif args.command == "info":
             print(cfg.registry)
         elif args.command == "config":
@@ -351,9 +544,18 @@ def main():
             else:
                 display_or_edit_config(args, cfg)
         elif args.command == "check":
+            from . import check
+
             check.check(args, cfg)
         elif args.command == "register":
             cfg.setup_external_stage(args)
+        elif args.command == "cache":
+            display_or_clear_cache(args, cfg)
+        elif args.command == "server":
+            from . import server
+
+            socket = args.socket or server.default_socket(cfg)
+            server.serve(socket, load_configuration, execute)
 
     except errors.FudError as e:
         log.error(e)
@@ -377,6 +579,27 @@ def config_run(parser):
         help="Whether data should be printed in CSV format. "
         + "This is currently only supported for profiling.",
     )
+    parser.add_argument(
+        "--trace",
+        dest="trace_file",
+        metavar="FILE",
+        help="Write a Chrome trace of the stages, steps, and tools of this run"
+        + " to FILE",
+    )
+    parser.add_argument(
+        "--profile-json",
+        dest="profile_file",
+        metavar="FILE",
+        help="Write the durations and resource usage of the stages, steps,"
+        + " and tools of this run to FILE",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        dest="profile_memory",
+        help="Also profile the peak memory and the bytes read and written by"
+        + " every step",
+    )
     parser.add_argument("--from", dest="source", help="Name of the start stage")
     parser.add_argument("--to", dest="dest", help="Name of the final stage")
     parser.add_argument(
@@ -414,6 +637,25 @@ def config_run(parser):
         dest="dry_run",
         help="Show the execution stages and exit",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        dest="no_cache",
+        help="Do not use the result cache for this run",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of independent steps to execute in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--async",
+        action="store_true",
+        dest="use_async",
+        help="Execute the steps with the asyncio engine",
+    )
     parser.add_argument(
         "-v", "--verbose", action="count", default=0, help="Enable verbose logging"
     )
@@ -424,6 +666,85 @@ def config_run(parser):
     return parser
 
 
+def config_exec_many(parser):
+    parser.add_argument(
+        "--manifest",
+        help="JSON file with a list of jobs. Each job is an object with an"
+        + " `input' and optional `data', `name', and `config' keys.",
+    )
+    parser.add_argument(
+        "--with-data",
+        dest="data_suffix",
+        metavar="SUFFIX",
+        help="Pair every input file with the data file <input>SUFFIX",
+    )
+    parser.add_argument(
+        "--data-key",
+        default="verilog.data",
+        help="Stage configuration key set to the data file of a job"
+        + " (default: verilog.data)",
+    )
+    parser.add_argument("--from", dest="source", help="Name of the start stage")
+    parser.add_argument("--to", dest="dest", help="Name of the final stage")
+    parser.add_argument(
+        "--through",
+        action="append",
+        metavar="stage",
+        default=[],
+        help="Names of intermediate stages (repeatable option)",
+    )
+    parser.add_argument(
+        "-o",
+        dest="out_dir",
+        default="fud-out",
+        help="Directory for the outputs and summary of the jobs"
+        + " (default: fud-out)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of jobs to execute in parallel (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--step-jobs",
+        type=int,
+        default=1,
+        help="Number of steps to execute in parallel within a job (default: 1)",
+    )
+    parser.add_argument(
+        "-s",
+        "--stage-val",
+        help="Override stage configuration key-value pairs for all jobs",
+        nargs=2,
+        metavar=("key", "value"),
+        dest="stage_dynamic_config",
+        action="append",
+    )
+    parser.add_argument(
+        "--stage-config",
+        help="Path to a TOML file with stage configuration options",
+        dest="config_file",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        dest="no_cache",
+        help="Do not use the result cache for these jobs",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Enable verbose logging"
+    )
+    parser.add_argument("-q", "--quiet", action="store_true")
+    parser.add_argument(
+        "inputs", help="Input files or glob patterns", nargs="*", default=[]
+    )
+    parser.set_defaults(command="exec-many")
+
+    return parser
+
+
 def config_config(parser):
     parser.add_argument(
         "-e",
@@ -474,3 +795,26 @@ def config_register(parser):
         action="store_true",
     )
     parser.set_defaults(command="register")
+
+
+def config_cache(parser):
+    parser.add_argument(
+        "action",
+        help="Show statistics about the cache or remove all of its entries.",
+        choices=["stats", "clear"],
+        nargs="?",
+        default="stats",
+    )
+    parser.set_defaults(command="cache")
+
+
+def config_server(parser):
+    parser.add_argument(
+        "--socket",
+        help="Path of the Unix socket to listen on"
+        + " (default: server.sock in the cache directory)",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Enable verbose logging"
+    )
+    parser.set_defaults(command="server")
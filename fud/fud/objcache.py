@@ -0,0 +1,160 @@
+"""
+A compiler cache for the C++ files generated by Verilator, in the spirit of
+ccache. Verilator's makefiles put the `OBJCACHE` command in front of every
+invocation of the C++ compiler; the `verilog` stage sets it to:
+
+    python -m fud.objcache <cache> <max size> <compiler> ...
+
+Compilations of a single C++ file into an object are keyed by the
+preprocessed file, the compiler, its arguments, and the working directory.
+Unchanged files reuse the object (and dependency file) of an earlier build.
+Every other command, like linking, runs unchanged.
+"""
+
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from .cache import ResultCache, tool_fingerprint
+
+# Directories in the cache for the objects and the persistent directories
+# they are built in.
+COMPILED_OBJECTS = "compiled-objects"
+OBJECT_DIRS = "objects"
+
+# Written to the working directory with a line for every object, reused or
+# compiled, so that the stage can report them.
+LOG_FILE = "fud-objcache.log"
+
+SOURCE_SUFFIXES = (".c", ".cc", ".cpp", ".cxx")
+
+# Flags for the dependency files that don't apply when preprocessing, and
+# whether they take an argument.
+DEPENDENCY_FLAGS = {
+    "-MD": False,
+    "-MMD": False,
+    "-MP": False,
+    "-MF": True,
+    "-MT": True,
+    "-MQ": True,
+}
+
+
+def _compilation(args: List[str]) -> Optional[Tuple[Path, Path, Optional[Path]]]:
+    """
+    The source, object, and dependency file of `args` if they compile a
+    single C++ file into an object, or None.
+    """
+    if "-c" not in args or "-o" not in args[:-1]:
+        return None
+    sources = [arg for arg in args[1:] if arg.endswith(SOURCE_SUFFIXES)]
+    if len(sources) != 1:
+        return None
+    output = Path(args[args.index("-o") + 1])
+    deps = None
+    if "-MF" in args[:-1]:
+        deps = Path(args[args.index("-MF") + 1])
+    elif "-MD" in args or "-MMD" in args:
+        deps = output.with_suffix(".d")
+    return Path(sources[0]), output, deps
+
+
+def _preprocess(args: List[str], source: Path) -> Optional[bytes]:
+    """The preprocessed `source`, or None if preprocessing fails."""
+    cmd = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg == "-o":
+            skip = True
+        elif arg in DEPENDENCY_FLAGS:
+            skip = DEPENDENCY_FLAGS[arg]
+        elif arg not in ("-c", str(source)):
+            cmd.append(arg)
+    proc = subprocess.run(
+        cmd + ["-E", str(source)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    return proc.stdout if proc.returncode == 0 else None
+
+
+def _write(path: Path, data: bytes):
+    """Atomically replace the file at `path` with `data`."""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _log(outcome: str, output: Path):
+    with open(LOG_FILE, "a") as f:
+        f.write(f"{outcome} {output}\n")
+
+
+def run(cache: ResultCache, args: List[str]) -> int:
+    """
+    Run the compiler command `args`, reusing the outputs of an identical
+    compilation from `cache`. Returns the exit code of the compiler.
+    """
+    files = _compilation(args)
+    preprocessed = None if files is None else _preprocess(args, files[0])
+    if files is None or preprocessed is None:
+        return subprocess.run(args).returncode
+    _, output, deps = files
+
+    material = {
+        "compiler": tool_fingerprint(args[0]),
+        "args": args,
+        "cwd": os.getcwd(),
+    }
+    h = hashlib.sha256(json.dumps(material, sort_keys=True).encode("UTF-8"))
+    h.update(hashlib.sha256(preprocessed).digest())
+    key = h.hexdigest()
+
+    # Entries hold the size of the dependency file, the dependency file, and
+    # the object.
+    entry = cache.get(key)
+    if entry is not None:
+        data = entry.read_bytes()
+        split = 8 + int.from_bytes(data[:8], "little")
+        if deps is not None:
+            _write(deps, data[8:split])
+        _write(output, data[split:])
+        _log("reused", output)
+        return 0
+
+    returncode = subprocess.run(args).returncode
+    if returncode == 0:
+        deps_data = deps.read_bytes() if deps is not None and deps.exists() else b""
+        cache.put(
+            key, len(deps_data).to_bytes(8, "little") + deps_data + output.read_bytes()
+        )
+        _log("compiled", output)
+    return returncode
+
+
+def read_log(build_dir) -> Tuple[int, int]:
+    """
+    The number of objects reused and compiled in `build_dir` since the log
+    was last read.
+    """
+    path = Path(build_dir) / LOG_FILE
+    if not path.exists():
+        return 0, 0
+    outcomes = [line.split()[0] for line in path.read_text().splitlines() if line]
+    path.unlink()
+    return outcomes.count("reused"), outcomes.count("compiled")
+
+
+def main():
+    location, max_size, *args = sys.argv[1:]
+    sys.exit(run(ResultCache(location, int(max_size)), args))
+
+
+if __name__ == "__main__":
+    main()
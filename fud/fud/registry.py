@@ -1,9 +1,15 @@
-from typing import List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
+import hashlib
+import json
+import logging as log
+import math
+import os
 from collections import namedtuple
-import networkx as nx  # type: ignore
+from importlib import import_module
 
-from fud import stages, errors
+from fud import __version__, stages, errors
+from fud.cache import cache_location
 from fud.errors import UndefinedState, MultiplePaths
 
 # An edge in the state graph
@@ -11,6 +17,65 @@ Edge = namedtuple("Edge", ["dest", "stage"])
 DEPRECATED_STATES = [("futil", "calyx")]
 
 
+def factory(path: str, *args: Any) -> Callable[[], stages.Stage]:
+    """
+    Returns a function that imports the callable at `path`, written as
+    `module:attribute`, and calls it with `args` to construct a stage.
+    For example, `factory("fud.stages.jq:JqStage", "dat")`.
+    """
+
+    def construct():
+        module, attr = path.split(":")
+        obj = import_module(module)
+        for name in attr.split("."):
+            obj = getattr(obj, name)
+        return obj(*args)
+
+    construct.module = path.split(":")[0]
+    return construct
+
+
+class LazyStage:
+    """
+    A stage registered with only its name, states, and description.
+    Constructing a stage imports its module, along with dependencies such as
+    numpy, so it is only done by `load` once the stage is used in a path.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        src_state: str,
+        target_state: str,
+        description: str,
+        load: Callable[[], stages.Stage],
+    ):
+        self.name = name
+        self.src_state = src_state
+        self.target_state = target_state
+        self.description = description
+        self._load = load
+        self._stage = None
+
+    def preload(self):
+        """Import the module of the stage without constructing it."""
+        module = getattr(self._load, "module", None)
+        if module is not None:
+            import_module(module)
+
+    def load(self) -> stages.Stage:
+        """Construct the stage, at most once."""
+        if self._stage is None:
+            stage = self._load()
+            expected = (self.name, self.src_state, self.target_state)
+            actual = (stage.name, stage.src_state, stage.target_state)
+            assert (
+                expected == actual
+            ), f"Stage registered as {expected} was constructed as {actual}"
+            self._stage = stage
+        return self._stage
+
+
 class Registry:
     """
     Defines all the stages and how they transform files from one stage to
@@ -19,16 +84,27 @@ class Registry:
 
     def __init__(self, config):
         self.config = config
-        self.graph = nx.DiGraph()
+        # Edges of the state graph, in the order the stages were registered.
+        # There is at most one stage between a pair of states.
+        self.graph: Dict[str, Dict[str, Any]] = {}
+        # Minimum costs between all pairs of states, keyed by the edge
+        # weights they were computed with.
+        self._distances: Optional[Tuple[Any, Dict[str, Dict[str, float]]]] = None
+
+    def edges(self):
+        """The (source, destination, stage) triples of the state graph."""
+        return [
+            (src, dst, stage)
+            for src, out in self.graph.items()
+            for dst, stage in out.items()
+        ]
 
     def get_states(self, stage: str) -> List[Tuple[str, str]]:
         """
         Returns the pairs of input and output states that the given stage
         operates upon.
         """
-        out = [
-            (s, e) for (s, e, st) in self.graph.edges(data="stage") if st.name == stage
-        ]
+        out = [(s, e) for (s, e, st) in self.edges() if st.name == stage]
         assert len(out) > 0, f"No state tranformation for {stage} found."
         return out
 
@@ -41,24 +117,62 @@ class Registry:
     def register(self, stage):
         """
         Defines a new stage named `stage` that converts programs from `src` to
-        `tar`
+        `tar`. `stage` may be a `LazyStage`, which is only constructed when
+        it is part of a path returned by `make_path`.
         """
 
         # Error if the stage is attempting to register deprecated states.
         Registry._deprecate_check(stage.name, stage.src_state)
         Registry._deprecate_check(stage.name, stage.target_state)
 
-        self.graph.add_edge(stage.src_state, stage.target_state, stage=stage)
+        self.graph.setdefault(stage.src_state, {})[stage.target_state] = stage
+        self.graph.setdefault(stage.target_state, {})
+        self._distances = None
+
+    def priority(self, stage) -> Optional[int]:
+        """The cost of using `stage` configured with `stages.<name>.priority`."""
+        cost = self.config.get(("stages", stage.name, "priority"))
+        return None if cost is None else int(cost)
+
+    def distances(self, weights) -> Dict[str, Dict[str, float]]:
+        """
+        Minimum cost of going from one state to another when the edges have
+        the given weights. Unreachable states have an infinite cost.
+        """
+        if self._distances is not None and self._distances[0] == weights:
+            return self._distances[1]
+
+        dist = {u: {v: math.inf for v in self.graph} for u in self.graph}
+        for u in self.graph:
+            dist[u][u] = 0
+        for (u, v, _), w in zip(self.edges(), weights):
+            dist[u][v] = min(dist[u][v], w)
+        # Floyd-Warshall
+        for k in self.graph:
+            dist_k = dist[k]
+            for u in self.graph:
+                dist_uk = dist[u][k]
+                if dist_uk == math.inf:
+                    continue
+                dist_u = dist[u]
+                for v, d in dist_k.items():
+                    if dist_uk + d < dist_u[v]:
+                        dist_u[v] = dist_uk + d
+
+        self._distances = (weights, dist)
+        return dist
 
     def make_path(self, start: str, dest: str, through=[]) -> List[stages.Stage]:
         """
         Compute a path from `start` to `dest` that contains all stages
         mentioned in `through`.
-        Raises MultiplePaths if there is more than one matching path for the
+        If some of the matching paths use stages with a priority, the path
+        with the smallest total priority is selected.
+        Raises MultiplePaths if there is more than one such path for the
         (start, dest) pair.
         """
 
-        nodes = self.graph.nodes()
+        nodes = self.graph
         if start not in nodes:
             raise UndefinedState(start, "Validate source state of the path")
 
@@ -69,51 +183,149 @@ class Registry:
             if node not in nodes:
                 raise UndefinedState(node, "Stage provided using --through")
 
-        all_paths = list(nx.all_simple_edge_paths(self.graph, start, dest))
+        # Paths are only stored when the result cache is enabled.
+        plan_file = None
+        if self.config.cache is not None:
+            costs = [self.priority(stage) for (_, _, stage) in self.edges()]
+            plan_file = self._plan_file(start, dest, through, costs)
+        path = self._load_plan(plan_file) if plan_file else None
+        if path is None:
+            path = self._plan(start, dest, through)
+            if plan_file:
+                self._store_plan(plan_file, path)
 
-        # Compute all stage pipelines that can be run.
-        stage_paths = []
+        return [
+            stage.load() if isinstance(stage, LazyStage) else stage for stage in path
+        ]
 
-        # Minimum cost path
-        min_cost = None
-        for path in all_paths:
-            through_check = set(through)
-            stage_path = []
-            # Cost of the Path
-            path_cost = None
-            for src, dst in path:
-                if src in through_check:
-                    through_check.remove(src)
-                stage = self.graph.get_edge_data(src, dst)["stage"]
-                stage_path.append(stage)
-                # Get the cost of the path if there is any
-                #  print(self.config.get(("stages", stage.name, "priority")))
-                cost = self.config.get(("stages", stage.name, "priority"))
-                if cost is not None:
-                    if path_cost is None:
-                        path_cost = cost
-                    else:
-                        path_cost += cost
-
-            # If there are no items left in the --through check then add it
-            if len(through_check) == 0:
-                # If this path has a cost, then stage_paths can only have
-                # one path in it.
-                if path_cost is not None:
-                    if min_cost is None or path_cost < min_cost:
-                        stage_paths = [stage_path]
-                    elif min_cost == path_cost:
-                        stage_paths.append(stage_path)
-                    min_cost = path_cost
-                elif min_cost is None:
-                    stage_paths.append(stage_path)
+    def _plan(self, start: str, dest: str, through) -> List[Any]:
+        """
+        Search for the best path from `start` to `dest` that goes through the
+        states in `through`.
+
+        Paths are built with a depth-first search that is pruned using the
+        minimum costs between all pairs of states: a partial path is
+        abandoned when it can no longer reach `dest` or one of the remaining
+        `through` states, or when it can only be completed with a cost larger
+        than the best path found so far. Since two paths with the same cost
+        already make the choice ambiguous, the search stops looking for
+        paths that can at best tie once it found two of them.
+        """
+        if start == dest:
+            if through:
+                raise errors.NoPathFound(start, dest, through)
+            return []
+
+        costs = {(src, dst): self.priority(stage) for (src, dst, stage) in self.edges()}
+        # Costs only bound the search when they can't decrease.
+        bounded = all(c is None or c >= 0 for c in costs.values())
+        weights = tuple((c or 0) if bounded else 0 for c in costs.values())
+        dist = self.distances(weights)
+        # States from which a stage with a priority can be reached.
+        priced = {
+            node: any(
+                c is not None and dist[node][src] < math.inf
+                for (src, _), c in costs.items()
+            )
+            for node in self.graph
+        }
+
+        # Best cost of a path with stages that have a priority and the paths
+        # with that cost.
+        best: Optional[int] = None
+        best_paths: List[List[Tuple[str, str]]] = []
+        # Paths without any stages that have a priority.
+        free_paths: List[List[Tuple[str, str]]] = []
+
+        def search(
+            node: str,
+            path: List[Tuple[str, str]],
+            visited: Set[str],
+            cost: Optional[int],
+        ):
+            nonlocal best, best_paths
+            if node == dest:
+                if not set(through) <= visited:
+                    return
+                if cost is None:
+                    if len(free_paths) < 2:
+                        free_paths.append(list(path))
+                elif best is None or cost < best:
+                    best, best_paths = cost, [list(path)]
+                elif cost == best and len(best_paths) < 2:
+                    best_paths.append(list(path))
+                return
 
+            remaining = set(through) - visited - {node}
+            if dist[node][dest] == math.inf or any(
+                dist[node][t] == math.inf for t in remaining
+            ):
+                return
+            if best is not None and bounded:
+                bound = (cost or 0) + dist[node][dest]
+                if bound > best or (bound == best and len(best_paths) > 1):
+                    return
+            # Paths without a priority only matter when no path has one.
+            if cost is None and len(free_paths) > 1 and not priced[node]:
+                return
+
+            visited.add(node)
+            for nxt in self.graph[node]:
+                if nxt in visited:
+                    continue
+                edge_cost = costs[(node, nxt)]
+                if edge_cost is not None:
+                    edge_cost += cost or 0
+                path.append((node, nxt))
+                search(nxt, path, visited, cost if edge_cost is None else edge_cost)
+                path.pop()
+            visited.remove(node)
+
+        search(start, [], set(), None)
+
+        stage_paths = best_paths if best is not None else free_paths
         if len(stage_paths) > 1:
-            raise MultiplePaths(start, dest, self.paths_str(all_paths))
+            raise MultiplePaths(start, dest, self.paths_str(stage_paths))
         elif len(stage_paths) == 0:
             raise errors.NoPathFound(start, dest, through)
         else:
-            return stage_paths[0]
+            return [self.graph[src][dst] for (src, dst) in stage_paths[0]]
+
+    def _plan_file(self, start: str, dest: str, through, costs) -> str:
+        """
+        File that stores the path computed for the given arguments. The key
+        covers the state graph and the priorities of its stages.
+        """
+        material = json.dumps(
+            {
+                "fud": __version__,
+                "edges": [(s, d, st.name) for (s, d, st) in self.edges()],
+                "costs": costs,
+                "start": start,
+                "dest": dest,
+                "through": list(through),
+            }
+        )
+        key = hashlib.sha256(material.encode("UTF-8")).hexdigest()
+        return str(cache_location(self.config) / "plans" / f"{key}.json")
+
+    def _load_plan(self, plan_file: str) -> Optional[List[Any]]:
+        """The path stored in `plan_file`, if any."""
+        try:
+            with open(plan_file) as f:
+                return [self.graph[src][dst] for (src, dst) in json.load(f)]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _store_plan(self, plan_file: str, path: List[Any]):
+        try:
+            os.makedirs(os.path.dirname(plan_file), exist_ok=True)
+            tmp = f"{plan_file}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump([(st.src_state, st.target_state) for st in path], f)
+            os.replace(tmp, plan_file)
+        except OSError as e:
+            log.debug(f"Cannot store the path in {plan_file}: {e}")
 
     def paths_str(self, paths):
         """
@@ -125,9 +337,9 @@ class Registry:
                 continue
             # Add the starting src
             path_str = path[0][0]
-            for _, dst in path:
+            for src, dst in path:
                 path_str += f" → {dst}"
-                cost = self.config.get(("stages", dst, "priority"))
+                cost = self.priority(self.graph[src][dst])
                 if cost is not None:
                     path_str += f" (cost: {cost})"
             p.append(path_str)
@@ -142,8 +354,8 @@ class Registry:
         stages = {}
         transforms = []
 
-        for src, dst, attr in sorted(self.graph.edges(data=True)):
-            transforms.append((src, dst, attr["stage"].name, attr["stage"].description))
+        for src, dst, stage in sorted(self.edges(), key=lambda e: e[:2]):
+            transforms.append((src, dst, stage.name, stage.description))
             if src not in stages:
                 stages[src] = []
             stages[src].append(dst)
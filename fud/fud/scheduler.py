@@ -0,0 +1,187 @@
+from typing import List, Set
+
+import logging as log
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import utils
+from .stages import ComputationGraph, Source, SourceType, Step
+
+# Sources that steps modify or consume in place. Steps that use the same
+# mutable source execute in the order they were defined.
+MUTABLE_SOURCES = [SourceType.Directory, SourceType.UnTyped, SourceType.Stream]
+
+
+def _is_barrier(step: Step) -> bool:
+    """
+    Steps that must not overlap with any other step: explicit barriers,
+    steps that hand control to the user, and steps with neither inputs nor
+    outputs which only exist for side effects we know nothing about.
+    """
+    if step.barrier or step.output.typ == SourceType.Terminal:
+        return True
+    return not step.inputs and not isinstance(step.output.typ, SourceType)
+
+
+def dependencies(steps: List[Step]) -> List[Set[int]]:
+    """
+    Compute the indices of the steps that each step depends upon. A step
+    depends on:
+    1. The steps that produce its inputs.
+    2. The previous step that used any mutable source it uses.
+    3. The closest barrier step before it. Barriers depend on all steps
+       before them.
+    """
+    producer = {}
+    last_user = {}
+    last_barrier = None
+    deps: List[Set[int]] = []
+
+    for idx, step in enumerate(steps):
+        if _is_barrier(step):
+            dep = set(range(idx))
+        else:
+            dep = set()
+            if last_barrier is not None:
+                dep.add(last_barrier)
+            for inp in step.inputs:
+                if id(inp) in producer:
+                    dep.add(producer[id(inp)])
+                if inp.typ in MUTABLE_SOURCES and id(inp) in last_user:
+                    dep.add(last_user[id(inp)])
+
+        for inp in step.inputs:
+            if inp.typ in MUTABLE_SOURCES:
+                last_user[id(inp)] = idx
+        producer[id(step.output)] = idx
+        if _is_barrier(step):
+            last_barrier = idx
+        deps.append(dep)
+
+    return deps
+
+
+def _run_step(step: Step, exec):
+    if step.output.typ == SourceType.Terminal:
+        exec.disable_spinner()
+    # Execute step within the stage
+    with exec.context(step.name):
+        step()
+
+
+def run(staged: ComputationGraph, input: Source, exec, jobs: int = 1):
+    """
+    Execute the steps of `staged` using the executor `exec`. When `jobs` is
+    larger than one, steps that don't depend on each other execute
+    concurrently on up to `jobs` threads. Otherwise, the steps execute in the
+    order they were defined.
+    """
+    if jobs <= 1:
+        for step in staged.get_steps(input):
+            _run_step(step, exec)
+        return
+
+    staged.set_input(input)
+    steps = staged.steps
+    deps = dependencies(steps)
+
+    pending = list(range(len(steps)))
+    done: Set[int] = set()
+    running = {}
+    failures = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            # Start ready steps in the order they were defined. Once a step
+            # fails, don't start any new ones.
+            for idx in list(pending):
+                if failures or len(running) >= jobs:
+                    break
+                if not deps[idx] <= done:
+                    continue
+                pending.remove(idx)
+                if steps[idx].skipped:
+                    done.add(idx)
+                    continue
+                log.debug(f"Scheduling {steps[idx].name}")
+                running[pool.submit(_run_step, steps[idx], exec)] = idx
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                idx = running.pop(future)
+                if future.exception() is not None:
+                    failures.append((idx, future.exception()))
+                else:
+                    done.add(idx)
+
+    # Report the failure of the earliest step, like a sequential execution.
+    if failures:
+        raise min(failures, key=lambda f: f[0])[1]
+
+
+async def _run_step_async(step: Step, exec):
+    if step.output.typ == SourceType.Terminal:
+        exec.disable_spinner()
+    with exec.context(step.name):
+        await step.run_async()
+
+
+async def run_async(staged: ComputationGraph, input: Source, exec, jobs: int = 1):
+    """
+    Execute the steps of `staged` on the running asyncio event loop. Steps
+    defined with coroutine functions are awaited on the loop and the other
+    steps run on threads; the commands they run with `utils.shell` are
+    executed as asyncio subprocesses. Like `run`, up to `jobs` independent
+    steps execute at the same time.
+    Several computation graphs, each with their own executor, can execute on
+    the same event loop.
+    """
+    import asyncio
+
+    # Copied into the context of every step started below.
+    utils.event_loop.set(asyncio.get_running_loop())
+
+    if jobs <= 1:
+        for step in staged.get_steps(input):
+            await _run_step_async(step, exec)
+        return
+
+    staged.set_input(input)
+    steps = staged.steps
+    deps = dependencies(steps)
+
+    pending = list(range(len(steps)))
+    done: Set[int] = set()
+    running = {}
+    failures = []
+    while pending or running:
+        # Start ready steps in the order they were defined. Once a step
+        # fails, don't start any new ones.
+        for idx in list(pending):
+            if failures or len(running) >= jobs:
+                break
+            if not deps[idx] <= done:
+                continue
+            pending.remove(idx)
+            if steps[idx].skipped:
+                done.add(idx)
+                continue
+            log.debug(f"Scheduling {steps[idx].name}")
+            task = asyncio.create_task(_run_step_async(steps[idx], exec))
+            running[task] = idx
+
+        if not running:
+            break
+
+        finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            idx = running.pop(task)
+            if task.exception() is not None:
+                failures.append((idx, task.exception()))
+            else:
+                done.add(idx)
+
+    # Report the failure of the earliest step, like a sequential execution.
+    if failures:
+        raise min(failures, key=lambda f: f[0])[1]
@@ -0,0 +1,295 @@
+"""
+A persistent fud process that executes the commands of other fud processes.
+
+`fud server` loads the configuration and registers all stages once, imports
+the modules of the built-in stages, and then listens on a Unix socket.
+A `fud exec` started with the environment variable `FUD_SERVER` set to the
+path of the socket forwards its command line to the server instead of
+executing it (see `fud.client`).
+
+For every command, the server forks a child that inherits the loaded
+configuration and modules. The client passes its standard input, output,
+and error to the server along with the request, so the child's outputs,
+including the progress spinner, go directly to the client's terminal.
+Once the child exits, the server sends its exit status to the client.
+
+Messages:
+    client -> server: an 8-byte little-endian length followed by a JSON
+        object with the keys `version`, `argv`, `cwd`, and `env`. The first
+        message carries the client's standard input, output, and error.
+    server -> client: a JSON object terminated by a newline with either the
+        key `status`, the exit status of the command, or `error`, a reason
+        for not executing it.
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import json
+import logging as log
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import traceback
+from pathlib import Path
+
+from . import __version__, errors
+from .cache import cache_location
+from .client import HEADER
+from .registry import LazyStage
+
+
+def default_socket(cfg) -> Path:
+    """The socket used by `fud server` unless `--socket` is given."""
+    return cache_location(cfg) / "server.sock"
+
+
+def _config_version(cfg) -> Tuple:
+    """Modification times of the files the loaded configuration depends on."""
+
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    externals = cfg.get(["externals"]) or {}
+    return (mtime(cfg.config_file),) + tuple(
+        (name, mtime(location)) for name, location in sorted(externals.items())
+    )
+
+
+def _recv_exactly(conn: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the client")
+        data += chunk
+    return data
+
+
+def _peer_uid(conn: socket.socket) -> Optional[int]:
+    """The user id of the process connected to `conn`, if the platform
+    reports it."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = struct.Struct("3i")
+    cred = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size)
+    _, uid, _ = creds.unpack(cred)
+    return uid
+
+
+def _reply(conn: socket.socket, **msg):
+    try:
+        conn.sendall(json.dumps(msg).encode("UTF-8") + b"\n")
+    except OSError:
+        pass
+
+
+def _exit_status(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _preload(cfg):
+    """Import the modules of the registered stages before forking."""
+    for _, _, stage in cfg.registry.edges():
+        if isinstance(stage, LazyStage):
+            try:
+                stage.preload()
+            except Exception as e:
+                log.debug(f"Cannot import the module of stage `{stage.name}': {e}")
+
+
+def _run_child(
+    request: Dict, fds: List[int], cfg, execute: Callable[[List[str], object], None]
+):
+    """Execute the request in a forked child. Never returns."""
+    status = 1
+    try:
+        # Run in a new session so that interrupting the command also
+        # interrupts the tools it started. The session has no controlling
+        # terminal, so reading from the client's terminal never stops the
+        # command with SIGTTIN like it would in a background process group
+        # of the server's terminal.
+        os.setsid()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        try:
+            execute(request["argv"], cfg)
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code & 0xFF
+            else:
+                print(e.code, file=sys.stderr)
+        except KeyboardInterrupt:
+            status = 128 + signal.SIGINT
+        except BaseException:
+            traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def serve(
+    path,
+    load: Callable[[], object],
+    execute: Callable[[List[str], object], None],
+):
+    """
+    Listen on the Unix socket `path` and execute the commands of clients.
+    `load` loads the configuration with its registry, which is reloaded when
+    the configuration file or an external stage changes, and
+    `execute(argv, cfg)` executes a command line.
+    """
+    if not hasattr(socket, "recv_fds"):
+        raise errors.FudError("fud server requires Python 3.9 or later")
+    path = Path(path)
+    if path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(path))
+            raise errors.FudError(f"A fud server is already listening on {path}")
+        except (ConnectionRefusedError, FileNotFoundError):
+            path.unlink()
+        finally:
+            probe.close()
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    cfg = load()
+    version = _config_version(cfg)
+    _preload(cfg)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the user running the server may connect: commands run with the
+    # server's permissions.
+    umask = os.umask(0o177)
+    try:
+        listener.bind(str(path))
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0o600)
+    listener.listen()
+    listener.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ)
+    # Connections of the running commands, keyed by the pid of their child.
+    running: Dict[int, socket.socket] = {}
+    # Connections whose client exited before the command.
+    interrupted: List[socket.socket] = []
+
+    # Remove the socket when the server is terminated.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    print(f"fud server listening on {path}", file=sys.stderr)
+    print(f"Use it with: export FUD_SERVER={path}", file=sys.stderr)
+
+    def accept():
+        nonlocal cfg, version
+        conn, _ = listener.accept()
+        if _peer_uid(conn) not in (None, os.getuid()):
+            log.debug("Dropping a connection from another user")
+            conn.close()
+            return
+        conn.setblocking(True)
+        fds: List[int] = []
+        try:
+            header, fds, _, _ = socket.recv_fds(conn, HEADER.size, 3)
+            if len(header) < HEADER.size:
+                header += _recv_exactly(conn, HEADER.size - len(header))
+            (size,) = HEADER.unpack(header)
+            request = json.loads(_recv_exactly(conn, size))
+        except (OSError, ValueError) as e:
+            log.debug(f"Dropping malformed request: {e}")
+            request = None
+
+        try:
+            if request is None:
+                conn.close()
+                return
+            if request.get("version") != __version__ or len(fds) != 3:
+                _reply(conn, error=f"the server runs fud {__version__}")
+                conn.close()
+                return
+
+            current = _config_version(cfg)
+            if current != version:
+                log.info("Reloading the configuration")
+                try:
+                    cfg, version = load(), current
+                except errors.FudError as e:
+                    _reply(conn, error=f"cannot reload the configuration: {e}")
+                    conn.close()
+                    return
+                _preload(cfg)
+
+            log.info(f"Executing: fud {' '.join(request['argv'])}")
+            pid = os.fork()
+            if pid == 0:
+                sel.close()
+                listener.close()
+                conn.close()
+                _run_child(request, fds, cfg, execute)
+            running[pid] = conn
+            sel.register(conn, selectors.EVENT_READ, pid)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def reap():
+        while running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            conn = running.pop(pid, None)
+            if conn is not None:
+                if conn in interrupted:
+                    interrupted.remove(conn)
+                else:
+                    sel.unregister(conn)
+                _reply(conn, status=_exit_status(status))
+                conn.close()
+
+    try:
+        while True:
+            for key, _ in sel.select(timeout=0.05):
+                if key.fileobj is listener:
+                    accept()
+                else:
+                    # The client only sends data before the command starts,
+                    # so the connection is readable once the client exits.
+                    conn, pid = key.fileobj, key.data
+                    if not conn.recv(1):
+                        log.info(f"The client of {pid} exited, interrupting it")
+                        sel.unregister(conn)
+                        interrupted.append(conn)
+                        try:
+                            os.killpg(pid, signal.SIGINT)
+                        except ProcessLookupError:
+                            pass
+            reap()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sel.close()
+        listener.close()
+        path.unlink(missing_ok=True)
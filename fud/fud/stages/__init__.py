@@ -1,19 +1,44 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, List, Optional, Union, Any, Dict, Callable, Iterable
+from typing import (
+    TYPE_CHECKING,
+    List,
+    Optional,
+    Union,
+    Any,
+    Dict,
+    Callable,
+    Iterable,
+    Tuple,
+)
 
 """The definitions of fud stages."""
 if TYPE_CHECKING:
     from .config import Configuration
 
+import contextvars
 import functools
 import inspect
 import logging as log
 from enum import Enum, auto
 from io import IOBase
 from pathlib import Path
+from tempfile import TemporaryFile
 
+from ..executor import record_conversion
 from ..utils import Conversions as conv
-from ..utils import Directory, is_debug
+from ..utils import Directory, is_debug, named_output
+
+
+async def _to_thread(func, *args):
+    """
+    Run `func` on a thread of the running event loop with the context of the
+    caller, like `asyncio.to_thread` which requires Python 3.9.
+    """
+    import asyncio
+
+    ctx = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(ctx.run, func, *args))
 
 
 class Step:
@@ -23,12 +48,25 @@ class Step:
     """
 
     def __init__(
-        self, name: str, func, args: Iterable[Any], output: Source, description: str
+        self,
+        name: str,
+        func,
+        args: Iterable[Any],
+        output: Source,
+        description: str,
+        inputs: Iterable[Source] = (),
+        barrier: bool = False,
     ):
         self.name = name
         self.func = func
         self.args = args
         self.output = output
+        # The sources this step reads. Used to compute the dependencies
+        # between steps when they are scheduled concurrently.
+        self.inputs = list(inputs)
+        # A barrier step runs after all steps defined before it and before all
+        # steps defined after it.
+        self.barrier = barrier
 
         if description is not None:
             self.description = description
@@ -39,19 +77,62 @@ class Step:
 
         # Whether this Step has been executed or not.
         self.executed = False
+        # Whether this Step no longer needs to execute. For example, when the
+        # output of its stage was found in the result cache.
+        self.skipped = False
 
-    def __call__(self):
-        assert not self.executed, "Attempting to re-execute the same step"
-
+    def _log_args(self):
         if is_debug():
             args = list(self.args)
             arg_str = ", ".join(map(lambda a: str(a), args))
             log.debug(f"{self.name}({arg_str})")
             self.args = args
-        self.output.data = self.func(*self.args)
+
+    def __call__(self):
+        assert not self.executed, "Attempting to re-execute the same step"
+
+        data = self._call_func()
+        # Steps defined with coroutine functions also run without an engine.
+        if inspect.iscoroutine(data):
+            import asyncio
+
+            data = asyncio.run(data)
+        self.output.data = data
+        self.executed = True
+        return self.output
+
+    async def run_async(self):
+        """
+        Execute this step on an asyncio event loop. Steps defined with
+        coroutine functions are awaited on the loop while other steps run on a
+        thread so that they don't block it.
+        """
+        assert not self.executed, "Attempting to re-execute the same step"
+
+        if inspect.iscoroutinefunction(self.func):
+            # Converting the arguments may read whole files.
+            args = await _to_thread(list, self.args)
+            self.args = args
+            self._log_args()
+            token = named_output.set(self.output.sink == SourceType.Path)
+            try:
+                data = await self.func(*args)
+            finally:
+                named_output.reset(token)
+        else:
+            data = await _to_thread(self._call_func)
+        self.output.data = data
         self.executed = True
         return self.output
 
+    def _call_func(self):
+        self._log_args()
+        token = named_output.set(self.output.sink == SourceType.Path)
+        try:
+            return self.func(*self.args)
+        finally:
+            named_output.reset(token)
+
     def __str__(self):
         return f"{self.name}: {self.description}"
 
@@ -94,36 +175,102 @@ class SourceType(Enum):
             return "Terminal"
 
 
-class Source:
-    convert_map: Dict[SourceType, Dict[SourceType, Callable[[Any], Any]]] = {
-        SourceType.Path: {
-            SourceType.Directory: conv.path_to_directory,
-            SourceType.Stream: conv.path_to_stream,
-            SourceType.String: lambda p: conv.bytes_to_string(
-                conv.stream_to_bytes(conv.path_to_stream(p))
-            ),
-            SourceType.Bytes: lambda p: conv.stream_to_bytes(conv.path_to_stream(p)),
-        },
-        SourceType.Stream: {
-            SourceType.Path: conv.stream_to_path,
-            SourceType.String: lambda s: conv.bytes_to_string(conv.stream_to_bytes(s)),
-            SourceType.Bytes: conv.stream_to_bytes,
-        },
-        SourceType.String: {
-            SourceType.Path: lambda s: conv.stream_to_path(
-                conv.bytes_to_stream(conv.string_to_bytes(s))
-            ),
-            SourceType.Stream: lambda s: conv.bytes_to_stream(conv.stream_to_bytes(s)),
-            SourceType.Bytes: conv.string_to_bytes,
-        },
-        SourceType.Directory: {
-            SourceType.String: lambda d: d.name,
-            SourceType.Path: lambda d: Path(d.name),
-        },
-        # Terminal and UnTyped cannot be converted
-        SourceType.Terminal: {},
-        SourceType.UnTyped: {},
+# Types of inputs and outputs of stages that can use the result cache.
+CACHEABLE_INPUTS = [SourceType.Path, SourceType.Stream, SourceType.String]
+CACHEABLE_OUTPUTS = [SourceType.Stream, SourceType.String]
+
+
+# The primitive conversions between types of sources along with their costs.
+# `Source.convert_to` chains the cheapest sequence of primitive conversions.
+# Conversions that read whole files into memory, copy data, or write it to
+# disk cost more than conversions that hand over a path or an open file.
+CONVERSIONS: Dict[SourceType, Dict[SourceType, Tuple[Callable[[Any], Any], int]]] = {
+    SourceType.Path: {
+        SourceType.Directory: (conv.path_to_directory, 0),
+        SourceType.Stream: (conv.path_to_stream, 1),
+        SourceType.Bytes: (conv.path_to_bytes, 2),
+    },
+    SourceType.Stream: {
+        SourceType.Path: (conv.stream_to_path, 3),
+        SourceType.Bytes: (conv.stream_to_bytes, 2),
+    },
+    SourceType.String: {
+        SourceType.Bytes: (conv.string_to_bytes, 2),
+    },
+    SourceType.Bytes: {
+        SourceType.Path: (conv.bytes_to_path, 3),
+        SourceType.Stream: (conv.bytes_to_stream, 1),
+        SourceType.String: (conv.bytes_to_string, 2),
+    },
+    SourceType.Directory: {
+        SourceType.String: (lambda d: d.name, 0),
+        SourceType.Path: (lambda d: Path(d.name), 0),
+    },
+    # Terminal and UnTyped cannot be converted
+    SourceType.Terminal: {},
+    SourceType.UnTyped: {},
+}
+
+
+@functools.lru_cache(maxsize=None)
+def plan_conversion(
+    src: SourceType, dst: SourceType
+) -> Optional[Tuple[Callable[[Any], Any], ...]]:
+    """
+    The cheapest chain of primitive conversions from `src` to `dst`, or None
+    if there is none. Conversions from and to directories are never chained
+    since the contents of a directory are not a file.
+    """
+    if SourceType.Directory in (src, dst):
+        direct = CONVERSIONS[src].get(dst)
+        return (direct[0],) if direct is not None else None
+
+    # Dijkstra's algorithm over the handful of source types.
+    best: Dict[SourceType, Tuple[int, Tuple[Callable[[Any], Any], ...]]] = {
+        src: (0, ())
     }
+    frontier = [(0, src)]
+    while frontier:
+        cost, typ = min(frontier, key=lambda f: f[0])
+        frontier.remove((cost, typ))
+        if typ == dst:
+            return best[typ][1]
+        if cost > best[typ][0]:
+            continue
+        for nxt, (func, weight) in CONVERSIONS[typ].items():
+            if nxt == SourceType.Directory:
+                continue
+            if nxt not in best or cost + weight < best[nxt][0]:
+                best[nxt] = (cost + weight, best[typ][1] + (func,))
+                frontier.append((cost + weight, nxt))
+    return None
+
+
+def _chain(funcs: Tuple[Callable[[Any], Any], ...]) -> Callable[[Any], Any]:
+    def convert(data):
+        for func in funcs:
+            data = func(data)
+        record_conversion(len(funcs))
+        return data
+
+    return convert
+
+
+def _convert_map() -> Dict[SourceType, Dict[SourceType, Callable[[Any], Any]]]:
+    out: Dict[SourceType, Dict[SourceType, Callable[[Any], Any]]] = {}
+    for src in SourceType:
+        out[src] = {}
+        for dst in SourceType:
+            plan = plan_conversion(src, dst) if src != dst else None
+            if plan is not None:
+                out[src][dst] = _chain(plan)
+    return out
+
+
+class Source:
+    # Functions that convert the data of a source to each type it can be
+    # converted to, planned by `plan_conversion`.
+    convert_map = _convert_map()
 
     @staticmethod
     def path(path: Optional[Union[str, Path]] = None) -> Source:
@@ -133,6 +280,9 @@ class Source:
 
     def __init__(self, data: Optional[Any], typ: SourceType):
         self.typ = typ
+        # The type a consumer of this source converts it to, if any. Steps
+        # whose output is converted to a path write it to a named file.
+        self.sink: Optional[SourceType] = None
         # check to make sure data is the right type
         if data is not None:
             if self.typ == SourceType.Path:
@@ -152,6 +302,14 @@ class Source:
             assert data is None, "Terminal Source cannot contain data"
         self.data = data
 
+    def consumed_as(self, typ: SourceType):
+        """
+        Record that a step converts this source to `typ`. Paths take
+        precedence since producing a named file serves every consumer.
+        """
+        if self.sink is None or typ == SourceType.Path:
+            self.sink = typ
+
     def is_convertible_to(self, other: SourceType):
         if self.typ == other:
             return True
@@ -192,6 +350,11 @@ class Stage:
     # The name of a Stage is shared by all instances of the stage.
     name = ""
 
+    # Whether the outputs of this stage are fully determined by its input,
+    # the values returned by `cache_inputs`, and its own attributes. The
+    # outputs of such stages can be reused using the fud result cache.
+    cacheable = False
+
     def __init__(
         self,
         *,  # Force naming of the arguments
@@ -215,6 +378,30 @@ class Stage:
         """
         return None
 
+    def cache_inputs(self, config: Configuration) -> Dict[str, Any]:
+        """
+        Everything other than the input that the outputs of this stage depend
+        upon. Used to compute keys for the result cache.
+        """
+        from ..cache import tool_fingerprint
+
+        return {
+            "stage": config.get(["stages", self.name]),
+            "global": config.get(["global"]),
+            "tool": tool_fingerprint(config.get(["stages", self.name, "exec"])),
+        }
+
+    def cache_dependencies(
+        self, config: Configuration, data: bytes, input_dir: Optional[Path] = None
+    ) -> Dict[str, Any]:
+        """
+        The digests of the files that the input `data` refers to, like the
+        files imported by a program. `input_dir` is the directory of the file
+        given to fud, if any. Used to compute keys for the result cache along
+        with `cache_inputs`.
+        """
+        return {}
+
     def _check_opts(self, config: Configuration):
         """
         Check that the options provided by the user are valid.
@@ -249,7 +436,7 @@ class Stage:
         else:
             builder = ComputationGraph(self.input_type, self.output_type)
             builder.ctx.append(self.name)
-            builder.output = self._define_steps(builder._input, builder, config)
+            builder.output = builder._define_stage_steps(self, builder._input, config)
             builder.ctx.pop()
 
         return builder
@@ -289,6 +476,35 @@ class ComputationGraph:
 
         self.output: Optional[Source] = None
 
+        # Temporary files created by converting sources to paths.
+        self.temporaries: List[Path] = []
+
+        # Directory of the input file, where programs find their imports.
+        self.input_dir: Optional[Path] = None
+
+    def convert(self, source: Source, typ: SourceType) -> Source:
+        """
+        Convert `source` to `typ`. Files created by converting data to a path
+        are removed by `cleanup`.
+        """
+        out = source.convert_to(typ)
+        if typ == SourceType.Path and source.typ in [
+            SourceType.Stream,
+            SourceType.String,
+            SourceType.Bytes,
+        ]:
+            self.temporaries.append(out.data)
+        return out
+
+    def cleanup(self):
+        """
+        Remove the temporary files created while executing this graph. Call
+        once its output is no longer needed.
+        """
+        for path in self.temporaries:
+            path.unlink(missing_ok=True)
+        self.temporaries = []
+
     def dry_run(self):
         """
         Print out step information without running them.
@@ -312,11 +528,91 @@ class ComputationGraph:
             input = self.output
 
         self.ctx.append(stage.name)
-        self.output = stage._define_steps(input, self, config)
+        self.output = self._define_stage_steps(stage, input, config)
         self.ctx.pop()
         self.output_type = stage.output_type
         return self
 
+    def _define_stage_steps(
+        self, stage: Stage, input: Source, config: Configuration
+    ) -> Source:
+        """
+        Define the steps of `stage`. If the result cache is enabled and the
+        stage is cacheable, the steps are bracketed by a lookup in the cache,
+        which skips them when their output is already known, and a step that
+        stores their output for later executions.
+        """
+        cache = getattr(config, "cache", None)
+        if (
+            cache is None
+            or not stage.cacheable
+            or input.typ not in CACHEABLE_INPUTS
+            or stage.output_type not in CACHEABLE_OUTPUTS
+        ):
+            return stage._define_steps(input, self, config)
+
+        prefix = ".".join(self.ctx)
+        # Key and cache entry computed by the lookup.
+        state = {"key": None, "entry": None}
+
+        def cache_lookup(input: Source):
+            if input.typ == SourceType.Stream:
+                # Reading the stream consumes it so replace it with a copy
+                # for the steps of the stage. Use a real file since the
+                # stream may be passed to a subprocess.
+                data = conv.stream_to_bytes(input.data)
+                # Text streams, like the standard input, hold strings.
+                if isinstance(data, str):
+                    data = data.encode("UTF-8")
+                input.data = TemporaryFile()
+                input.data.write(data)
+                input.data.seek(0)
+            else:
+                data = input.convert_to(SourceType.Bytes).data
+            state["key"] = cache.key(stage, config, data, self.input_dir)
+            state["entry"] = cache.get(state["key"])
+            if state["entry"] is not None:
+                log.debug(f"{prefix}: found output in cache")
+                for step in stage_steps:
+                    step.skipped = True
+
+        lookup = Step(
+            f"{prefix}.cache_lookup",
+            cache_lookup,
+            [input],
+            Source(None, SourceType.UnTyped),
+            "look up the output of the stage in the result cache",
+            inputs=[input],
+            # The lookup decides whether the steps of the stage execute.
+            barrier=True,
+        )
+        self.steps.append(lookup)
+
+        start = len(self.steps)
+        output = stage._define_steps(input, self, config)
+        stage_steps = self.steps[start:]
+
+        def cache_store(output: Source) -> Any:
+            if state["entry"] is not None:
+                data = Source.path(state["entry"])
+            else:
+                data = output.convert_to(SourceType.Bytes)
+                cache.put(state["key"], data.data)
+            return data.convert_to(stage.output_type).data
+
+        cached_output = Source(None, stage.output_type)
+        self.steps.append(
+            Step(
+                f"{prefix}.cache_store",
+                cache_store,
+                [output],
+                cached_output,
+                "store the output of the stage in the result cache",
+                inputs=[output],
+            )
+        )
+        return cached_output
+
     def also_do(self, input: Source, stage: Stage, config: Configuration) -> Source:
         """
         Define a branch of the computation graph that may use any input.
@@ -348,14 +644,23 @@ class ComputationGraph:
 
         return out
 
+    def set_input(self, input_data: Source):
+        """
+        Provide the data for the input of this computation graph.
+        """
+        if input_data.typ == SourceType.Path and input_data.data is not None:
+            self.input_dir = Path(input_data.data).resolve().parent
+        self._input.data = input_data.convert_to(self.input_type).data
+
     def get_steps(self, input_data: Source):
         """
         Steps associated with this computation graph
         """
-        self._input.data = input_data.convert_to(self.input_type).data
+        self.set_input(input_data)
 
         for step in self.steps:
-            yield step
+            if not step.skipped:
+                yield step
 
     def convert_source_to(self, input: Source, output_type: SourceType) -> Source:
         """
@@ -363,8 +668,9 @@ class ComputationGraph:
         """
 
         def transform_source(input: Source) -> Any:
-            return input.convert_to(output_type).data
+            return self.convert(input, output_type).data
 
+        input.consumed_as(output_type)
         output = Source(None, output_type)
         convert_step = Step(
             "transform",
@@ -372,6 +678,7 @@ class ComputationGraph:
             [input],
             output,
             f"transform input to {output_type}",
+            inputs=[input],
         )
         self.steps.append(convert_step)
         return output
@@ -429,6 +736,8 @@ class ComputationGraph:
                         raise Exception(
                             f"Type mismatch: can't convert {arg.typ} to {inp}"
                         )
+                    if arg.typ != inp:
+                        arg.consumed_as(inp)
 
                 # Create a source with no data so that we can return a handle
                 # to this.
@@ -440,7 +749,7 @@ class ComputationGraph:
                 # NOTE(rachit): This is a *LAZY* computaion and only occurs when
                 # the step's data has been filled.
                 unwrapped_args = map(
-                    lambda a: a[0].convert_to(a[1]).data, zip(args, input_types)
+                    lambda a: builder.convert(a[0], a[1]).data, zip(args, input_types)
                 )
                 if builder.ctx:
                     name = f"{'.'.join(builder.ctx)}.{function.__name__}"
@@ -454,6 +763,7 @@ class ComputationGraph:
                         unwrapped_args,
                         future_output,
                         description,
+                        inputs=args,
                     )
                 )
                 # return handle to the thing this function will return
@@ -1,9 +1,13 @@
+from pathlib import Path
+
+from fud.cache import import_digests
 from fud.stages import SourceType, Stage
 from fud.utils import shell, unwrap_or
 
 
 class DahliaStage(Stage):
     name = "dahlia"
+    cacheable = True
 
     def __init__(self, dest, flags, descr):
         super().__init__(
@@ -18,6 +22,11 @@ class DahliaStage(Stage):
     def known_opts(self):
         return ["flags", "exec", "file_extensions"]
 
+    def cache_dependencies(self, config, data, input_dir=None):
+        # Imports are found next to the program.
+        dirs = [Path.cwd()]
+        return import_digests(data, [input_dir, *dirs] if input_dir else dirs)
+
     def _define_steps(self, input, builder, config):
         dahlia_exec = config["stages", self.name, "exec"]
         cmd = " ".join(
@@ -31,6 +40,6 @@ class DahliaStage(Stage):
 
         @builder.step(description=cmd)
         def run_dahlia(dahlia_prog: SourceType.Path) -> SourceType.Stream:
-            return shell(cmd.format(prog=str(dahlia_prog)))
+            return shell(cmd.format(prog=str(dahlia_prog)), stream=True)
 
         return run_dahlia(input)
@@ -1,3 +1,6 @@
+from pathlib import Path
+
+from fud.cache import import_digests, library_dirs
 from fud.stages import SourceType, Stage
 from fud import config as cfg
 
@@ -6,6 +9,7 @@ from ..utils import shell, unwrap_or
 
 class CalyxStage(Stage):
     name = "calyx"
+    cacheable = True
 
     def __init__(self, destination, flags, desc):
         self.flags = flags
@@ -24,6 +28,13 @@ class CalyxStage(Stage):
     def known_opts(self):
         return ["flags", "exec", "file_extensions"]
 
+    def cache_dependencies(self, config, data, input_dir=None):
+        # Imports are found next to the program and in the libraries passed
+        # with `-l`.
+        flags = f"{self.flags} {unwrap_or(config['stages', self.name, 'flags'], '')}"
+        dirs = [*library_dirs(flags), config["global", cfg.ROOT], Path.cwd()]
+        return import_digests(data, [input_dir, *dirs] if input_dir else dirs)
+
     def _define_steps(self, input, builder, config):
         calyx_exec = config["stages", self.name, "exec"]
         cmd = " ".join(
@@ -41,6 +52,7 @@ class CalyxStage(Stage):
             return shell(
                 cmd,
                 stdin=inp_stream,
+                stream=True,
             )
 
         return run_futil(input)
@@ -3,12 +3,25 @@ from fud.stages import Stage, SourceType, Source
 from pathlib import Path
 import simplejson as sjson
 import numpy as np
-from fud.stages.verilator.numeric_types import FixedPoint, Bitnum
+from fud.stages.verilator.numeric_types import bitnum, fixed_point
 from fud.errors import InvalidNumericType
-from fud.stages.verilator.json_to_dat import parse_fp_widths, float_to_fixed
+from fud.stages.verilator.json_to_dat import (
+    decode,
+    float_to_fixed,
+    load_memories,
+    parse_fp_widths,
+)
+from fud.stages.verilator.numeric_arrays import (
+    base64_decode,
+    base64_encode,
+    encode_bitnums,
+    encode_fixed_points,
+)
 from fud.utils import shell, TmpDir, unwrap_or, transparent_shell
 from fud import config as cfg
+from fud.cache import file_digest, import_digests, library_dirs
 from enum import Enum, auto
+from decimal import Decimal
 
 
 class EvalType(Enum):
@@ -26,6 +39,7 @@ _DEBUGGER_TARGET = "debugger"
 class InterpreterStage(Stage):
     name = "interpreter"
     eval_type = EvalType.INTERPRETER
+    cacheable = True
 
     @classmethod
     def data_converter(cls):
@@ -33,13 +47,14 @@ class InterpreterStage(Stage):
             flags="",
             debugger_flags="",
             desc=(
-                "convert data files for the interpreter use. ",
-                "Meant for internal interp dev use.",
+                "convert data files for the interpreter use. "
+                "Meant for internal interp dev use."
             ),
             output_type=SourceType.Path,
             output_name="interpreter-data",
         )
         self.eval_type = EvalType.DATA_CONVERTER
+        self.cacheable = False
         return self
 
     @classmethod
@@ -53,6 +68,7 @@ class InterpreterStage(Stage):
         )
         self.eval_type = EvalType.DEBUGGER
         self._no_spinner = True
+        self.cacheable = False
         return self
 
     def __init__(
@@ -74,6 +90,20 @@ class InterpreterStage(Stage):
         self.flags = flags
         self.debugger_flags = debugger_flags
 
+    def cache_inputs(self, config):
+        return {
+            **super().cache_inputs(config),
+            "data": file_digest(config.get(["stages", "verilog", "data"])),
+            "mrxl_data": file_digest(config.get(["stages", "mrxl", "data"])),
+        }
+
+    def cache_dependencies(self, config, data, input_dir=None):
+        # Imports are found next to the program and in the libraries passed
+        # with `-l`.
+        flags = f"{self.flags} {unwrap_or(config['stages', self.name, 'flags'], '')}"
+        dirs = [*library_dirs(flags), config["global", cfg.ROOT], Path.cwd()]
+        return import_digests(data, [input_dir, *dirs] if input_dir else dirs)
+
     def _is_debugger(self):
         """
         Am I a debugger?
@@ -132,11 +162,8 @@ class InterpreterStage(Stage):
             Creates a data file to initialze the interpreter memories
             """
             round_float_to_fixed = config["stages", self.name, "round_float_to_fixed"]
-            convert_to_json(
-                tmpdir.name,
-                sjson.load(open(json_path.data), use_decimal=True),
-                round_float_to_fixed,
-            )
+            with open(json_path.data, "rb") as f:
+                convert_to_json(tmpdir.name, load_memories(f), round_float_to_fixed)
 
         @builder.step()
         def output_data(
@@ -221,50 +248,86 @@ class InterpreterStage(Stage):
 
 
 def convert_to_json(output_dir, data, round_float_to_fixed):
+    """
+    Write the interpreter data file for `data` to `output_dir`. `data` is
+    either a dictionary or an iterable of (name, memory) pairs, like the ones
+    returned by `load_memories`. Memories are converted and written one at a
+    time.
+    """
     output_dir = Path(output_dir)
     shape = {}
-    output_json = {}
-    for k, item in data.items():
-        arr = np.array(item["data"], str)
-        format = item["format"]
-
-        numeric_type = format["numeric_type"]
-        is_signed = format["is_signed"]
-        shape[k] = {"is_signed": is_signed}
-
-        if numeric_type not in {"bitnum", "fixed_point"}:
-            raise InvalidNumericType('Fud only supports "fixed_point" and "bitnum".')
-
-        is_fp = numeric_type == "fixed_point"
-        if is_fp:
-            width, int_width = parse_fp_widths(format)
-            shape[k]["int_width"] = int_width
-        else:
-            width = format["width"]
-
-        shape[k]["width"] = width
-
-        def convert(x):
-            if not is_fp:
-                return Bitnum(x, **shape[k]).base_64_encode()
-
-            try:
-                return FixedPoint(x, **shape[k]).base_64_encode()
-            except InvalidNumericType as error:
-                if round_float_to_fixed:
-                    # Only round if it is not already representable.
-                    fractional_width = width - int_width
-                    x = float_to_fixed(float(x), fractional_width)
-                    x = str(x)
-                    return FixedPoint(x, **shape[k]).base_64_encode()
-                else:
-                    raise error
-
-        output_json[k] = [convert(x) for x in arr.flatten()]
-    out_path = output_dir / _FILE_NAME
+    with (output_dir / _FILE_NAME).open("w") as out:
+        out.write("{")
+        items = data.items() if isinstance(data, dict) else data
+        for idx, (k, item) in enumerate(items):
+            arr = np.array(item["data"], str)
+            format = item["format"]
+
+            numeric_type = format["numeric_type"]
+            is_signed = format["is_signed"]
+            shape[k] = {"is_signed": is_signed}
+
+            if numeric_type not in {"bitnum", "fixed_point"}:
+                raise InvalidNumericType(
+                    'Fud only supports "fixed_point" and "bitnum".'
+                )
 
-    with out_path.open("w") as f:
-        sjson.dump(output_json, f, indent=2, use_decimal=True)
+            is_fp = numeric_type == "fixed_point"
+            if is_fp:
+                width, int_width = parse_fp_widths(format)
+                shape[k]["int_width"] = int_width
+            else:
+                width = format["width"]
+
+            shape[k]["width"] = width
+
+            def convert(x):
+                if not is_fp:
+                    return bitnum(x, **shape[k]).base_64_encode()
+
+                try:
+                    return fixed_point(x, **shape[k]).base_64_encode()
+                except InvalidNumericType as error:
+                    if round_float_to_fixed:
+                        # Only round if it is not already representable.
+                        fractional_width = width - int_width
+                        x = float_to_fixed(float(x), fractional_width)
+                        # Use the exact value of the rounded float. Its
+                        # shortest repr isn't always representable.
+                        x = str(Decimal(x))
+                        return fixed_point(x, **shape[k]).base_64_encode()
+                    else:
+                        raise error
+
+            encoded = encode_memory(
+                arr.flatten(),
+                convert,
+                round_float_to_fixed,
+                is_signed,
+                width,
+                int_width if is_fp else None,
+            )
+            # Same output as dumping the dictionary of all memories with
+            # `indent=2`: strip the braces around the memory.
+            entry = sjson.dumps({k: encoded}, indent=2)
+            out.write(("," if idx else "") + entry[1:-2])
+        out.write("\n}" if shape else "}")
+
+
+def encode_memory(values, convert, round, is_signed, width, int_width=None):
+    """
+    Base64 encode the array of strings `values`. Most values are encoded on
+    the whole array at once. The others are encoded one at a time with
+    `convert`.
+    """
+    if int_width is None:
+        encoded, ok = encode_bitnums(values, width, is_signed)
+    else:
+        encoded, ok = encode_fixed_points(values, width, int_width, is_signed, round)
+    strings = base64_encode(encoded, width).tolist()
+    for idx in np.flatnonzero(~ok):
+        strings[idx] = convert(values[idx]).decode("ascii")
+    return strings
 
 
 def parse_from_json(output_data_str, original_data_file_path):
@@ -310,7 +373,7 @@ def parse_from_json(output_data_str, original_data_file_path):
 
                 assert len(bin_str) == width + 2
 
-                fp = FixedPoint(
+                fp = fixed_point(
                     bin_str,
                     width,
                     int_width,
@@ -320,6 +383,37 @@ def parse_from_json(output_data_str, original_data_file_path):
             else:
                 return False, f"got {numeric_type}"
 
+    def parse_memory(target, format_details):
+        """
+        Decode all values of a memory at once. Falls back to `parse_entry`
+        for values that the vectorized decoder rejects.
+        """
+        if format_details is None or not isinstance(target, list):
+            return parse_entry(target, format_details)
+        numeric_type, is_signed, (width, int_width, _) = format_details
+        try:
+            arr = np.array(target, dtype=object)
+        except ValueError:
+            return parse_entry(target, format_details)
+        strings = arr.ravel().tolist()
+        all_strings = set(map(type, strings)) <= {str}
+        if numeric_type not in ["bitnum", "fixed_point"] or not all_strings:
+            return parse_entry(target, format_details)
+
+        args = {"width": width, "is_signed": is_signed}
+        if numeric_type == "fixed_point":
+            args["int_width"] = int_width
+        values, ok = base64_decode(strings, width)
+        if ok.size and ok.all():
+            return decode(values, args).reshape(arr.shape).tolist()
+        decoded = iter(decode(values[ok], args).tolist() if ok.any() else [])
+        result = np.empty(len(strings), dtype=object)
+        result[:] = [
+            next(decoded) if is_ok else parse_entry(x, format_details)
+            for is_ok, x in zip(ok, strings)
+        ]
+        return result.reshape(arr.shape).tolist()
+
     processed_output_data = dict()
 
     for component, inner_dict in output_data.items():
@@ -354,7 +448,7 @@ def parse_from_json(output_data_str, original_data_file_path):
             else:
                 format_details = None
 
-            inner_dict_output[key] = parse_entry(target, format_details)
+            inner_dict_output[key] = parse_memory(target, format_details)
         processed_output_data[component] = inner_dict_output
 
     return processed_output_data
@@ -32,6 +32,6 @@ class JqStage(Stage):
 
         @builder.step(description=cmd)
         def run(inp_stream: SourceType.Stream) -> SourceType.Stream:
-            return shell(cmd, stdin=inp_stream)
+            return shell(cmd, stdin=inp_stream, stream=True)
 
         return run(stream)
@@ -32,6 +32,6 @@ class RelayStage(Stage):
         @builder.step(description=str(script))
         def run_relay(input_path: SourceType.Path) -> SourceType.Stream:
             flags = unwrap_or(config["stages", self.name, "flags"], "")
-            return shell(f"{str(script)} {str(input_path)} {flags}")
+            return shell(f"{str(script)} {str(input_path)} {flags}", stream=True)
 
         return run_relay(input)
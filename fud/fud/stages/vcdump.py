@@ -1,9 +1,25 @@
+from fnmatch import fnmatchcase
+from glob import escape
+from io import TextIOWrapper
+from tempfile import TemporaryFile
+import json
+
+from fud.errors import Malformed
 from fud.stages import Stage, SourceType
-from fud.utils import shell
+from fud.utils import option_list
+
+# Number of bytes read from the VCD file at a time.
+READ_SIZE = 1 << 20
+
+FORMATS = ["nested", "columnar"]
+
+# Simulator stages that can trace a part of the design.
+TRACING_STAGES = ["verilog", "icarus-verilog"]
 
 
 class VcdumpStage(Stage):
     name = "vcd"
+    cacheable = True
 
     def __init__(self):
         super().__init__(
@@ -11,14 +27,217 @@ class VcdumpStage(Stage):
             target_state="vcd_json",
             input_type=SourceType.Stream,
             output_type=SourceType.Stream,
-            description="Transform VCD file to JSON using `vcdump`",
+            description="Transform VCD file to JSON",
         )
 
+    def known_opts(self):
+        return ["signals", "start", "end", "format", "file_extensions"]
+
+    def signals(self, config):
+        """
+        Patterns for the signals to keep. Unless they are given, only keeps
+        the scopes traced by the simulator, if it traces a part of the design.
+        """
+        signals = config.get(["stages", self.name, "signals"])
+        if signals is not None:
+            return option_list(signals)
+        traced = [
+            f"*.main.{escape(scope)}"
+            for stage in TRACING_STAGES
+            for scope in option_list(config.get(["stages", stage, "trace_scopes"]))
+        ]
+        return traced or None
+
+    def cache_inputs(self, config):
+        return {**super().cache_inputs(config), "signals": self.signals(config)}
+
     def _define_steps(self, stream, builder, config):
-        cmd = " ".join([config["stages", self.name, "exec"], "--pretty"])
+        signals = self.signals(config)
+        start = config.get(["stages", self.name, "start"])
+        end = config.get(["stages", self.name, "end"])
+        start = None if start is None else int(start)
+        end = None if end is None else int(end)
+        format = config.get(["stages", self.name, "format"]) or "nested"
+        if format not in FORMATS:
+            raise Malformed(
+                "Stage option",
+                f"Unknown format `{format}' for stage `{self.name}'. "
+                f"Supported formats: {', '.join(FORMATS)}.",
+            )
+
+        @builder.step()
+        def read(inp_stream: SourceType.Stream) -> SourceType.Stream:
+            """
+            Read the VCD file and write the selected signals as JSON.
+            """
+            data = read_vcd(inp_stream, signals, start, end, format == "columnar")
+            out = TemporaryFile()
+            text = TextIOWrapper(out, encoding="UTF-8")
+            if format == "columnar":
+                json.dump(data, text, separators=(",", ":"))
+            else:
+                json.dump(data, text, indent=2)
+            text.flush()
+            text.detach()
+            out.seek(0)
+            return out
+
+        return read(stream)
+
+
+def _tokens(stream):
+    """The whitespace separated tokens of `stream`, read in chunks."""
+    rest = b""
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        tokens = chunk.split()
+        rest = b"" if chunk[-1:].isspace() or not tokens else tokens.pop()
+        yield from tokens
+    if rest:
+        yield rest
+
+
+def _command(tokens):
+    """The arguments of a command, up to its `$end`."""
+    args = []
+    for tok in tokens:
+        if tok == b"$end":
+            return args
+        args.append(tok)
+    raise Malformed("VCD file", "Unterminated command")
+
+
+def _header(tokens):
+    """
+    Read the definitions of the VCD file. Returns its timescale and, for
+    every identifier code, the names and widths of the variables using it.
+    Names are the paths of the variables through their scopes.
+    """
+    timescale = None
+    scopes = []
+    variables = {}
+    for tok in tokens:
+        args = _command(tokens)
+        if tok == b"$enddefinitions":
+            return timescale, variables
+        elif tok == b"$scope":
+            scopes.append(args[1].decode())
+        elif tok == b"$upscope":
+            scopes.pop()
+        elif tok == b"$var":
+            _, width, code, name = args[:4]
+            path = tuple(scopes + [name.decode()])
+            variables.setdefault(code, []).append((path, int(width)))
+        elif tok == b"$timescale":
+            timescale = b"".join(args).decode()
+    raise Malformed("VCD file", "Missing $enddefinitions")
+
+
+def _selected(name, signals):
+    """Whether the signal `name` matches one of the patterns in `signals`.
+    A pattern naming a scope matches all the signals in it."""
+    return any(
+        fnmatchcase(name, pat) or fnmatchcase(name, pat + ".*") for pat in signals
+    )
+
+
+def read_vcd(stream, signals=None, start=None, end=None, columnar=False):
+    """
+    Read the VCD file in the binary `stream` in one pass. Only the signals
+    whose names (the paths through their scopes, joined with `.`) match one
+    of the glob patterns in `signals` are kept, and only at the times from
+    `start` to `end`, inclusive. Values with unknown (`x`) or floating (`z`)
+    bits are None.
+
+    By default, returns the value of every signal at every time in a
+    dictionary nested by scope. If `columnar` is set, returns the times at
+    which each signal changed along with the new values instead:
+        {"timescale": "1ps", "signals": {"TOP.main.x": {
+            "width": 4, "times": [0, 10], "values": [0, 3]}}}
+    """
+    tokens = _tokens(stream)
+    timescale, variables = _header(tokens)
+    if signals is not None:
+        variables = {
+            code: kept
+            for code, vars in variables.items()
+            if (kept := [v for v in vars if _selected(".".join(v[0]), signals)])
+        }
+
+    # The current value of each signal and the signals changed since the
+    # last time that was recorded.
+    values = dict.fromkeys(variables)
+    changed = set()
+    # The recorded values of each signal, and the times they changed at.
+    samples = {code: [] for code in variables}
+    times = {code: [] for code in variables}
+
+    def record(time):
+        if start is not None and time < start:
+            return
+        if columnar:
+            for code in changed:
+                times[code].append(time)
+                samples[code].append(values[code])
+            changed.clear()
+        else:
+            for code, value in values.items():
+                samples[code].append(value)
+
+    # Changes before the first timestamp happen at time 0.
+    time, pending = 0, False
+    for tok in tokens:
+        first = tok[0]
+        if first == 35:  # `#`
+            if pending:
+                record(time)
+            time, pending = int(tok[1:]), True
+            if end is not None and time > end:
+                pending = False
+                break
+        elif first in b"01xzXZ":
+            code = tok[1:]
+            if code in values:
+                values[code] = first - 48 if first < 50 else None
+                changed.add(code)
+            pending = True
+        elif first in b"bBrR":
+            code = next(tokens)
+            if code in values:
+                try:
+                    value = int(tok[1:], 2) if first in b"bB" else float(tok[1:])
+                except ValueError:
+                    value = None
+                values[code] = value
+                changed.add(code)
+            pending = True
+        elif tok == b"$comment":
+            _command(tokens)
+    if pending:
+        record(time)
 
-        @builder.step(description=cmd)
-        def run_vcdump(inp_stream: SourceType.Stream) -> SourceType.Stream:
-            return shell(cmd, stdin=inp_stream)
+    if columnar:
+        return {
+            "timescale": timescale,
+            "signals": {
+                ".".join(path): {
+                    "width": width,
+                    "times": times[code],
+                    "values": samples[code],
+                }
+                for code, vars in variables.items()
+                for (path, width) in vars
+            },
+        }
 
-        return run_vcdump(stream)
+    nested = {}
+    for code, vars in variables.items():
+        for path, _ in vars:
+            scope = nested
+            for name in path[:-1]:
+                scope = scope.setdefault(name, {})
+            scope[path[-1]] = samples[code]
+    return nested
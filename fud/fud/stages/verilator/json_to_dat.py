@@ -1,9 +1,30 @@
 import simplejson as sjson
 import numpy as np
-from .numeric_types import FixedPoint, Bitnum
+from decimal import Decimal
+from .numeric_types import bitnum, fixed_point
+from .numeric_arrays import (
+    decode_bitnums,
+    decode_fixed_points,
+    encode_bitnums,
+    encode_fixed_points,
+    flatten,
+    hex_lines,
+    parse_hex,
+    MAX_WIDTH,
+)
+from .testbench import BIN_HEADER_SIZE, BIN_MAGIC, BIN_VERSION, word_bytes
 from pathlib import Path
+from fud.cache import file_digest
 from fud.errors import InvalidNumericType, Malformed
+import codecs
 import logging as log
+import re
+
+# Number of bytes read at once by `load_memories`.
+READ_SIZE = 1 << 20
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Strings, unterminated strings, and brackets in JSON text.
+_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|"|[][{}]')
 
 
 def float_to_fixed(value: float, N: int) -> float:
@@ -14,6 +35,33 @@ def float_to_fixed(value: float, N: int) -> float:
     return round(value * w) / float(w)
 
 
+def parse(hex_value: str, args):
+    """Parses a single hexadecimal number with the given numeric type
+    arguments.
+    """
+    hex_value = f"0x{hex_value}"
+    if "int_width" in args:
+        return fixed_point(hex_value, **args).str_value()
+    else:
+        bn = bitnum(hex_value, **args)
+        if bn.is_undef:
+            return bn.str_value()
+        else:
+            return int(bn.str_value())
+
+
+def decode(values, args):
+    """Decodes the array of `width`-bit numbers `values` with the given
+    numeric type arguments.
+    """
+    if "int_width" in args:
+        return decode_fixed_points(
+            values, args["width"], args["int_width"], args["is_signed"]
+        )
+    else:
+        return decode_bitnums(values, args["width"], args["is_signed"])
+
+
 def parse_dat(path, args):
     """Parses a number with the given numeric type
     arguments from the array at the given `path`.
@@ -30,32 +78,69 @@ def parse_dat(path, args):
             ),
         )
 
-    def parse(hex_value: str):
-        hex_value = f"0x{hex_value}"
-        if "int_width" in args:
-            return FixedPoint(hex_value, **args).str_value()
-        else:
-            bn = Bitnum(hex_value, **args)
-            if bn.is_undef:
-                return bn.str_value()
-            else:
-                return int(bn.str_value())
+    width = args["width"]
+    lines = path.read_bytes().split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+    # Remove lines that start with '//' since they are probably comments.
+    # These seem to be generated by icarus-verilog's $writememh() but not
+    # verilator.
+    if any(line.startswith(b"//") for line in lines):
+        log.debug(f"Ignoring lines that look like comments: {path}")
+        lines = [line for line in lines if not line.startswith(b"//")]
 
-    with path.open("r") as f:
-        lines = []
-        # Remove lines that start with '//' since they are probably comments.
-        # These seem to be generated by icarus-verilog's $writememh() but not
-        # verilator.
-        for hex_value in f.readlines():
-            if hex_value.startswith("//"):
-                log.debug(
-                    f"Ignorning line {repr(hex_value)}"
-                    + f" since it looks like a comment: {path}"
-                )
-                continue
-            lines.append(parse(hex_value))
+    if not lines:
+        return np.array([])
 
-        return np.array(lines)
+    # Decode the whole file at once. Lines the vectorized parser rejects, like
+    # undefined values, are decoded one at a time.
+    values, ok = parse_hex(lines, width)
+    if ok.all():
+        return decode(values, args)
+
+    decoded = iter(decode(values[ok], args).tolist() if ok.any() else [])
+    return np.array(
+        [
+            next(decoded) if is_ok else parse(line.decode(), args)
+            for is_ok, line in zip(ok, lines)
+        ]
+    )
+
+
+def parse_bin(path, args, size):
+    """Parses the `size` numbers in the binary memory file at `path` with the
+    given numeric type arguments.
+    """
+    width = args["width"]
+    nwords = word_bytes(width) // 4
+    header_words = BIN_HEADER_SIZE // 4
+    expected = [BIN_MAGIC, BIN_VERSION, 4 * nwords, size]
+    file_size = path.stat().st_size
+    words = np.memmap(path, dtype="<u4", mode="r") if file_size else np.zeros(0)
+    if (
+        file_size != BIN_HEADER_SIZE + 4 * nwords * size
+        or words[:header_words].tolist() != expected
+    ):
+        raise Malformed(
+            "Binary memory file",
+            f"`{path}' does not contain {size} numbers with width {width}",
+        )
+    words = words[header_words:].reshape(size, nwords)
+
+    if width <= MAX_WIDTH:
+        values = words[:, 0].astype(np.int64)
+        if nwords > 1:
+            values |= words[:, 1].astype(np.int64) << 32
+        return decode(values, args)
+
+    return np.array(
+        [
+            parse(f"{sum(w << (32 * i) for i, w in enumerate(row)):X}", args)
+            for row in words.tolist()
+        ],
+        # Keep values that don't fit in 64 bits as integers.
+        dtype=object,
+    )
 
 
 def parse_fp_widths(format):
@@ -81,35 +166,188 @@ def parse_fp_widths(format):
     elif provided(width, frac_width):
         return width, (width - frac_width)
     else:
-        raise Exception(
-            """Fixed point requires one of the following:
+        raise Exception("""Fixed point requires one of the following:
             (1) Bit width `width`, integer width `int_width`.
             (2) Bit width `width`, fractional width `frac_width`.
             (3) Integer width `int_width`, fractional width `frac_width`.
-            """
-        )
+            """)
 
 
 def convert(x, round: bool, is_signed: bool, width: int, int_width=None):
     with_prefix = False
     # If `int_width` is not defined, then this is a `Bitnum`
     if int_width is None:
-        return Bitnum(x, width, is_signed).hex_string(with_prefix)
+        return bitnum(x, width, is_signed).hex_string(with_prefix)
 
     try:
-        return FixedPoint(x, width, int_width, is_signed).hex_string(with_prefix)
+        return fixed_point(x, width, int_width, is_signed).hex_string(with_prefix)
     except InvalidNumericType as error:
         if round:
             # Only round if it is not already representable.
             fractional_width = width - int_width
             x = float_to_fixed(float(x), fractional_width)
-            x = str(x)
-            return FixedPoint(x, width, int_width, is_signed).hex_string(with_prefix)
+            # Use the exact value of the rounded float. Its shortest repr
+            # isn't always representable in fixed point.
+            x = str(Decimal(x))
+            return fixed_point(x, width, int_width, is_signed).hex_string(with_prefix)
         else:
             raise error
 
 
-def convert2dat(output_dir, data, extension, round: bool):
+def encode(values, round: bool, is_signed: bool, width: int, int_width=None):
+    """Encode the array of strings `values` as the contents of a `.dat` file.
+    Most values are encoded on the whole array at once. Values that need
+    arbitrary-precision arithmetic are encoded one at a time with `convert`.
+    """
+    if int_width is None:
+        encoded, ok = encode_bitnums(values, width, is_signed)
+    else:
+        encoded, ok = encode_fixed_points(values, width, int_width, is_signed, round)
+
+    if ok.all():
+        return hex_lines(encoded, width)
+
+    lines = hex_lines(encoded[ok], width).decode("ascii").splitlines()
+    fast = iter(lines)
+    out = []
+    for v, is_ok in zip(values, ok):
+        out.append(
+            next(fast) if is_ok else convert(v, round, is_signed, width, int_width)
+        )
+    return ("\n".join(out) + "\n").encode("ascii") if out else b""
+
+
+def write_bin(path, values, round: bool, is_signed: bool, width: int, int_width=None):
+    """Write the array of strings `values` to `path` as a binary memory file.
+    See `testbench.py` for the format. The numbers are encoded in place in a
+    memory map of the file.
+    """
+    if int_width is None:
+        encoded, ok = encode_bitnums(values, width, is_signed)
+    else:
+        encoded, ok = encode_fixed_points(values, width, int_width, is_signed, round)
+
+    nwords = word_bytes(width) // 4
+    header_words = BIN_HEADER_SIZE // 4
+    file = np.memmap(
+        path, dtype="<u4", mode="w+", shape=(header_words + len(values) * nwords,)
+    )
+    file[:header_words] = [BIN_MAGIC, BIN_VERSION, 4 * nwords, len(values)]
+    words = file[header_words:].reshape(len(values), nwords)
+    words[:, 0] = encoded & 0xFFFFFFFF
+    if nwords > 1:
+        words[:, 1] = encoded >> 32
+    for i in np.flatnonzero(~ok):
+        v = int(convert(values[i], round, is_signed, width, int_width), 16)
+        words[i] = [(v >> (32 * w)) & 0xFFFFFFFF for w in range(nwords)]
+    file.flush()
+    del words, file
+
+
+def load_memories(f):
+    """Reads the memories in the JSON data file `f` (opened in binary mode)
+    one at a time. Yields the name and the definition of each memory.
+    Numbers are parsed like `sjson.load(f, use_decimal=True)` does.
+
+    Uses `ijson` if it is installed. Otherwise, the text of each memory is
+    decoded separately so that only one memory is in memory at a time.
+    """
+    try:
+        import ijson  # type: ignore
+    except ModuleNotFoundError:
+        yield from _load_memories(f)
+        return
+
+    yield from ijson.kvitems(f, "", use_float=False)
+
+
+def _load_memories(f):
+    decoder = sjson.JSONDecoder(parse_float=Decimal)
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    eof = False
+
+    def read(size):
+        nonlocal buf, eof
+        data = f.read(size)
+        eof = not data
+        buf += utf8.decode(data, final=eof)
+
+    def skip(pos):
+        """Skip whitespace starting at `pos`."""
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return pos
+            read(READ_SIZE)
+
+    def expect(pos, chars):
+        pos = skip(pos)
+        if pos == len(buf) or buf[pos] not in chars:
+            found = f"`{buf[pos]}'" if pos < len(buf) else "the end of the file"
+            raise Malformed("Data file", f"Expected one of `{chars}' but found {found}")
+        return pos + 1, buf[pos]
+
+    def find_end(pos):
+        """Find the end of the array or object at `pos` without decoding it.
+        Reads more until it is complete."""
+        depth = 0
+        while True:
+            for m in _TOKENS.finditer(buf, pos):
+                token = m.group()
+                if token == '"':
+                    # The string continues after the end of the buffer.
+                    break
+                pos = m.end()
+                if token in "[{":
+                    depth += 1
+                elif token in "]}":
+                    depth -= 1
+                    if depth == 0:
+                        return pos
+            else:
+                pos = len(buf)
+            if eof:
+                return len(buf)
+            # Grow the buffer geometrically to bound the copies.
+            read(max(READ_SIZE, len(buf)))
+
+    def value(pos):
+        """Decode the value at `pos`. Reads more until it is complete."""
+        pos = skip(pos)
+        if pos < len(buf) and buf[pos] in "[{":
+            find_end(pos)
+            return decoder.raw_decode(buf, pos)
+        while True:
+            try:
+                val, end = decoder.raw_decode(buf, pos)
+                # A number at the end of the buffer might continue.
+                if eof or (end < len(buf) and buf[end] not in "0123456789.eE+-"):
+                    return val, end
+            except sjson.JSONDecodeError:
+                if eof:
+                    raise
+            read(READ_SIZE)
+
+    pos, _ = expect(0, "{")
+    pos = skip(pos)
+    if pos < len(buf) and buf[pos] == "}":
+        return
+    while True:
+        name, pos = value(pos)
+        if not isinstance(name, str):
+            raise Malformed("Data file", f"Expected a memory name but found {name}")
+        pos, _ = expect(pos, ":")
+        mem, pos = value(pos)
+        yield name, mem
+        # Drop the text of the memory.
+        buf = buf[pos:]
+        pos, c = expect(0, ",}")
+        if c == "}":
+            return
+
+
+def convert2dat(output_dir, data, extension, round: bool, binary=()):
     """Goes through the JSON data and creates a file for
     each key, flattens the data, and then converts it to
     bitstrings. Also generates a file named "shape.json" t
@@ -121,13 +359,20 @@ def convert2dat(output_dir, data, extension, round: bool):
     representations should be converted to the nearest fixed
     point. If False, an exception is thrown when a number
     cannot be represented exactly in fixed point format.
+
+    Memories named in `binary` are written to `.bin` files in the binary
+    format instead and their memory files are left empty.
+
+    `data` is either a dictionary or an iterable of (name, memory) pairs,
+    like the ones returned by `load_memories`.
     """
     output_dir = Path(output_dir)
     shape = {}
-    for k, item in data.items():
+    items = data.items() if isinstance(data, dict) else data
+    for k, item in items:
         path = output_dir / f"{k}.{extension}"
         path.touch()
-        arr = np.array(item["data"], str)
+        values, data_shape = flatten(item["data"])
         format = item["format"]
 
         numeric_type = format["numeric_type"]
@@ -152,11 +397,14 @@ def convert2dat(output_dir, data, extension, round: bool):
         if int_width is not None:
             shape[k]["int_width"] = int_width
 
-        with path.open("w") as f:
-            for v in arr.flatten():
-                f.write(convert(v, round, is_signed, width, int_width) + "\n")
+        if k in binary:
+            bin_path = output_dir / f"{k}.bin"
+            write_bin(bin_path, values, round, is_signed, width, int_width)
+        else:
+            with path.open("wb") as f:
+                f.write(encode(values, round, is_signed, width, int_width))
 
-        shape[k]["shape"] = list(arr.shape)
+        shape[k]["shape"] = data_shape
         shape[k]["numeric_type"] = numeric_type
 
     # Commit shape.json file.
@@ -167,7 +415,8 @@ def convert2dat(output_dir, data, extension, round: bool):
 
 def convert2json(input_dir, extension):
     """Converts a directory of *.dat
-    files back into a JSON file.
+    files back into a JSON file. Memories with a binary memory file
+    (<mem>.<extension>.bin) are read from it instead.
     Only de-parses output memory files corresponding to memory names in
     "shape.json"
     """
@@ -186,7 +435,11 @@ def convert2json(input_dir, extension):
         args = form.copy()
         del args["shape"]
         del args["numeric_type"]
-        arr = parse_dat(path, args)
+        bin_path = input_dir / f"{mem}.{extension}.bin"
+        if bin_path.exists():
+            arr = parse_bin(bin_path, args, int(np.prod(form["shape"])))
+        else:
+            arr = parse_dat(path, args)
         if form["shape"] == [0]:
             raise Malformed(
                 "Data format shape",
@@ -213,3 +466,25 @@ def convert2json(input_dir, extension):
         data[mem] = arr.tolist()
 
     return data
+
+
+def memory_checksums(input_dir, extension):
+    """
+    SHA-256 digests of the memory files that the simulator wrote to
+    `input_dir` for the memories in "shape.json". Much cheaper than
+    converting the memories back to JSON, but the digests of memories are
+    only comparable between runs with the same data format.
+    Memories without a memory file have no digest.
+    """
+    input_dir = Path(input_dir)
+    shape_json_path = input_dir / "shape.json"
+    if not shape_json_path.exists():
+        return {}
+
+    shape_json = sjson.load(shape_json_path.open("r"), use_decimal=True)
+    checksums = {}
+    for mem in shape_json:
+        bin_path = input_dir / f"{mem}.{extension}.bin"
+        path = bin_path if bin_path.exists() else input_dir / f"{mem}.{extension}"
+        checksums[mem] = file_digest(path)
+    return checksums
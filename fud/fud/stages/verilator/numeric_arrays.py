@@ -0,0 +1,394 @@
+"""Vectorized conversions between arrays of numbers and their bit-level
+representation in memory files.
+
+The functions in this module handle the common cases (values that fit in
+63 bits, decimal strings without exponents) on whole arrays at once. They
+report which elements they could not handle so that callers can fall back
+to the arbitrary-precision `NumericType` classes for those.
+"""
+
+from typing import List, Tuple
+
+import base64
+import binascii
+from decimal import Decimal, localcontext
+from itertools import chain
+
+import numpy as np
+
+from fud.errors import Malformed
+
+# Largest width handled by the vectorized functions. Values are computed
+# with int64 arithmetic, so we need an extra bit for the sign.
+MAX_WIDTH = 62
+# At most this many decimal digits fit in an int64.
+MAX_DIGITS = 18
+# Powers of 5 that fit in an int64.
+POW5 = np.array([5**i for i in range(MAX_DIGITS + 1)], dtype=np.int64)
+
+HEX_DIGITS = np.frombuffer(b"0123456789ABCDEF", dtype=np.uint8)
+NEWLINE = ord("\n")
+# Number of values formatted at once by `hex_lines`. Bounds the size of the
+# intermediate arrays.
+CHUNK_SIZE = 1 << 16
+
+
+def flatten(data) -> Tuple[np.ndarray, List[int]]:
+    """
+    Flatten the nested lists in `data` into an array of strings. Returns
+    the array and the shape of `data`.
+    """
+    shape = []
+    level = [data]
+    while level and any(isinstance(x, list) for x in level):
+        lengths = set(len(x) if isinstance(x, list) else -1 for x in level)
+        if len(lengths) > 1:
+            raise Malformed(
+                "Data format shape",
+                f"Nested lists of different lengths {sorted(lengths)}"
+                + f" at dimension {len(shape)}",
+            )
+        shape.append(lengths.pop())
+        level = list(chain.from_iterable(level))
+    return np.array([str(x) for x in level], dtype=str), shape
+
+
+def _char_matrix(values: np.ndarray) -> np.ndarray:
+    """
+    Returns the characters of the strings in `values` as a matrix of code
+    points with one row per string, padded with zeros.
+    """
+    values = np.ascontiguousarray(values, dtype=str)
+    width = max(values.dtype.itemsize // 4, 1)
+    if values.dtype.itemsize == 0:
+        values = values.astype("U1")
+    return values.view(np.uint32).reshape(len(values), width)
+
+
+def parse_decimals(
+    values: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parse decimal strings of the form `-?[0-9]+(.[0-9]+)?` into integers.
+    The value of the i-th string is `(-1 if neg[i] else 1) * digits[i] /
+    10**frac_digits[i]`.
+
+    Returns `(digits, frac_digits, neg, ok)` where `ok` marks the strings
+    that were parsed. Strings with other forms (e.g., exponents) or more
+    than `MAX_DIGITS` digits are not parsed.
+    """
+    n = len(values)
+    chars = _char_matrix(values)
+
+    is_digit = (chars >= ord("0")) & (chars <= ord("9"))
+    is_dot = chars == ord(".")
+    is_pad = chars == 0
+    neg = chars[:, 0] == ord("-")
+
+    # A minus sign is only allowed in front and there is at most one dot,
+    # which must have digits on both sides.
+    valid = is_digit | is_dot | is_pad
+    valid[:, 0] |= neg
+    ok = valid.all(axis=1) & (is_dot.sum(axis=1) <= 1)
+    num_digits = is_digit.sum(axis=1)
+    ok &= (num_digits > 0) & (num_digits <= MAX_DIGITS)
+
+    # Digits after the dot. Valid strings only contain digits after it.
+    has_dot = is_dot.any(axis=1)
+    length = chars.shape[1] - is_pad.sum(axis=1)
+    frac_digits = np.where(has_dot, length - np.argmax(is_dot, axis=1) - 1, 0)
+    ok &= ~has_dot | ((frac_digits > 0) & (num_digits > frac_digits))
+    # Padding only at the end, and the first digit right after the sign.
+    ok &= ~(is_pad[:, :-1] & ~is_pad[:, 1:]).any(axis=1)
+    ok &= np.where(neg, is_digit[:, min(1, chars.shape[1] - 1)], is_digit[:, 0])
+
+    digits = np.zeros(n, np.int64)
+    for col in range(chars.shape[1]):
+        d = is_digit[:, col] & ok
+        digit = chars[:, col].astype(np.int64) - ord("0")
+        digits = np.where(d, digits * 10 + digit, digits)
+
+    return digits, frac_digits.astype(np.int64), neg, ok
+
+
+def to_floats(
+    values: np.ndarray, digits: np.ndarray, frac_digits: np.ndarray
+) -> np.ndarray:
+    """
+    The magnitudes of the parsed `values` as correctly rounded floats.
+    """
+    # Dividing two exactly representable floats is correctly rounded.
+    exact = (digits < (1 << 53)) & (frac_digits <= 22)
+    floats = digits / np.power(10.0, np.minimum(frac_digits, 22))
+    if not exact.all():
+        floats[~exact] = np.abs(values[~exact].astype(np.float64))
+    return floats
+
+
+def _float_chars(values: np.ndarray) -> np.ndarray:
+    """Strings that only contain characters used by floats."""
+    chars = _char_matrix(values)
+    allowed = np.zeros(128, bool)
+    allowed[np.frombuffer(b"0123456789.+-eE", np.uint8)] = True
+    return ((chars == 0) | allowed[np.minimum(chars, 127)]).all(axis=1) & (
+        chars[:, 0] != 0
+    )
+
+
+def _fits(values: np.ndarray, width: int) -> np.ndarray:
+    return (values >= 0) & (values < (1 << width))
+
+
+def encode_bitnums(
+    values: np.ndarray, width: int, is_signed: bool
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode the integer strings in `values` as `width`-bit two's complement
+    numbers. Returns the encoded numbers and a mask of the elements that
+    were encoded. The remaining elements must be encoded with `Bitnum`.
+    """
+    n = len(values)
+    if not 0 < width <= MAX_WIDTH:
+        return np.zeros(n, np.int64), np.zeros(n, bool)
+
+    digits, frac_digits, neg, ok = parse_decimals(values)
+    ok &= frac_digits == 0
+    if is_signed:
+        # Negative numbers must fit in the width. Positive numbers may use
+        # the sign bit.
+        ok &= np.where(neg, digits <= (1 << (width - 1)), _fits(digits, width))
+    else:
+        ok &= ~neg & _fits(digits, width)
+
+    encoded = np.where(neg & (digits > 0), (1 << width) - digits, digits)
+    return np.where(ok, encoded, 0), ok
+
+
+def encode_fixed_points(
+    values: np.ndarray, width: int, int_width: int, is_signed: bool, round: bool
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode the decimal strings in `values` as fixed-point numbers with
+    `width` bits, `int_width` of which are integer bits. If `round` is set,
+    values that are not representable are rounded to the nearest
+    representable value (ties go to even). Returns the encoded numbers and a
+    mask of the elements that were encoded. The remaining elements must be
+    encoded with `FixedPoint`.
+    """
+    n = len(values)
+    frac_width = width - int_width
+    # `FixedPoint` uses an extra bit when there are no integer bits. Leave
+    # those formats to it.
+    if not (0 < width <= MAX_WIDTH and 0 < int_width <= width):
+        return np.zeros(n, np.int64), np.zeros(n, bool)
+
+    digits, frac_digits, neg, parsed = parse_decimals(values)
+
+    # The value is exactly representable if `digits * 2**frac_width /
+    # 10**frac_digits` is an integer, i.e., `digits` is divisible by
+    # `5**frac_digits` and the quotient has enough trailing zero bits.
+    pow5 = POW5[np.clip(frac_digits, 0, MAX_DIGITS)]
+    exact = parsed & (digits % pow5 == 0)
+    quot = digits // pow5
+    shift = frac_width - frac_digits
+    down = np.clip(-shift, 0, 62)
+    exact &= (shift >= 0) | (quot & ((1 << down) - 1) == 0)
+    # Make sure that shifting left doesn't overflow.
+    up = np.clip(shift, 0, 63)
+    exact &= (quot == 0) | (up < width)
+    exact &= quot < (np.int64(1) << np.clip(width - up, 0, 62))
+    scaled = np.where(shift >= 0, quot << up, quot >> down)
+
+    # `float_to_fixed` doesn't support rounding without fractional bits.
+    if round and frac_width > 0:
+        inexact = parsed & ~exact
+        floats = to_floats(values[inexact], digits[inexact], frac_digits[inexact])
+        # Values in other forms, like `1.5E-7`, are rounded too. If they were
+        # exactly representable, rounding doesn't change them as long as
+        # they fit in a float.
+        others = ~parsed & _float_chars(values)
+        if width > 53:
+            others[:] = False
+        try:
+            other_floats = np.abs(values[others].astype(np.float64))
+        except ValueError:
+            others[:] = False
+            other_floats = np.zeros(0)
+
+        idx = np.concatenate([np.flatnonzero(inexact), np.flatnonzero(others)])
+        floats = np.concatenate([floats, other_floats])
+        rounded = np.rint(floats * float(1 << frac_width))
+        # Out of range values are reported by `FixedPoint`.
+        in_range = rounded < float(1 << width)
+        scaled = scaled.copy()
+        scaled[idx[in_range]] = rounded[in_range].astype(np.int64)
+        exact[idx[in_range]] = True
+
+    ok = exact & _fits(scaled, width)
+    if not is_signed:
+        ok &= ~neg
+    encoded = np.where(neg & (scaled > 0), (1 << width) - scaled, scaled)
+    return np.where(ok, encoded, 0), ok
+
+
+def hex_lines(values: np.ndarray, width: int) -> bytes:
+    """
+    Format the unsigned `values` as uppercase hexadecimal numbers without
+    leading zeros, one per line.
+    """
+    num_digits = max(1, -(-width // 4))
+    shifts = np.arange(4 * (num_digits - 1), -1, -4, dtype=np.uint64)
+    out = []
+    for start in range(0, len(values), CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, len(values))
+        chunk = values[start:end].astype(np.uint64)
+        nibbles = (chunk[:, None] >> shifts) & np.uint64(0xF)
+
+        # Keep every digit after the first non-zero one and the last digit.
+        keep = np.empty((len(chunk), num_digits + 1), bool)
+        keep[:, :-1] = np.logical_or.accumulate(nibbles != 0, axis=1)
+        keep[:, -2:] = True
+
+        chars = np.empty((len(chunk), num_digits + 1), np.uint8)
+        chars[:, :-1] = HEX_DIGITS[nibbles]
+        chars[:, -1] = NEWLINE
+        out.append(chars[keep].tobytes())
+    return b"".join(out)
+
+
+def _hex_table() -> np.ndarray:
+    table = np.full(256, 255, np.uint8)
+    for i, c in enumerate(b"0123456789abcdef"):
+        table[c] = i
+        table[ord(chr(c).upper())] = i
+    return table
+
+
+# Value of every ASCII hexadecimal digit. Other characters map to 255.
+HEX_VALUES = _hex_table()
+
+
+def parse_hex(lines: List[bytes], width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Parse hexadecimal numbers with at most `width` bits. Returns the parsed
+    numbers and a mask of the lines that were parsed. Lines with other
+    characters, like the `x` digits of undefined values, are not parsed.
+    """
+    n = len(lines)
+    if not 0 < width <= MAX_WIDTH or n == 0:
+        return np.zeros(n, np.int64), np.zeros(n, bool)
+
+    arr = np.array(lines, dtype=bytes)
+    line_width = max(arr.dtype.itemsize, 1)
+    chars = np.frombuffer(arr.astype(f"S{line_width}").tobytes(), np.uint8)
+    chars = chars.reshape(n, line_width)
+    is_pad = chars == 0
+    nibbles = HEX_VALUES[chars]
+    ok = ((nibbles != 255) | is_pad).all(axis=1) & ~is_pad[:, 0]
+
+    values = np.zeros(n, np.int64)
+    for col in range(line_width):
+        digit = ok & ~is_pad[:, col]
+        # Stop before the values overflow. Those lines are not parsed.
+        ok &= ~digit | (values < (1 << (MAX_WIDTH - 3)))
+        values = np.where(digit & ok, (values << 4) | nibbles[:, col], values)
+
+    ok &= values < (1 << width)
+    return np.where(ok, values, 0), ok
+
+
+def decode_bitnums(values: np.ndarray, width: int, is_signed: bool) -> np.ndarray:
+    """Interpret `width`-bit `values` as two's complement numbers."""
+    if is_signed:
+        return np.where(values >= (1 << (width - 1)), values - (1 << width), values)
+    return values
+
+
+def decode_fixed_points(
+    values: np.ndarray, width: int, int_width: int, is_signed: bool
+) -> np.ndarray:
+    """
+    Interpret `width`-bit `values` as fixed-point numbers with `int_width`
+    integer bits and format them like `FixedPoint.str_value`. Each distinct
+    value is only formatted once.
+    """
+    frac_width = width - int_width
+    unique, inverse = np.unique(values, return_inverse=True)
+    neg = np.zeros(len(unique), bool)
+    if is_signed:
+        neg = unique >= (1 << (width - 1))
+    magnitude = np.where(neg, (1 << width) - unique, unique)
+    int_parts = magnitude >> frac_width
+    fracs = (magnitude & ((1 << frac_width) - 1)) / float(1 << frac_width)
+
+    with localcontext() as ctx:
+        ctx.prec = 64
+        strings = [
+            str(-Decimal(i + Decimal(f)) if n else Decimal(i + Decimal(f)))
+            for i, f, n in zip(int_parts.tolist(), fracs.tolist(), neg.tolist())
+        ]
+    return np.array(strings, dtype=str)[inverse]
+
+
+def base64_encode(values: np.ndarray, width: int) -> np.ndarray:
+    """
+    Encode the unsigned `values` as base64 strings of their little-endian
+    bytes, `ceil(width / 8)` bytes per number. The result is the same as
+    encoding each number with `base64.standard_b64encode`.
+    """
+    nbytes = -(-width // 8)
+    # Pad every number to whole groups of three bytes so that the numbers can
+    # be encoded at once. The padding encodes as `A`s which are replaced by
+    # `=` afterwards.
+    padded = -(-nbytes // 3) * 3
+    chars = padded // 3 * 4
+    # Only the first eight bytes of each number can be non-zero.
+    copied = min(nbytes, 8)
+    raw = np.zeros((len(values), padded), np.uint8)
+    raw[:, :copied] = values.astype("<u8").view(np.uint8).reshape(-1, 8)[:, :copied]
+    encoded = np.frombuffer(base64.standard_b64encode(raw.tobytes()), np.uint8)
+    encoded = encoded.reshape(len(values), chars).copy()
+    first_pad = chars - (padded - nbytes)
+    encoded[:, first_pad:] = ord("=")
+    return encoded.view(f"S{chars}").ravel().astype(str)
+
+
+def base64_decode(strings: List[str], width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode the base64 strings of little-endian numbers with at most `width`
+    bits. Returns the numbers and a mask of the strings that were decoded.
+    Strings of different lengths or with more bits are not decoded.
+    """
+    n = len(strings)
+    if not 0 < width <= MAX_WIDTH or n == 0:
+        return np.zeros(n, np.int64), np.zeros(n, bool)
+
+    arr = np.array(strings, dtype=bytes)
+    chars = arr.dtype.itemsize
+    if chars % 4 != 0 or np.char.str_len(arr).min() != chars:
+        return np.zeros(n, np.int64), np.zeros(n, bool)
+
+    # Decode the padding as zeros and drop the extra bytes afterwards.
+    text = np.frombuffer(arr.tobytes(), np.uint8).reshape(n, chars)
+    is_pad = text == ord("=")
+    pad = is_pad.sum(axis=1)
+    nbytes = chars // 4 * 3 - pad
+    try:
+        raw = base64.b64decode(
+            np.where(is_pad, ord("A"), text).astype(np.uint8).tobytes(),
+            validate=True,
+        )
+    except binascii.Error:
+        return np.zeros(n, np.int64), np.zeros(n, bool)
+    raw = np.frombuffer(raw, np.uint8).reshape(n, chars // 4 * 3)
+
+    # At most two padding characters at the end.
+    ok = (pad <= 2) & ~(is_pad[:, :-1] & ~is_pad[:, 1:]).any(axis=1)
+    values = np.zeros(n, np.int64)
+    for b in range(min(raw.shape[1], 8)):
+        values |= np.where(b < nbytes, raw[:, b].astype(np.int64), 0) << (8 * b)
+    # Bytes past the first eight must be zero.
+    high = (raw[:, 8:] != 0) & (np.arange(8, raw.shape[1]) < nbytes[:, None])
+    ok &= ~high.any(axis=1)
+    ok &= (values >= 0) & (values < (1 << width))
+    return np.where(ok, values, 0), ok
@@ -5,10 +5,14 @@ from math import log2
 from fractions import Fraction
 from dataclasses import dataclass
 from decimal import Decimal, getcontext
+from functools import lru_cache
 from fud.errors import InvalidNumericType
 import math
 import logging as log
 
+# Number of values remembered by `bitnum` and `fixed_point`.
+CACHE_SIZE = 1 << 14
+
 
 @dataclass
 class NumericType:
@@ -21,13 +25,23 @@ class NumericType:
     2. `width`: The bit width of the entire number.
     4. `is_signed`: The signed-ness of the number."""
 
+    __slots__ = (
+        "width",
+        "is_signed",
+        "string_repr",
+        "is_undef",
+        "bit_string_repr",
+        "hex_string_repr",
+        "uint_repr",
+    )
+
     width: int
     is_signed: bool
     string_repr: str
-    is_undef: bool = False
-    bit_string_repr: str = None
-    hex_string_repr: str = None
-    uint_repr: int = None
+    is_undef: bool
+    bit_string_repr: str
+    hex_string_repr: str
+    uint_repr: int
 
     def __init__(self, value: str, width: int, is_signed: bool):
         if not isinstance(value, str) or len(value) == 0:
@@ -44,6 +58,10 @@ class NumericType:
         value = value.strip()
         self.width = width
         self.is_signed = is_signed
+        self.is_undef = False
+        self.bit_string_repr = None
+        self.hex_string_repr = None
+        self.uint_repr = None
 
         stripped_prefix = value[2:] if value.startswith("0x") else value
         if any(digit == "x" for digit in stripped_prefix):
@@ -99,6 +117,8 @@ class NumericType:
 class Bitnum(NumericType):
     """Represents a two's complement bitnum."""
 
+    __slots__ = ()
+
     def __init__(self, value: str, width: int, is_signed: bool):
         super().__init__(value, width, is_signed)
 
@@ -110,7 +130,7 @@ class Bitnum(NumericType):
             self.uint_repr = int(self.bit_string_repr, 2)
             self.hex_string_repr = np.base_repr(self.uint_repr, 16)
 
-        if is_signed and self.uint_repr > (2 ** (width - 1)):
+        if is_signed and self.uint_repr >= (2 ** (width - 1)):
             negated_value = -1 * ((2**width) - self.uint_repr)
             self.string_repr = str(negated_value)
 
@@ -152,15 +172,19 @@ class FixedPoint(NumericType):
     the fixed point number. The fractional width is
     then inferred as `width - int_width`."""
 
-    int_width: int = None
-    frac_width: int = None
-    decimal_repr: Decimal = None
-    rational_repr: Fraction = None
+    __slots__ = ("int_width", "frac_width", "decimal_repr", "rational_repr")
+
+    int_width: int
+    frac_width: int
+    decimal_repr: Decimal
+    rational_repr: Fraction
 
     def __init__(self, value: str, width: int, int_width: int, is_signed: bool):
         super().__init__(value, width, is_signed)
         self.int_width = int_width
         self.frac_width = width - int_width
+        self.decimal_repr = None
+        self.rational_repr = None
         if int_width > width:
             raise InvalidNumericType(
                 f"width: {width} should be greater than the integer width: {int_width}."
@@ -188,7 +212,7 @@ class FixedPoint(NumericType):
 
         is_negative = self.is_signed and value.startswith("-")
         if is_negative:
-            self.decimal_repr *= -1
+            self.decimal_repr = self.decimal_repr.copy_negate()
             self.rational_repr *= -1
 
         int_partition, frac_partition = partition(self.decimal_repr, self.rational_repr)
@@ -227,7 +251,7 @@ has led to overflow.
 
         if is_negative:
             # Re-negate the decimal representation.
-            self.decimal_repr *= -1
+            self.decimal_repr = self.decimal_repr.copy_negate()
             self.rational_repr *= -1
             bits = self.__negate_twos_complement(bits)
 
@@ -326,3 +350,31 @@ def bitnum_to_fixed(bitnum: Bitnum, int_width: int) -> FixedPoint:
         int_width=int_width,
         is_signed=bitnum.is_signed,
     )
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _bitnum(value: str, width: int, is_signed: bool) -> Bitnum:
+    return Bitnum(value, width, is_signed)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _fixed_point(value: str, width: int, int_width: int, is_signed: bool):
+    return FixedPoint(value, width, int_width, is_signed)
+
+
+def bitnum(value: str, width: int, is_signed: bool) -> Bitnum:
+    """Like `Bitnum(value, width, is_signed)` but reuses the numbers
+    created for the last `CACHE_SIZE` distinct arguments. The returned
+    number is shared and must not be modified."""
+    if not isinstance(value, str):
+        return Bitnum(value, width, is_signed)
+    return _bitnum(value, width, is_signed)
+
+
+def fixed_point(value: str, width: int, int_width: int, is_signed: bool) -> FixedPoint:
+    """Like `FixedPoint(value, width, int_width, is_signed)` but reuses the
+    numbers created for the last `CACHE_SIZE` distinct arguments. The
+    returned number is shared and must not be modified."""
+    if not isinstance(value, str):
+        return FixedPoint(value, width, int_width, is_signed)
+    return _fixed_point(value, width, int_width, is_signed)
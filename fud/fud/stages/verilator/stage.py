@@ -1,16 +1,215 @@
 import simplejson as sjson
+import logging as log
+import os
 import re
+import shlex
+import shutil
+import sys
 from pathlib import Path
 
 from fud import errors
+from fud.cache import (
+    DEFAULT_MAX_SIZE,
+    BuildCache,
+    cache_location,
+    file_digest,
+    tool_fingerprint,
+)
+from fud.executor import record_objects
+from fud.objcache import COMPILED_OBJECTS, OBJECT_DIRS, read_log
 from fud.stages import Source, SourceType, Stage
-from fud.utils import TmpDir, shell
+from fud.utils import Directory, TmpDir, option_list, shell
 from fud import config as cfg
 
-from .json_to_dat import convert2dat, convert2json
+from .json_to_dat import convert2dat, convert2json, load_memories, memory_checksums
+from .testbench import (
+    Trace,
+    binary_testbench,
+    find_memories,
+    traced_testbench,
+    without_memory_dumps,
+    without_memory_loads,
+)
 
 VCD_FILE = "output.vcd"
 
+# Outputs that simulations can report.
+OUTPUTS = ["cycles", "memories", "checksums"]
+
+# Optimization levels of the C++ compiler.
+OPT_LEVELS = ["0", "1", "2", "3", "s"]
+
+MODULE = re.compile(r"^\s*module\s+(\w+)", re.MULTILINE)
+
+
+def data_format(config, stage):
+    """
+    The format of the memory files exchanged with the simulator of `stage`:
+    `dat` for text files or `bin` for the binary format.
+    """
+    fmt = config.get(["stages", stage, "data_format"]) or "dat"
+    if fmt not in ["dat", "bin"]:
+        raise errors.Malformed(
+            "Configuration",
+            f"stages.{stage}.data_format must be `dat' or `bin', not `{fmt}'",
+        )
+    return fmt
+
+
+def simulation_outputs(config, stage):
+    """
+    The outputs reported by simulating with `stage`: the number of cycles,
+    the contents of the memories, and the checksums of the memory files.
+    """
+    outputs = option_list(config.get(["stages", stage, "outputs"]))
+    unknown = [out for out in outputs if out not in OUTPUTS]
+    if unknown:
+        raise errors.Malformed(
+            "Configuration",
+            f"Unknown outputs {', '.join(unknown)} in stages.{stage}.outputs. "
+            f"Supported outputs: {', '.join(OUTPUTS)}",
+        )
+    return outputs or ["cycles", "memories"]
+
+
+def dumps_memories(outputs):
+    """Whether the simulator needs to dump the memories to report `outputs`."""
+    return "memories" in outputs or "checksums" in outputs
+
+
+def simulation_json(cycles, datadir, outputs):
+    """The JSON output of a simulation that ran for `cycles` cycles."""
+    data = {}
+    if "cycles" in outputs:
+        data["cycles"] = cycles
+    if "memories" in outputs:
+        data["memories"] = convert2json(datadir, "out")
+    if "checksums" in outputs:
+        data["checksums"] = memory_checksums(datadir, "out")
+    return data
+
+
+def trace_options(config, stage):
+    """
+    The parts of the simulation that `stage` traces into the VCD file, or
+    None to trace all of it.
+    """
+    scopes = option_list(config.get(["stages", stage, "trace_scopes"]))
+    start = config.get(["stages", stage, "trace_start"])
+    end = config.get(["stages", stage, "trace_end"])
+    if not scopes and start is None and end is None:
+        return None
+    return Trace(
+        scopes,
+        None if start is None else int(start),
+        None if end is None else int(end),
+    )
+
+
+def build_jobs(config, stage):
+    """
+    The number of C++ files that `stage` compiles in parallel. By default,
+    the CPUs are shared between the runs of fud that execute at the same
+    time.
+    """
+    jobs = config.get(["stages", stage, "build_jobs"])
+    if jobs is not None:
+        return int(jobs)
+    workers = getattr(config, "workers", 1)
+    return max((os.cpu_count() or 1) // workers, 1)
+
+
+def verilator_flags(config, stage):
+    """
+    Flags for Verilator's multithreaded model and the optimization level of
+    the C++ compiler. `threads` can be `auto` to use a thread per CPU.
+    """
+    flags = []
+    threads = config.get(["stages", stage, "threads"])
+    if threads == "auto":
+        threads = os.cpu_count() or 1
+    if threads is not None and int(threads) > 1:
+        flags += ["--threads", str(int(threads))]
+    opt_level = config.get(["stages", stage, "opt_level"])
+    if opt_level is not None:
+        if str(opt_level) not in OPT_LEVELS:
+            raise errors.Malformed(
+                "Configuration",
+                f"stages.{stage}.opt_level must be one of: {', '.join(OPT_LEVELS)}",
+            )
+        opt = f"-O{opt_level}"
+        flags += ["-MAKEFLAGS", f"'OPT_FAST={opt} OPT_SLOW={opt} OPT_GLOBAL={opt}'"]
+    return flags
+
+
+def objcache_command(config):
+    """
+    The command that Verilator's makefiles run the C++ compiler with to
+    reuse objects from the object cache of `fud`.
+    """
+    max_size = config.get(["cache", "max_size"]) or DEFAULT_MAX_SIZE
+    return shlex.join(
+        [
+            sys.executable,
+            "-m",
+            "fud.objcache",
+            str(cache_location(config) / COMPILED_OBJECTS),
+            str(int(max_size)),
+        ]
+    )
+
+
+def module_names(verilog_path):
+    """Names of the modules defined in the Verilog file at `verilog_path`."""
+    return sorted(set(MODULE.findall(Path(verilog_path).read_text())))
+
+
+def binary_memories(verilog_path):
+    """Names of the memories that the binary testbench loads."""
+    return {mem.name for mem in find_memories(Path(verilog_path).read_text())}
+
+
+def write_design(input_path, build_dir, dump, binary=False, copy=False):
+    """
+    Returns the design to compile. The design is copied to `build_dir`
+    without the dumps of its memories if they are not needed, and without
+    the loads and dumps of the memories that the testbench handles in the
+    binary format. With `copy`, the design is
+    always copied so that its path is the same for every build in
+    `build_dir`.
+    """
+    if dump and not binary and not copy:
+        return str(input_path)
+    src = Path(input_path).read_text()
+    if binary:
+        names = [mem.name for mem in find_memories(src)]
+        src = without_memory_loads(src, names)
+    if not dump:
+        src = without_memory_dumps(src)
+    elif binary:
+        src = without_memory_dumps(src, names)
+    out = Path(build_dir) / "design.sv"
+    out.write_text(src)
+    return str(out)
+
+
+def write_testbench(testbench, input_path, build_dir, binary, trace=None, dump=True):
+    """
+    Returns the testbench to compile `input_path` with. With the binary
+    format or a `Trace`, the testbench is generated in `build_dir`.
+    """
+    if not binary and trace is None:
+        return testbench
+    src = Path(testbench).read_text()
+    if binary:
+        memories = find_memories(Path(input_path).read_text())
+        src = binary_testbench(src, memories, dump)
+    if trace is not None:
+        src = traced_testbench(src, trace)
+    out = Path(build_dir) / "tb.sv"
+    out.write_text(src)
+    return str(out)
+
 
 class JsonToDat(Stage):
     name = "to-dat"
@@ -43,7 +242,7 @@ class JsonToDat(Stage):
             )
             convert2dat(
                 dir.name,
-                sjson.load(json, use_decimal=True),
+                load_memories(json),
                 "dat",
                 round_float_to_fixed,
             )
@@ -87,6 +286,7 @@ class DatToJson(Stage):
 
 class VerilatorStage(Stage):
     name = "verilog"
+    cacheable = True
 
     def __init__(self, mem, desc):
         super().__init__(
@@ -108,10 +308,41 @@ class VerilatorStage(Stage):
             "round_float_to_fixed",
             "cycle_limit",
             "file_extensions",
+            "reuse_build",
+            "data_format",
+            "trace_scopes",
+            "trace_start",
+            "trace_end",
+            "outputs",
+            "build_jobs",
+            "threads",
+            "opt_level",
+            "incremental",
         ]
 
+    def cache_inputs(self, config):
+        testbench = Path(config["global", cfg.ROOT]) / "fud" / "icarus" / "tb.sv"
+        inputs = super().cache_inputs(config)
+        # How the simulator is built doesn't change the outputs.
+        inputs["stage"] = {
+            k: v
+            for k, v in (inputs["stage"] or {}).items()
+            if k not in ("build_jobs", "reuse_build", "incremental")
+        }
+        return {
+            **inputs,
+            "data": file_digest(config.get(["stages", "verilog", "data"])),
+            "testbench": file_digest(testbench),
+        }
+
     def _define_steps(self, input_data, builder, config):
-        # Step 1: Make a new temporary directory
+        binary = data_format(config, self.name) == "bin"
+        trace = trace_options(config, self.name) if self.vcd else None
+        outputs = simulation_outputs(config, self.name)
+        # Memories are never read back from VCD simulations.
+        dump = dumps_memories(outputs) and not self.vcd
+
+        # Step 1: Make new temporary directories
         @builder.step()
         def mktmp() -> SourceType.Directory:
             """
@@ -119,6 +350,15 @@ class VerilatorStage(Stage):
             """
             return TmpDir()
 
+        @builder.step()
+        def mkdatadir() -> SourceType.Directory:
+            """
+            Make temporary directory to store the memory files of the design.
+            Kept separate from the build files so that the data can be
+            converted while the design compiles.
+            """
+            return TmpDir()
+
         # Step 2a: Dynamically retrieve the value of stages.verilog.data
         @builder.step(description="Dynamically retrieve the value of stages.verilog.data")
         def get_verilog_data() -> SourceType.Path:
@@ -140,7 +380,11 @@ class VerilatorStage(Stage):
 
         # Step 2: Transform data from JSON to Dat.
         @builder.step()
-        def json_to_dat(tmp_dir: SourceType.Directory, json_path: SourceType.Path):
+        def json_to_dat(
+            tmp_dir: SourceType.Directory,
+            json_path: SourceType.Path,
+            verilog_path: SourceType.Path,
+        ):
             """
             Converts a `json` data format into a series of `.dat` files inside the given
             temporary directory.
@@ -148,12 +392,14 @@ class VerilatorStage(Stage):
             round_float_to_fixed = config["stages", self.name, "round_float_to_fixed"]
             # if verilog.data was not given, do nothing
             if json_path.data:
-                convert2dat(
-                    tmp_dir.name,
-                    sjson.load(open(json_path.data), use_decimal=True),
-                    "dat",
-                    round_float_to_fixed,
-                )
+                with open(json_path.data, "rb") as f:
+                    convert2dat(
+                        tmp_dir.name,
+                        load_memories(f),
+                        "dat",
+                        round_float_to_fixed,
+                        binary_memories(verilog_path) if binary else (),
+                    )
 
         # Step 3: compile with verilator
         testbench_sv = str(
@@ -164,36 +410,110 @@ class VerilatorStage(Stage):
                 config["stages", self.name, "exec"],
                 "--trace",
                 "{input_path}",
-                testbench_sv,
+                "{testbench}",
                 "--binary",
                 "--top-module",
                 "TOP",  # The wrapper module name from `tb.sv`.
                 "--Mdir",
                 "{tmpdir_name}",
+                # Not part of the keys of builds since it doesn't change them.
+                "-j",
+                "{jobs}",
+                *verilator_flags(config, self.name),
                 "-fno-inline",
             ]
         )
 
+        def compile(input_path, build_dir, incremental=False):
+            testbench = write_testbench(
+                testbench_sv, input_path, build_dir, binary, trace, dump
+            )
+            return shell(
+                cmd.format(
+                    input_path=write_design(
+                        input_path, build_dir, dump, binary, incremental
+                    ),
+                    testbench=testbench,
+                    tmpdir_name=build_dir,
+                    jobs=build_jobs(config, self.name),
+                ),
+                stdout_as_debug=True,
+                env={"OBJCACHE": objcache_command(config)} if incremental else None,
+            )
+
         @builder.step(description=cmd)
         def compile_with_verilator(
             input_path: SourceType.Path, tmpdir: SourceType.Directory
         ) -> SourceType.Stream:
-            return shell(
-                cmd.format(input_path=str(input_path), tmpdir_name=tmpdir.name),
-                stdout_as_debug=True,
+            return compile(input_path, tmpdir.name)
+
+        # Step 3 (reuse_build == True): compile into a persistent build
+        # directory keyed by the design, unless it has been compiled before.
+        @builder.step(description=f"{cmd} (reusing earlier builds)")
+        def compile_or_reuse(input_path: SourceType.Path) -> SourceType.Directory:
+            """
+            Compile the design into a persistent build directory that is shared
+            by all runs of the same design, testbench, and compiler.
+            """
+            key = BuildCache.key(
+                design=file_digest(input_path),
+                testbench=file_digest(testbench_sv),
+                cmd=cmd,
+                tool=tool_fingerprint(config["stages", self.name, "exec"]),
+                data_format="bin" if binary else "dat",
+                trace=trace,
+                dump=dump,
             )
+            build = BuildCache.from_config(config).get_or_build(
+                key, lambda build_dir: compile(input_path, build_dir)
+            )
+            return Directory(str(build))
+
+        # Step 3 (incremental == True): compile in a persistent object
+        # directory, only compiling the C++ files that changed.
+        @builder.step(description=f"{cmd} (reusing unchanged objects)")
+        def compile_incrementally(
+            input_path: SourceType.Path, tmpdir: SourceType.Directory
+        ):
+            """
+            Compile the design in the persistent object directory shared by
+            the designs with the same modules. C++ files that are unchanged
+            since an earlier build reuse its objects.
+            """
+            name = BuildCache.key(
+                modules=module_names(input_path),
+                cmd=cmd,
+                tool=tool_fingerprint(config["stages", self.name, "exec"]),
+                data_format="bin" if binary else "dat",
+                trace=trace,
+                dump=dump,
+            )
+            objects = BuildCache.from_config(config, OBJECT_DIRS)
+            with objects.persistent(name) as build_dir:
+                # Forget the objects of interrupted builds.
+                read_log(build_dir)
+                compile(input_path, build_dir, incremental=True)
+                reused, compiled = read_log(build_dir)
+                # Simulate a copy so that other runs can use the directory.
+                shutil.copy2(build_dir / "VTOP", Path(tmpdir.name) / "VTOP")
+            log.info(f"Reused {reused} of {reused + compiled} objects")
+            record_objects(reused, compiled)
 
         # Step 4: simulate
         @builder.step()
-        def simulate(tmpdir: SourceType.Directory) -> SourceType.Stream:
+        def simulate(
+            builddir: SourceType.Directory,
+            tmpdir: SourceType.Directory,
+            datadir: SourceType.Directory,
+        ) -> SourceType.Stream:
             """
             Simulates compiled Verilator code.
             """
             cycle_limit = config["stages", self.name, "cycle_limit"]
             return shell(
                 [
-                    f"{tmpdir.name}/VTOP",
-                    f"+DATA={tmpdir.name}",
+                    f"{builddir.name}/VTOP",
+                    f"+DATA={datadir.name}",
                     f"+CYCLE_LIMIT={str(cycle_limit)}",
                     f"+OUT={tmpdir.name}/output.vcd",
                     f"+NOTRACE={0 if self.vcd else 1}",
@@ -214,7 +534,9 @@ class VerilatorStage(Stage):
         # Step 5(self.vcd == False): extract cycles + data
         @builder.step()
         def output_json(
-            simulated_output: SourceType.String, tmpdir: SourceType.Directory
+            simulated_output: SourceType.String,
+            tmpdir: SourceType.Directory,
+            datadir: SourceType.Directory,
         ) -> SourceType.Stream:
             """
             Convert .dat files back into a json and extract simulated cycles from log.
@@ -226,10 +548,8 @@ class VerilatorStage(Stage):
 
             # Look for output like: "Simulated 91 cycles"
             r = re.search(r"Simulated\s+((-)?\d+) cycles", simulated_output)
-            data = {
-                "cycles": int(r.group(1)) if r is not None else 0,
-                "memories": convert2json(tmpdir.name, "out"),
-            }
+            cycles = int(r.group(1)) if r is not None else 0
+            data = simulation_json(cycles, datadir.name, outputs)
 
             # Write to a file so we can return a stream.
             out = Path(tmpdir.name) / "output.json"
@@ -238,22 +558,34 @@ class VerilatorStage(Stage):
             return out.open("rb")
 
         @builder.step()
-        def cleanup(tmpdir: SourceType.Directory):
+        def cleanup(tmpdir: SourceType.Directory, datadir: SourceType.Directory):
             """
             Cleanup Verilator build files that we no longer need.
             """
             tmpdir.remove()
+            datadir.remove()
 
         # Schedule
         tmpdir = mktmp()
+        datadir = mkdatadir()
         data_path = get_verilog_data()
 
         # if we need to, convert dynamically sourced json to dat
         check_verilog_for_mem_read(input_data, data_path)
-        json_to_dat(tmpdir, data_path)
-
-        compile_with_verilator(input_data, tmpdir)
-        stdout = simulate(tmpdir)
-        result = output_vcd(tmpdir) if self.vcd else output_json(stdout, tmpdir)
-        cleanup(tmpdir)
+        json_to_dat(datadir, data_path, input_data)
+
+        if config.get(["stages", self.name, "reuse_build"]):
+            builddir = compile_or_reuse(input_data)
+        elif config.get(["stages", self.name, "incremental"]):
+            compile_incrementally(input_data, tmpdir)
+            builddir = tmpdir
+        else:
+            compile_with_verilator(input_data, tmpdir)
+            builddir = tmpdir
+        stdout = simulate(builddir, tmpdir, datadir)
+        if self.vcd:
+            result = output_vcd(tmpdir)
+        else:
+            result = output_json(stdout, tmpdir, datadir)
+        cleanup(tmpdir, datadir)
         return result
@@ -0,0 +1,253 @@
+"""Testbench variants for the binary memory format and selective tracing.
+
+Designs generated by Calyx load their external memories with `$readmemh`
+and dump them with `$writememh`. With the binary format, the testbench
+instead loads every memory from `<mem>.bin` with `$fread` and dumps it to
+`<mem>.out.bin` with `$fwrite`, and these calls are removed from the design.
+
+A binary memory file starts with a header of four little-endian 32-bit
+words: `BIN_MAGIC`, `BIN_VERSION`, the number of bytes per element, and the
+number of elements. The elements follow in row-major order. Each element is
+a little-endian number padded to a multiple of 32 bits, which is the layout
+that `$fwrite("%u")` produces.
+
+The testbench traces every signal of the `main` component into the VCD
+file. With selective tracing, it only traces the chosen instances and
+signals, optionally during a window of cycles.
+"""
+
+from typing import List, Optional
+
+import re
+from dataclasses import dataclass
+from math import prod
+
+from fud import errors
+
+# "FUDM" read as a little-endian 32-bit word.
+BIN_MAGIC = 0x4D445546
+BIN_VERSION = 1
+# Size of the header in bytes.
+BIN_HEADER_SIZE = 16
+
+
+def word_bytes(width: int) -> int:
+    """Number of bytes used by each element of a `width`-bit memory."""
+    return 4 * -(-width // 32)
+
+
+@dataclass
+class Memory:
+    """An external memory of the `main` component"""
+
+    # Name of the memory cell
+    name: str
+    # Path of the array inside the memory cell, e.g. `mem` or `mem.mem`
+    array: str
+    # Bit width of the elements
+    width: int
+    # Dimensions of the array
+    dims: List[int]
+
+    @property
+    def size(self) -> int:
+        return prod(self.dims)
+
+
+def find_memories(verilog_src: str) -> List[Memory]:
+    """
+    Find the external memories of the `main` component in the Verilog
+    generated by Calyx.
+    """
+    main = re.search(
+        r"^module main\b(.*?)^// COMPONENT END: main$", verilog_src, re.M | re.S
+    )
+    if main is None:
+        return []
+    body = main.group(1)
+
+    memories = []
+    for name, array in re.findall(
+        r'\$readmemh\(\{DATA, "/(\w+)\.dat"\}, \1\.([\w.]+)\);', body
+    ):
+        cell = re.search(rf"^\w+ # \((.*?)\) {name} \($", body, re.M | re.S)
+        if cell is None:
+            raise errors.Malformed(
+                "Verilog", f"Cannot find the definition of memory `{name}'"
+            )
+        params = {k: int(v) for k, v in re.findall(r"\.(\w+)\((\d+)\)", cell[1])}
+        dims = [params[f"D{i}_SIZE"] for i in range(4) if f"D{i}_SIZE" in params]
+        if "SIZE" in params:
+            dims = [params["SIZE"]]
+        # Memories with several dimensions that are backed by a flat array.
+        if "." in array:
+            dims = [prod(dims)]
+        memories.append(Memory(name, array, params["WIDTH"], dims))
+    return memories
+
+
+def _load_and_dump(mem: Memory, dump: bool) -> str:
+    nbytes = word_bytes(mem.width)
+    word = f"FUD_WORD_{mem.name}"
+    loaded = f"FUD_BIN_{mem.name}"
+    indices = "".join(f"[i{d}]" for d in range(len(mem.dims)))
+    element = f"main.{mem.name}.{mem.array}{indices}"
+
+    def loops(body: List[str]) -> List[str]:
+        lines = body
+        for d, size in reversed(list(enumerate(mem.dims))):
+            lines = (
+                [f"for (int i{d} = 0; i{d} < {size}; i{d}++) begin"]
+                + ["  " + line for line in lines]
+                + ["end"]
+            )
+        return ["    " + line for line in lines]
+
+    # `$fread` reads big-endian numbers. Reverse the bytes of each element.
+    swapped = ", ".join(f"{word}[{8 * b + 7}:{8 * b}]" for b in range(nbytes))
+    load = loops(
+        [
+            f"FUD_CODE = $fread({word}, FUD_FD);",
+            f"{word} = {{{swapped}}};",
+            f"{element} = {word}[{mem.width - 1}:0];",
+        ]
+    )
+    dump_loops = loops([f"{word} = {element};", f'$fwrite(FUD_FD, "%u", {word});'])
+    header = ", ".join(f"32'd{v}" for v in [BIN_MAGIC, BIN_VERSION, nbytes, mem.size])
+
+    lines = [
+        f"logic {loaded};",
+        f"logic [{8 * nbytes - 1}:0] {word};",
+        "initial begin",
+        '  FUD_CODE = $value$plusargs("DATA=%s", FUD_DATA);',
+        f'  FUD_FD = $fopen({{FUD_DATA, "/{mem.name}.bin"}}, "rb");',
+        f"  {loaded} = FUD_FD != 0;",
+        f"  if ({loaded}) begin",
+        f"    FUD_CODE = $fseek(FUD_FD, {BIN_HEADER_SIZE}, 0);",
+        *load,
+        "    $fclose(FUD_FD);",
+        "  end",
+        "end",
+    ]
+    if dump:
+        lines += [
+            "final begin",
+            f"  if ({loaded}) begin",
+            f'    FUD_FD = $fopen({{FUD_DATA, "/{mem.name}.out.bin"}}, "wb");',
+            f'    $fwrite(FUD_FD, "%u%u%u%u", {header});',
+            *dump_loops,
+            "    $fclose(FUD_FD);",
+            "  end",
+            "end",
+        ]
+    return "\n".join(lines)
+
+
+def binary_testbench(testbench: str, memories: List[Memory], dump: bool = True) -> str:
+    """
+    Add blocks that load and dump `memories` in the binary format to the
+    `TOP` module of `testbench`. Memories are only loaded unless `dump` is
+    set.
+    """
+    blocks = "\n".join(
+        [
+            "// Memories in the binary format. Generated by fud.",
+            "/* verilator lint_off WIDTH */",
+            "string FUD_DATA;",
+            "int FUD_FD;",
+            "int FUD_CODE;",
+        ]
+        + [_load_and_dump(mem, dump) for mem in memories]
+        + ["/* verilator lint_on WIDTH */", ""]
+    )
+    end = testbench.rindex("endmodule")
+    return testbench[:end] + blocks + testbench[end:]
+
+
+def _without_calls(
+    verilog_src: str, call: str, file: str, names: Optional[List[str]]
+) -> str:
+    if names == []:
+        return verilog_src
+    name = r"\w+" if names is None else "(?:" + "|".join(map(re.escape, names)) + ")"
+    return re.sub(
+        rf'^[ \t]*\${call}\(\{{DATA, "/{name}\.{file}"\}}, [\w.]+\);\n',
+        "",
+        verilog_src,
+        flags=re.M,
+    )
+
+
+def without_memory_dumps(verilog_src: str, names: Optional[List[str]] = None) -> str:
+    """
+    Remove the `$writememh` calls that dump the external memories of the
+    design generated by Calyx when the simulation ends. Only removes the
+    dumps of the memories in `names`, if it is given.
+    """
+    return _without_calls(verilog_src, "writememh", "out", names)
+
+
+def without_memory_loads(verilog_src: str, names: List[str]) -> str:
+    """
+    Remove the `$readmemh` calls that load the memories in `names` in the
+    design generated by Calyx, so that only the testbench loads them.
+    """
+    return _without_calls(verilog_src, "readmemh", "dat", names)
+
+
+@dataclass
+class Trace:
+    """The parts of a simulation traced into the VCD file"""
+
+    # Instances and signals of the `main` component to trace, e.g. `pe_0_0`
+    # or `pe_0_0.acc.out`. Everything is traced if it is empty.
+    scopes: List[str]
+    # First and last cycle to trace, counted like the simulated cycles.
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+
+# The call that traces the whole design in `tb.sv`.
+DUMP_ALL = "$dumpvars(0,main);"
+
+
+def traced_testbench(testbench: str, trace: Trace) -> str:
+    """
+    Restrict the VCD file written by `testbench` to the scopes and cycles
+    of `trace`.
+    """
+    if DUMP_ALL not in testbench:
+        raise errors.Malformed("Testbench", f"Cannot find `{DUMP_ALL}'")
+    for scope in trace.scopes:
+        if not re.fullmatch(r"[A-Za-z_][\w$]*(\.[A-Za-z_][\w$]*|\[\d+\])*", scope):
+            raise errors.Malformed(
+                "Configuration", f"`{scope}' is not the name of an instance or signal"
+            )
+
+    dump = " ".join(f"$dumpvars(0,main.{scope});" for scope in trace.scopes)
+    if trace.start:
+        # Start with tracing turned off.
+        dump = f"{dump or DUMP_ALL} $dumpoff;"
+    testbench = testbench.replace(DUMP_ALL, dump or DUMP_ALL)
+
+    # Cycle `i` starts when the cycle counter reaches RESET_CYCLES + 1 + i.
+    window = []
+    if trace.start:
+        window.append(f"if (cycle_count == RESET_CYCLES + {1 + trace.start}) $dumpon;")
+    if trace.end is not None:
+        window.append(f"if (cycle_count == RESET_CYCLES + {2 + trace.end}) $dumpoff;")
+    if not window:
+        return testbench
+    blocks = "\n".join(
+        [
+            "// Trace window. Generated by fud.",
+            "always @(posedge clk) begin",
+            "  if (NOTRACE == 0) begin",
+            *["    " + line for line in window],
+            "  end",
+            "end",
+            "",
+        ]
+    )
+    end = testbench.rindex("endmodule")
+    return testbench[:end] + blocks + testbench[end:]
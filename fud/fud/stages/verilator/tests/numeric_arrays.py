@@ -0,0 +1,204 @@
+from fud.stages.verilator.json_to_dat import (
+    convert,
+    convert2dat,
+    convert2json,
+    encode,
+    load_memories,
+    parse_dat,
+)
+import fud.stages.verilator.json_to_dat as json_to_dat
+from fud.stages.verilator.numeric_arrays import (
+    MAX_WIDTH,
+    base64_decode,
+    base64_encode,
+)
+from fud.stages.verilator.numeric_types import Bitnum, FixedPoint
+from fud.errors import InvalidNumericType
+from hypothesis import given, strategies as st  # type: ignore
+import numpy as np
+import pytest  # type: ignore
+from pathlib import Path
+import base64
+import io
+import simplejson as sjson  # type: ignore
+import tempfile
+
+
+def expected_dat(values, round, is_signed, width, int_width=None):
+    """Encode `values` one at a time."""
+    lines = [convert(v, round, is_signed, width, int_width) for v in values]
+    return "".join(line + "\n" for line in lines).encode("ascii")
+
+
+def check_encode(values, round, is_signed, width, int_width=None):
+    """The vectorized encoder agrees with the per-element encoder, including
+    on the values it rejects."""
+    arr = np.array(values, str)
+    try:
+        expected = expected_dat(arr, round, is_signed, width, int_width)
+    except (InvalidNumericType, ValueError) as e:
+        with pytest.raises(type(e)):
+            encode(arr, round, is_signed, width, int_width)
+        return
+    assert encode(arr, round, is_signed, width, int_width) == expected
+
+
+@given(
+    data=st.data(),
+    width=st.integers(min_value=1, max_value=70),
+    is_signed=st.booleans(),
+)
+def test_bitnum_encode(data, width, is_signed):
+    bound = 2 ** (width + 1)
+    values = data.draw(st.lists(st.integers(-bound, bound), max_size=20))
+    check_encode(values, False, is_signed, width)
+
+
+@given(
+    data=st.data(),
+    width=st.integers(min_value=1, max_value=64),
+    is_signed=st.booleans(),
+    round=st.booleans(),
+)
+def test_fixed_point_encode(data, width, is_signed, round):
+    int_width = data.draw(st.integers(min_value=0, max_value=width))
+    bound = 2 ** (int_width + 1)
+    values = data.draw(
+        st.lists(
+            st.decimals(-bound, bound, allow_nan=False, allow_infinity=False)
+            | st.floats(-bound, bound, allow_nan=False, allow_infinity=False)
+            | st.integers(-bound, bound).map(lambda i: i / 2**width),
+            max_size=20,
+        )
+    )
+    check_encode(values, round, is_signed, width, int_width)
+
+
+def test_encode_large_array():
+    """Arrays larger than a chunk are encoded in order."""
+    values = np.arange(-(2**17), 2**17)
+    lines = encode(values.astype(str), False, True, 32).decode("ascii").splitlines()
+    assert lines == [f"{v & 0xFFFFFFFF:X}" for v in values.tolist()]
+
+
+def expected_json(lines, width, is_signed, int_width=None):
+    """Decode `lines` one at a time."""
+    values = []
+    for line in lines:
+        if int_width is not None:
+            values.append(FixedPoint(f"0x{line}", width, int_width, is_signed))
+        else:
+            values.append(Bitnum(f"0x{line}", width, is_signed))
+    return [
+        int(v.str_value()) if int_width is None and not v.is_undef else v.str_value()
+        for v in values
+    ]
+
+
+def check_decode(lines, width, is_signed, int_width=None):
+    """The vectorized decoder agrees with the per-element decoder, including
+    on the values it rejects."""
+    args = {"width": width, "is_signed": is_signed}
+    if int_width is not None:
+        args["int_width"] = int_width
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "mem.out"
+        path.write_text("".join(line + "\n" for line in lines))
+        try:
+            expected = expected_json(lines, width, is_signed, int_width)
+        except Exception as e:
+            with pytest.raises(type(e)):
+                parse_dat(path, args)
+            return
+        assert parse_dat(path, args).tolist() == np.array(expected).tolist()
+
+
+@given(
+    data=st.data(),
+    width=st.integers(min_value=1, max_value=70),
+    is_signed=st.booleans(),
+    fixed_point=st.booleans(),
+)
+def test_decode(data, width, is_signed, fixed_point):
+    int_width = None
+    if fixed_point:
+        int_width = data.draw(st.integers(min_value=1, max_value=width))
+    values = st.integers(0, 2 ** (width + 1)).map(lambda v: f"{v:X}")
+    undef = st.just("x" * ((width + 3) // 4))
+    lines = data.draw(st.lists(values | undef, max_size=20))
+    check_decode(lines, width, is_signed, int_width)
+
+
+def test_decode_round_trip():
+    """Decoding the encoded values returns the original values."""
+    values = np.arange(-(2**15), 2**15)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "mem.out"
+        path.write_bytes(encode(values.astype(str), False, True, 17))
+        decoded = parse_dat(path, {"width": 17, "is_signed": True})
+    assert decoded.tolist() == values.tolist()
+
+
+@given(
+    data=st.data(),
+    width=st.integers(min_value=1, max_value=100),
+    is_signed=st.booleans(),
+)
+def test_binary_round_trip(data, width, is_signed):
+    """Memories written in the binary format are read back unchanged."""
+    low = -(2 ** (width - 1)) if is_signed else 0
+    high = 2 ** (width - 1) - 1 if is_signed else 2**width - 1
+    values = data.draw(st.lists(st.integers(low, high), min_size=1, max_size=20))
+    mem = {
+        "data": values,
+        "format": {"numeric_type": "bitnum", "is_signed": is_signed, "width": width},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        convert2dat(tmp, {"mem": mem}, "dat", False, {"mem"})
+        assert Path(tmp, "mem.dat").read_bytes() == b""
+        # Simulators write the memory back to `mem.out.bin`.
+        Path(tmp, "mem.bin").rename(Path(tmp, "mem.out.bin"))
+        assert convert2json(tmp, "out") == {"mem": values}
+
+
+json_values = st.recursive(
+    st.none()
+    | st.booleans()
+    | st.integers()
+    | st.decimals(allow_nan=False, allow_infinity=False)
+    | st.text(),
+    lambda children: st.lists(children) | st.dictionaries(st.text(), children),
+    max_leaves=20,
+)
+
+
+@given(
+    memories=st.dictionaries(st.text(), json_values, max_size=5),
+    read_size=st.integers(min_value=1, max_value=64),
+    indent=st.none() | st.integers(0, 2),
+)
+def test_load_memories(memories, read_size, indent):
+    """Memories are read one at a time like `sjson.load` reads them."""
+    text = sjson.dumps(memories, indent=indent, use_decimal=True).encode()
+    expected = list(sjson.loads(text, use_decimal=True).items())
+    json_to_dat.READ_SIZE, old = read_size, json_to_dat.READ_SIZE
+    try:
+        assert list(load_memories(io.BytesIO(text))) == expected
+    finally:
+        json_to_dat.READ_SIZE = old
+
+
+@given(data=st.data(), width=st.integers(min_value=1, max_value=100))
+def test_base64(data, width):
+    """Base64 encoding agrees with encoding the bytes of each value."""
+    values = data.draw(st.lists(st.integers(0, 2**width - 1), max_size=20))
+    nbytes = -(-width // 8)
+    expected = [
+        base64.standard_b64encode(v.to_bytes(nbytes, "little")).decode("ascii")
+        for v in values
+    ]
+    if width <= MAX_WIDTH:
+        assert base64_encode(np.array(values, np.int64), width).tolist() == expected
+    decoded, ok = base64_decode(np.array(expected, str), width)
+    assert ok.all() == (width <= MAX_WIDTH or not values)
+    assert decoded[ok].tolist() == [v for v, o in zip(values, ok) if o]
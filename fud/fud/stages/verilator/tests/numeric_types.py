@@ -1,5 +1,10 @@
 from random import randint
-from fud.stages.verilator.numeric_types import FixedPoint, Bitnum
+from fud.stages.verilator.numeric_types import (
+    FixedPoint,
+    Bitnum,
+    bitnum,
+    fixed_point,
+)
 from fud.errors import InvalidNumericType
 from hypothesis import given, strategies as st  # type: ignore
 import numpy as np
@@ -124,3 +129,17 @@ def test_non_string_initialization():
         Bitnum(16, 5, False)
     with pytest.raises(InvalidNumericType, match=r"string"):
         FixedPoint(0.5, 2, 1, False)
+
+
+def test_memoized_construction():
+    """The factories return shared numbers equal to the constructed ones."""
+    assert bitnum("-3", 8, True) is bitnum("-3", 8, True)
+    assert bitnum("-3", 8, True) == Bitnum("-3", 8, True)
+    assert bitnum("0xFD", 8, True) == Bitnum("0xFD", 8, True)
+    assert fixed_point("0.5", 8, 4, False) is fixed_point("0.5", 8, 4, False)
+    assert fixed_point("0.5", 8, 4, False) == FixedPoint("0.5", 8, 4, False)
+    assert fixed_point("0.5", 8, 4, False) != fixed_point("0.5", 8, 4, True)
+    with pytest.raises(InvalidNumericType, match=r"overflow"):
+        bitnum("256", 8, False)
+    with pytest.raises(InvalidNumericType, match=r"string"):
+        fixed_point(0.5, 2, 1, False)
@@ -0,0 +1,102 @@
+from fud.errors import Malformed
+from fud.stages.verilator.testbench import (
+    DUMP_ALL,
+    Memory,
+    Trace,
+    binary_testbench,
+    traced_testbench,
+    without_memory_dumps,
+    without_memory_loads,
+)
+from fud.stages.verilator.stage import write_design
+from pathlib import Path
+import pytest  # type: ignore
+
+TESTBENCH = (Path(__file__).parents[4] / "icarus" / "tb.sv").read_text()
+
+
+def test_trace_scopes():
+    """Only the chosen scopes are traced."""
+    tb = traced_testbench(TESTBENCH, Trace(["pe_0_0", "pe_0_1.acc.out"]))
+    assert DUMP_ALL not in tb
+    assert "$dumpvars(0,main.pe_0_0); $dumpvars(0,main.pe_0_1.acc.out);" in tb
+    assert "$dumpon" not in tb and "$dumpoff" not in tb
+
+
+def test_trace_window():
+    """Tracing starts turned off and is turned on and off by the window."""
+    tb = traced_testbench(TESTBENCH, Trace([], 3, 10))
+    assert f"{DUMP_ALL} $dumpoff;" in tb
+    assert "if (cycle_count == RESET_CYCLES + 4) $dumpon;" in tb
+    assert "if (cycle_count == RESET_CYCLES + 12) $dumpoff;" in tb
+    assert tb.rstrip().endswith("endmodule")
+
+
+def test_trace_invalid_scope():
+    with pytest.raises(Malformed):
+        traced_testbench(TESTBENCH, Trace(["main); $finish; //"]))
+
+
+def test_without_memory_dumps():
+    """Memories are still loaded but no longer dumped."""
+    design = "\n".join(
+        [
+            "initial begin",
+            '  $readmemh({DATA, "/mem.dat"}, mem.mem);',
+            "end",
+            "final begin",
+            '  $writememh({DATA, "/mem.out"}, mem.mem);',
+            "end",
+            "",
+        ]
+    )
+    assert without_memory_dumps(design) == design.replace(
+        '  $writememh({DATA, "/mem.out"}, mem.mem);\n', ""
+    )
+    mem = Memory("mem", "mem", 32, [4])
+    assert "$fwrite" in binary_testbench(TESTBENCH, [mem])
+    tb = binary_testbench(TESTBENCH, [mem], dump=False)
+    assert "$fread" in tb and "$fwrite" not in tb
+
+
+def test_without_memory_loads():
+    """Only the loads of the chosen memories are removed."""
+    load = '  $readmemh({DATA, "/%s.dat"}, %s.mem);\n'
+    design = "initial begin\n" + load % ("a", "a") + load % ("b", "b") + "end\n"
+    assert without_memory_loads(design, ["a"]) == design.replace(load % ("a", "a"), "")
+    assert without_memory_loads(design, []) == design
+
+
+def test_binary_design_without_text_memories(tmp_path):
+    """Designs compiled for the binary format don't load or dump memories as
+    text, so the testbench is the only one to initialize them."""
+    design = "\n".join(
+        [
+            "module main (",
+            ");",
+            "std_mem_d1 # (",
+            "    .WIDTH(32),",
+            "    .SIZE(4),",
+            "    .IDX_SIZE(3)",
+            ") mem (",
+            ");",
+            "initial begin",
+            '  $readmemh({DATA, "/mem.dat"}, mem.mem);',
+            "end",
+            "final begin",
+            '  $writememh({DATA, "/mem.out"}, mem.mem);',
+            "end",
+            "endmodule",
+            "// COMPONENT END: main",
+            "",
+        ]
+    )
+    input = tmp_path / "design.v"
+    input.write_text(design)
+    build = tmp_path / "build"
+    build.mkdir()
+    assert write_design(input, build, dump=True) == str(input)
+    written = Path(write_design(input, build, dump=True, binary=True)).read_text()
+    assert "$readmemh" not in written and "$writememh" not in written
+    written = Path(write_design(input, build, dump=False, binary=True)).read_text()
+    assert "$readmemh" not in written and "$writememh" not in written
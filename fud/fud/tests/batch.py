@@ -0,0 +1,65 @@
+from argparse import Namespace
+import copy
+import json
+import os
+
+import pytest  # type: ignore
+
+import fud.batch as batch
+from fud.batch import BatchRunner, Job
+from fud.config import DEFAULT_CONFIGURATION, DynamicDict
+from fud.stages.verilator.stage import build_jobs
+
+
+def test_unexpected_errors_fail_the_job(tmp_path, monkeypatch):
+    """Any error raised by a job is reported in its summary."""
+
+    def execute(conf, config, path):
+        raise ValueError("bad value")
+
+    monkeypatch.setattr(batch, "execute", execute)
+    args = Namespace(
+        source="a",
+        dest="b",
+        through=[],
+        data_key="verilog.data",
+        out_dir=str(tmp_path),
+        step_jobs=1,
+    )
+    runner = BatchRunner(args, config=None)
+    runner.path = lambda input_file: []
+    result = runner.run(Job("job", str(tmp_path / "input")))
+    assert result["status"] == "failed"
+    assert result["error"] == "ValueError: bad value"
+
+
+@pytest.mark.parametrize(
+    "jobs, configured, expected", [(1, None, 8), (2, None, 4), (3, None, 2), (2, 8, 8)]
+)
+def test_jobs_share_cpus(tmp_path, monkeypatch, jobs, configured, expected):
+    """The jobs of a batch share the CPUs to build their simulators, unless
+    the number of build jobs is configured."""
+
+    def execute(conf, config, path):
+        return None, {"build_jobs": build_jobs(config, "verilog")}
+
+    monkeypatch.setattr(batch, "execute", execute)
+    monkeypatch.setattr(BatchRunner, "path", lambda self, input_file: [])
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    config = DynamicDict(copy.deepcopy(DEFAULT_CONFIGURATION))
+    config["stages", "verilog", "build_jobs"] = configured
+    args = Namespace(
+        inputs=[str(tmp_path / f"{i}.futil") for i in range(jobs)],
+        manifest=None,
+        data_suffix=None,
+        source="a",
+        dest="b",
+        through=[],
+        data_key="verilog.data",
+        out_dir=str(tmp_path / "out"),
+        step_jobs=1,
+        jobs=jobs,
+    )
+    batch.run_batch(args, config)
+    results = json.loads((tmp_path / "out" / "summary.json").read_text())
+    assert [res["steps"]["build_jobs"] for res in results] == [expected] * jobs
@@ -0,0 +1,93 @@
+from fud.cache import BuildCache, ResultCache, import_digests
+from fud.config import DEFAULT_CONFIGURATION, DynamicDict
+from fud.stages.verilator.stage import VerilatorStage
+from pathlib import Path
+import copy
+import os
+
+import pytest  # type: ignore
+
+
+def test_import_closure(tmp_path):
+    """Programs depend on the files they import, directly or indirectly."""
+    lib = tmp_path / "primitives"
+    lib.mkdir()
+    (lib / "core.futil").write_text('import "compile.futil";\nextern "core.sv" {}')
+    (lib / "compile.futil").write_text("")
+    (lib / "core.sv").write_text("module std_reg;")
+    program = b'import "primitives/core.futil";\nimport "missing.futil";'
+
+    before = import_digests(program, [str(tmp_path)])
+    assert set(before) == {
+        str(lib / name) for name in ["core.futil", "compile.futil", "core.sv"]
+    } | {"missing.futil"}
+    assert before["missing.futil"] is None
+
+    Path(lib / "core.sv").write_text("module std_reg; endmodule")
+    after = import_digests(program, [tmp_path])
+    assert after[str(lib / "core.sv")] != before[str(lib / "core.sv")]
+
+
+def test_build_options_not_in_key(tmp_path):
+    """Options that only change how the simulator is built share outputs."""
+    config = DynamicDict(copy.deepcopy(DEFAULT_CONFIGURATION))
+    config["global", "root"] = str(tmp_path)
+    stage = VerilatorStage("dat", "")
+    cache = ResultCache(tmp_path / "cache")
+    key = cache.key(stage, config, b"module main;")
+    for option in ["reuse_build", "incremental", "build_jobs"]:
+        config["stages", "verilog", option] = 2
+        assert cache.key(stage, config, b"module main;") == key
+    config["stages", "verilog", "cycle_limit"] = 2
+    assert cache.key(stage, config, b"module main;") != key
+
+
+def test_builds_are_reused(tmp_path):
+    """Each build runs once and is reused by later runs with the same key."""
+    builds = BuildCache(tmp_path)
+    calls = []
+
+    def build(build_dir):
+        calls.append(build_dir)
+        (Path(build_dir) / "VTOP").write_text(str(len(calls)))
+
+    key = BuildCache.key(design="a", trace=False)
+    assert BuildCache.key(trace=False, design="a") == key
+    first = builds.get_or_build(key, build)
+    assert builds.get_or_build(key, build) == first
+    assert (first / "VTOP").read_text() == "1"
+    assert len(calls) == 1
+
+    other = builds.get_or_build(BuildCache.key(design="a", trace=True), build)
+    assert other != first
+    assert len(calls) == 2
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_failed_builds_are_not_kept(tmp_path):
+    """A build that fails leaves nothing behind, so the next run rebuilds."""
+    builds = BuildCache(tmp_path)
+
+    def fail(build_dir):
+        (Path(build_dir) / "partial.o").write_text("")
+        raise OSError("compiler crashed")
+
+    with pytest.raises(OSError):
+        builds.get_or_build("key", fail)
+    assert list(tmp_path.iterdir()) == []
+    path = builds.get_or_build("key", lambda build_dir: None)
+    assert not (path / "partial.o").exists()
+
+
+def test_least_recently_used_builds_are_evicted(tmp_path):
+    """Only the `max_builds` most recently used builds are kept."""
+    builds = BuildCache(tmp_path, max_builds=2)
+    a = builds.get_or_build("a", lambda build_dir: None)
+    b = builds.get_or_build("b", lambda build_dir: None)
+    os.utime(a, ns=(1, 1))
+    os.utime(b, ns=(2, 2))
+    # Reusing `a` makes `b` the least recently used build.
+    builds.get_or_build("a", lambda build_dir: None)
+    builds.get_or_build("c", lambda build_dir: None)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a", "c"]
+    assert builds.stats()["builds"] == 2
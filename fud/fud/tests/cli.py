@@ -0,0 +1,185 @@
+from pathlib import Path
+import json
+import os
+import subprocess
+import sys
+
+import pytest  # type: ignore
+import toml
+
+# A Calyx compiler that copies its input to its output. It records every
+# time it runs in `calls`, exits with status 3 on inputs that contain `fail`,
+# and takes half a second on inputs that contain `slow`.
+CALYX = f"""#!{sys.executable}
+import sys, time
+source = sys.stdin.read()
+if "slow" in source:
+    time.sleep(0.5)
+with open({{calls!r}}, "a") as f:
+    f.write("calyx\\n")
+if "fail" in source:
+    print("failed to compile", file=sys.stderr)
+    sys.exit(3)
+sys.stdout.write(source)
+"""
+
+
+class Fud:
+    """Runs the fud command line with its configuration in `tmp`."""
+
+    def __init__(self, tmp: Path):
+        self.tmp = tmp
+        self.calls = tmp / "calls"
+        calyx = tmp / "bin" / "calyx"
+        calyx.parent.mkdir()
+        calyx.write_text(CALYX.format(calls=str(self.calls)))
+        calyx.chmod(0o755)
+        self.config = {
+            "global": {"root": str(tmp)},
+            "cache": {"enabled": True, "location": str(tmp / "cache")},
+            "stages": {"calyx": {"exec": str(calyx)}},
+        }
+
+    def ncalls(self) -> int:
+        """The number of times the tools ran since the last call."""
+        if not self.calls.exists():
+            return 0
+        n = len(self.calls.read_text().splitlines())
+        self.calls.unlink()
+        return n
+
+    def __call__(self, *argv, input=None, cwd=None, check=True):
+        config = self.tmp / "config" / "fud" / "config.toml"
+        config.parent.mkdir(parents=True, exist_ok=True)
+        config.write_text(toml.dumps(self.config))
+        env = {
+            **os.environ,
+            "XDG_CONFIG_HOME": str(self.tmp / "config"),
+            "PYTHONPATH": str(Path(__file__).parents[2]),
+        }
+        env.pop("FUD_SERVER", None)
+        proc = subprocess.run(
+            [sys.executable, "-c", "from fud.main import main; main()", *argv],
+            input=input,
+            cwd=cwd or self.tmp,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if check:
+            assert proc.returncode == 0, proc.stderr
+        return proc
+
+
+@pytest.fixture
+def fud(tmp_path):
+    return Fud(tmp_path)
+
+
+def test_cache_stdin(fud):
+    """Programs read from the standard input are cached."""
+    argv = ["exec", "--from", "calyx", "--to", "verilog", "-q"]
+    for _ in range(2):
+        output = fud(*argv, input="component main() {}").stdout
+        assert output.strip() == "component main() {}"
+    assert fud.ncalls() == 1
+
+
+def test_cache_imports_next_to_program(fud):
+    """Editing a file imported by a program invalidates its cached outputs,
+    wherever fud runs from."""
+    prog = fud.tmp / "dir" / "main.futil"
+    prog.parent.mkdir()
+    prog.write_text('import "x.futil";')
+    (prog.parent / "x.futil").write_text("component x() {}")
+    elsewhere = fud.tmp / "elsewhere"
+    elsewhere.mkdir()
+    argv = ["exec", str(prog), "--to", "verilog", "-q"]
+    fud(*argv, cwd=elsewhere)
+    fud(*argv, cwd=elsewhere)
+    assert fud.ncalls() == 1
+    (prog.parent / "x.futil").write_text("component y() {}")
+    fud(*argv, cwd=elsewhere)
+    assert fud.ncalls() == 1
+
+
+def test_profile_streamed_output(fud):
+    """The final output is read before reporting a profiled execution, so
+    its failures are reported and the time its tool ran is profiled."""
+    argv = ["exec", "--from", "calyx", "--to", "verilog", "--no-cache", "-q"]
+    for profile in [["-pr"], ["--profile-json", "profile.json"]]:
+        proc = fud(*argv, *profile, input="fail", check=False)
+        assert proc.returncode != 0
+        assert "failed to compile" in proc.stderr
+
+    report = fud(*argv, "-pr", "-csv", input="slow").stdout
+    durations = dict(line.split(",") for line in report.split())
+    assert float(durations["calyx.run_futil"]) >= 0.5
+
+
+def test_profile_json_and_trace(fud):
+    """The profile summary and the trace nest the tools under the steps that
+    started them, and are written for runs that fail."""
+    argv = ["exec", "--from", "calyx", "--to", "verilog", "--no-cache", "-q"]
+    argv += ["--profile-json", "profile.json", "--trace", "trace.json"]
+    fud(*argv, input="slow")
+    summary = json.loads((fud.tmp / "profile.json").read_text())
+    [stage] = summary["stages"]
+    assert stage["name"] == "calyx"
+    [step] = stage["steps"]
+    assert step["name"] == "calyx.run_futil"
+    [process] = step["processes"]
+    assert process["name"].startswith(fud.config["stages"]["calyx"]["exec"])
+    assert 0.5 <= process["duration"] <= step["duration"] <= summary["duration"]
+    assert "user_cpu" in process and "max_rss_kb" in process
+
+    events = json.loads((fud.tmp / "trace.json").read_text())["traceEvents"]
+    spans = {e["cat"]: e for e in events if e["ph"] == "X"}
+    assert spans.keys() == {"stage", "step", "process"}
+    assert spans["stage"]["tid"] == 0
+    assert spans["step"]["tid"] == spans["process"]["tid"] != 0
+    assert spans["step"]["ts"] <= spans["process"]["ts"]
+    assert spans["process"]["dur"] >= 0.5e6
+
+    fud(*argv, input="fail", check=False)
+    summary = json.loads((fud.tmp / "profile.json").read_text())
+    [process] = summary["stages"][0]["steps"][0]["processes"]
+    assert process["failed"]
+    events = json.loads((fud.tmp / "trace.json").read_text())["traceEvents"]
+    assert any(e["args"].get("failed") for e in events if e["ph"] == "X")
+
+
+def test_profile_memory(fud):
+    """Memory profiles report the usage of every step, including the memory
+    used by tools that stream their output."""
+    argv = ["exec", "--from", "calyx", "--to", "verilog", "--no-cache", "-q"]
+    argv += ["--profile-memory", "-pr"]
+    header, row = fud(*argv, input="component main() {}").stdout.splitlines()
+    assert header.split("  ")[0] == "step"
+    assert "heap peak (MB)" in header and "max rss (MB)" in header
+    assert row.split()[0] == "calyx.run_futil"
+
+    [row] = fud(*argv, "-csv", input="component main() {}").stdout.split()
+    step, _, heap, rss, read, written = row.split(",")
+    assert step == "calyx.run_futil"
+    assert float(heap) > 0 and float(rss) > 0
+
+    fud(*argv, "--profile-json", "profile.json", input="component main() {}")
+    summary = json.loads((fud.tmp / "profile.json").read_text())
+    [step] = summary["stages"][0]["steps"]
+    [process] = step["processes"]
+    assert step["heap_peak_bytes"] > 0
+    assert step["max_rss_kb"] == process["max_rss_kb"] > 0
+
+
+def test_async_matches_sequential(fud):
+    """The asyncio engine produces the same outputs as sequential runs."""
+    prog = fud.tmp / "prog.futil"
+    prog.write_text("component main() {}")
+    vcd = Path(__file__).parent / "fixtures" / "counter.vcd"
+    for argv in [[str(prog), "--to", "verilog"], [str(vcd), "--to", "vcd_json"]]:
+        argv = ["exec", *argv, "--no-cache", "-q"]
+        expected = fud(*argv).stdout
+        assert expected
+        for engine in [["--async"], ["--async", "-j", "4"]]:
+            assert fud(*argv, *engine).stdout == expected
@@ -0,0 +1,94 @@
+from fud.executor import Profiler
+from fud.stages import ComputationGraph, Source, SourceType, plan_conversion
+from fud.utils import NamedOutput
+from hypothesis import given, strategies as st  # type: ignore
+from io import BytesIO
+from pathlib import Path
+import pytest  # type: ignore
+import tempfile
+
+# Source types that hold the contents of a file.
+FILE_TYPES = [SourceType.Path, SourceType.Stream, SourceType.String, SourceType.Bytes]
+
+
+def make_source(typ, text, tmp):
+    if typ == SourceType.Path:
+        path = Path(tmp) / "input"
+        path.write_bytes(text.encode())
+        return Source.path(path)
+    if typ == SourceType.Stream:
+        return Source(BytesIO(text.encode()), typ)
+    if typ == SourceType.String:
+        return Source(text, typ)
+    return Source(text.encode(), typ)
+
+
+def contents(source):
+    if source.typ == SourceType.Path:
+        return source.data.read_bytes().decode()
+    if source.typ == SourceType.Stream:
+        return source.data.read().decode()
+    if source.typ == SourceType.Bytes:
+        return source.data.decode()
+    return source.data
+
+
+@pytest.mark.parametrize("src", FILE_TYPES)
+@pytest.mark.parametrize("dst", FILE_TYPES)
+@given(text=st.text())
+def test_convert(src, dst, text):
+    """Converting between file types preserves the contents."""
+    with tempfile.TemporaryDirectory() as tmp:
+        assert contents(make_source(src, text, tmp).convert_to(dst)) == text
+
+
+def test_plan():
+    """Conversions take the cheapest chain and don't go through streams."""
+    names = {
+        (src, dst): [f.__name__ for f in plan_conversion(src, dst)]
+        for src in FILE_TYPES
+        for dst in FILE_TYPES
+        if src != dst
+    }
+    assert names[SourceType.String, SourceType.Stream] == [
+        "string_to_bytes",
+        "bytes_to_stream",
+    ]
+    assert names[SourceType.String, SourceType.Path] == [
+        "string_to_bytes",
+        "bytes_to_path",
+    ]
+    assert names[SourceType.Path, SourceType.String] == [
+        "path_to_bytes",
+        "bytes_to_string",
+    ]
+    assert names[SourceType.Stream, SourceType.Path] == ["stream_to_path"]
+    # Temporary files are not directories.
+    assert plan_conversion(SourceType.Stream, SourceType.Directory) is None
+
+
+def test_count_conversions():
+    """Profiled steps count their conversions and the bytes they copy."""
+    profiler = Profiler("step")
+    profiler.start()
+    Source("abc", SourceType.String).convert_to(SourceType.Stream)
+    profiler.end()
+    assert profiler.span.args["conversions"] == 2
+    assert profiler.span.args["copied_bytes"] == 3
+
+
+def test_hand_over_named_output():
+    """Unread named outputs are handed to path consumers without copying."""
+    out = NamedOutput()
+    out.write(b"abc")
+    out.seek(0)
+    graph = ComputationGraph(SourceType.Stream, SourceType.Path)
+    profiler = Profiler("step")
+    profiler.start()
+    path = graph.convert(Source(out, SourceType.Stream), SourceType.Path).data
+    profiler.end()
+    assert path == out.path
+    assert "copied_bytes" not in profiler.span.args
+    assert path.read_bytes() == b"abc"
+    graph.cleanup()
+    assert not path.exists()
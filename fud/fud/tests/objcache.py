@@ -0,0 +1,69 @@
+from fud.cache import ResultCache
+from fud.objcache import read_log, run
+from pathlib import Path
+import os
+import sys
+import tempfile
+
+# A compiler that preprocesses by printing the source and compiles by
+# copying it. It counts the files it compiles in `compiled`.
+COMPILER = f"""#!{sys.executable}
+import sys
+args = sys.argv[1:]
+source = open(args[-1]).read()
+if "-E" in args:
+    print(source)
+    sys.exit(0)
+if "fail" in source:
+    sys.exit(1)
+out = args[args.index("-o") + 1]
+open(out, "w").write("object of " + source)
+open(out[: -len(".o")] + ".d", "w").write(out + ": " + args[-1])
+open("compiled", "a").write(args[-1] + "\\n")
+"""
+
+
+def build(tmp, sources):
+    """Compile `sources` with the cache in `tmp`. Returns the files compiled."""
+    cache = ResultCache(Path(tmp, "cache"))
+    compiler = Path(tmp, "cc")
+    # Changes to the compiler invalidate the objects it compiled.
+    if not compiler.exists():
+        compiler.write_text(COMPILER)
+        compiler.chmod(0o755)
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        for name, src in sources.items():
+            Path(f"{name}.cpp").write_text(src)
+            args = [str(compiler), "-MMD", "-c", "-o", f"{name}.o", f"{name}.cpp"]
+            assert run(cache, args) == (1 if "fail" in src else 0)
+        compiled = Path("compiled")
+        names = compiled.read_text().split() if compiled.exists() else []
+        compiled.unlink(missing_ok=True)
+        return names
+    finally:
+        os.chdir(cwd)
+
+
+def test_reuse_unchanged_objects():
+    """Only the files that changed since the last build are compiled."""
+    with tempfile.TemporaryDirectory() as tmp:
+        assert build(tmp, {"a": "int a;", "b": "int b;"}) == ["a.cpp", "b.cpp"]
+        assert read_log(tmp) == (0, 2)
+        Path(tmp, "a.o").unlink()
+        Path(tmp, "a.d").unlink()
+        assert build(tmp, {"a": "int a;", "b": "int c;"}) == ["b.cpp"]
+        assert read_log(tmp) == (1, 1)
+        assert Path(tmp, "a.o").read_text() == "object of int a;"
+        assert Path(tmp, "a.d").read_text() == "a.o: a.cpp"
+        assert Path(tmp, "b.o").read_text() == "object of int c;"
+
+
+def test_failed_compilations_are_not_cached():
+    """Files that fail to compile are compiled again."""
+    with tempfile.TemporaryDirectory() as tmp:
+        build(tmp, {"a": "fail"})
+        build(tmp, {"a": "fail"})
+        assert read_log(tmp) == (0, 0)
+        assert build(tmp, {"a": "int a;"}) == ["a.cpp"]
@@ -0,0 +1,177 @@
+from fud.registry import LazyStage, Registry
+from fud.errors import MultiplePaths, NoPathFound
+from fud.main import register_stages
+from hypothesis import given, settings, strategies as st  # type: ignore
+import pytest  # type: ignore
+import os
+import subprocess
+import sys
+import tempfile
+
+
+class Stage:
+    def __init__(self, name, src_state, target_state):
+        self.name = name
+        self.src_state = src_state
+        self.target_state = target_state
+        self.description = name
+
+
+class Config:
+    def __init__(self, priorities, location, cache=True):
+        self.priorities = priorities
+        self.location = location
+        self.cache = cache
+
+    def get(self, keys):
+        if list(keys) == ["cache", "location"]:
+            return self.location
+        return self.priorities.get(keys[1])
+
+
+def simple_paths(graph, node, dest, path):
+    """All simple paths from `node` to `dest` like `nx.all_simple_edge_paths`."""
+    if node == dest:
+        yield list(path)
+        return
+    visited = {src for (src, _) in path} | {node}
+    for nxt in graph.get(node, {}):
+        if nxt not in visited:
+            yield from simple_paths(graph, nxt, dest, path + [(node, nxt)])
+
+
+def expected_path(registry, start, dest, through):
+    """Enumerate all simple paths and select the cheapest one."""
+    candidates = []
+    for path in simple_paths(registry.graph, start, dest, []):
+        if set(through) <= {src for (src, _) in path}:
+            costs = [registry.priority(registry.graph[s][d]) for (s, d) in path]
+            costs = [c for c in costs if c is not None]
+            candidates.append((sum(costs) if costs else None, path))
+    costed = [c for (c, _) in candidates if c is not None]
+    if costed:
+        candidates = [(c, p) for (c, p) in candidates if c == min(costed)]
+    if len(candidates) != 1:
+        return len(candidates)
+    return [registry.graph[s][d] for (s, d) in candidates[0][1]]
+
+
+states = st.sampled_from("abcdef")
+
+
+@settings(deadline=None)
+@given(
+    edges=st.lists(st.tuples(states, states), max_size=15),
+    priorities=st.dictionaries(st.integers(0, 14), st.integers(-2, 3), max_size=5),
+    start=states,
+    dest=states,
+    through=st.lists(states, max_size=2),
+)
+def test_make_path(edges, priorities, start, dest, through):
+    """The planner selects the same path as enumerating all simple paths."""
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Config({f"s{i}": p for i, p in priorities.items()}, tmp)
+        registry = Registry(config)
+        for i, (src, dst) in enumerate(edges):
+            registry.register(Stage(f"s{i}", src, dst))
+        if not {start, dest, *through} <= set(registry.graph):
+            return
+        expected = expected_path(registry, start, dest, through)
+        # The second call reads the path stored by the first one.
+        for _ in range(2):
+            if expected == 0:
+                with pytest.raises(NoPathFound):
+                    registry.make_path(start, dest, through)
+            elif isinstance(expected, int):
+                with pytest.raises(MultiplePaths):
+                    registry.make_path(start, dest, through)
+            else:
+                assert registry.make_path(start, dest, through) == expected
+
+
+def test_plans_not_stored_without_cache():
+    """Paths are only stored when the result cache is enabled."""
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = Registry(Config({}, tmp, cache=None))
+        registry.register(Stage("s0", "a", "b"))
+        assert registry.make_path("a", "b", []) == [registry.graph["a"]["b"]]
+        assert not os.path.exists(os.path.join(tmp, "plans"))
+
+
+def diamonds(priorities, n=40):
+    """A registry with `n` pairs of parallel routes from state `s{i}` to
+    `s{i+1}`, through `u{i}` or `l{i}`. The stages of the upper and lower
+    routes have the given priorities."""
+    upper, lower = priorities
+    prio = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = Registry(Config(prio, tmp, cache=None))
+    for i in range(n):
+        for route, p in [("u", upper), ("l", lower)]:
+            for j, (src, dst) in enumerate(
+                [(f"s{i}", f"{route}{i}"), (f"{route}{i}", f"s{i + 1}")]
+            ):
+                name = f"{route}{i}_{j}"
+                registry.register(Stage(name, src, dst))
+                if p is not None:
+                    prio[name] = p
+    return registry
+
+
+@pytest.mark.parametrize("priorities", [(None, None), (0, 0), (1, None), (0, None)])
+def test_many_ambiguous_routes(priorities):
+    """Ambiguity is reported without enumerating every path."""
+    registry = diamonds(priorities)
+    with pytest.raises(MultiplePaths):
+        registry.make_path("s0", "s40", [])
+
+
+@pytest.mark.parametrize(
+    "priorities,route", [((0, 1), "u"), ((1, 2), "u"), ((2, 0), "l")]
+)
+def test_many_routes(priorities, route):
+    """The cheapest of many routes is found without enumerating every path."""
+    registry = diamonds(priorities)
+    path = registry.make_path("s0", "s40", [])
+    assert [stage.name for stage in path] == [
+        f"{route}{i}_{j}" for i in range(40) for j in range(2)
+    ]
+
+
+def test_registered_stages():
+    """Every stage registered by fud is constructed with the name, states,
+    and description it was registered with."""
+    registry = Registry(Config({}, None, cache=None))
+    register_stages(registry)
+    for _, _, stage in registry.edges():
+        assert isinstance(stage, LazyStage)
+        loaded = stage.load()
+        assert loaded.description == stage.description
+
+
+def test_registration_mismatch():
+    """Stages constructed with other states than they were registered with
+    are rejected."""
+    stage = LazyStage("s", "a", "b", "s", lambda: Stage("s", "a", "c"))
+    with pytest.raises(AssertionError, match="constructed as"):
+        stage.load()
+
+
+def test_lazy_registration():
+    """Registering the stages doesn't import their modules."""
+    script = """
+import sys
+from fud.main import register_stages
+from fud.registry import Registry
+register_stages(Registry(None))
+print(" ".join(m for m in sys.modules if m.startswith("fud.stages.")))
+print("numpy" in sys.modules)
+"""
+    proc = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+    )
+    assert proc.stdout.split("\n")[:2] == ["", "False"]
@@ -0,0 +1,121 @@
+from fud import scheduler
+from fud.config import DEFAULT_CONFIGURATION, DynamicDict
+from fud.executor import Executor
+from fud.stages import ComputationGraph, Source, SourceType, Step
+from fud.stages.verilator.stage import VerilatorStage
+import asyncio
+import copy
+import pytest  # type: ignore
+import threading
+
+
+def order(steps):
+    """For every step, the names of the steps that execute before it."""
+    deps = scheduler.dependencies(steps)
+    before = []
+    for dep in deps:
+        before.append(set().union(*[before[d] | {d} for d in dep]))
+    names = [step.name.split(".")[-1] for step in steps]
+    return {names[i]: {names[d] for d in b} for i, b in enumerate(before)}
+
+
+@pytest.mark.parametrize(
+    "option,compile",
+    [
+        (None, "compile_with_verilator"),
+        ("reuse_build", "compile_or_reuse"),
+        ("incremental", "compile_incrementally"),
+    ],
+)
+def test_verilator_dependencies(tmp_path, option, compile):
+    """The Verilator build doesn't wait for the data and the simulation
+    waits for both."""
+    config = DynamicDict(copy.deepcopy(DEFAULT_CONFIGURATION))
+    config["global", "root"] = str(tmp_path)
+    if option:
+        config["stages", "verilog", option] = True
+    before = order(VerilatorStage("dat", "").setup(config).steps)
+
+    chain = ["mktmp", compile, "simulate", "output_json", "cleanup"]
+    if option == "reuse_build":
+        # Builds are kept in their own directory.
+        chain.remove("mktmp")
+        assert "mktmp" in before["simulate"]
+    for first, then in zip(chain, chain[1:]):
+        assert first in before[then]
+    assert "json_to_dat" in before["simulate"]
+    assert "json_to_dat" not in before[compile]
+    assert compile not in before["json_to_dat"]
+
+
+def test_mutable_sources_and_barriers():
+    """Steps that use the same mutable source execute in the order they were
+    defined and barriers separate the steps before them from the ones
+    after them."""
+    directory = Source(None, SourceType.Directory)
+    text = Source(None, SourceType.String)
+
+    def step(name, inputs, typ=SourceType.String, barrier=False):
+        output = Source(None, typ)
+        return Step(name, None, [], output, name, inputs, barrier), output
+
+    make, directory = step("make", [], SourceType.Directory)
+    read, text = step("read", [directory])
+    write, _ = step("write", [directory])
+    first, _ = step("first", [text])
+    second, _ = step("second", [text])
+    barrier, _ = step("barrier", [text], barrier=True)
+    last, _ = step("last", [])
+    before = order([make, read, write, first, second, barrier, last])
+
+    assert before["write"] == {"make", "read"}
+    # Strings are never modified, so their readers are independent.
+    assert before["second"] == {"make", "read"}
+    assert before["barrier"] == {"make", "read", "write", "first", "second"}
+    assert "barrier" in before["last"]
+
+
+def failing_graph(ran):
+    """A graph with a failing step, a step that uses its output, and an
+    independent step. The steps that execute are added to `ran`."""
+    builder = ComputationGraph(SourceType.UnTyped, SourceType.String)
+    lock = threading.Lock()
+
+    @builder.step()
+    def fail() -> SourceType.String:
+        """Fail."""
+        raise ValueError("failed")
+
+    @builder.step()
+    def use(failed: SourceType.String) -> SourceType.String:
+        """Use the output of the failed step."""
+        with lock:
+            ran.append("use")
+        return failed
+
+    @builder.step()
+    def independent() -> SourceType.String:
+        """Run on its own."""
+        with lock:
+            ran.append("independent")
+        return ""
+
+    builder.output = use(fail())
+    independent()
+    return builder
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+@pytest.mark.parametrize("use_async", [False, True])
+def test_failure_stops_dependents(jobs, use_async):
+    """The failure of a step is raised and the steps that use its output
+    don't execute."""
+    ran = []
+    staged = failing_graph(ran)
+    input = Source(None, SourceType.UnTyped)
+    with pytest.raises(ValueError, match="failed"):
+        if use_async:
+            asyncio.run(scheduler.run_async(staged, input, Executor(None), jobs))
+        else:
+            scheduler.run(staged, input, Executor(None), jobs)
+    assert "use" not in ran
@@ -0,0 +1,58 @@
+from fud import scheduler
+from fud.errors import StepFailure
+from fud.executor import Executor
+from fud.stages import ComputationGraph, Source, SourceType
+from fud.utils import shell
+import asyncio
+import pytest  # type: ignore
+
+
+def test_upstream_failure():
+    """The failure of a command that streams its output to another command
+    is reported once the output is read."""
+    upstream = shell("echo partial; echo bad >&2; exit 3", stream=True)
+    downstream = shell("cat", stdin=upstream, stream=True)
+    with pytest.raises(StepFailure, match="exit 3") as e:
+        downstream.read()
+    assert "bad" in str(e.value)
+
+
+def test_downstream_failure():
+    """The failure of a command that reads from a pipe is reported."""
+    upstream = shell("echo data", stream=True)
+    downstream = shell("cat > /dev/null; exit 4", stdin=upstream, stream=True)
+    with pytest.raises(StepFailure, match="exit 4"):
+        downstream.read()
+
+
+def test_upstream_failure_without_stream():
+    """Commands that wait for their output report the failure of the
+    command they read from."""
+    upstream = shell("exit 3", stream=True)
+    with pytest.raises(StepFailure, match="exit 3"):
+        shell("cat", stdin=upstream)
+
+
+def test_stream_output():
+    upstream = shell("printf 'a\\nb\\n'", stream=True)
+    assert shell("sort -r", stdin=upstream, stream=True).read() == b"b\na\n"
+
+
+def test_shell_on_event_loop():
+    """Steps executed by the asyncio engine run their commands as asyncio
+    subprocesses and report their failures."""
+    builder = ComputationGraph(SourceType.UnTyped, SourceType.Stream)
+
+    @builder.step()
+    def run() -> SourceType.Stream:
+        """Run commands."""
+        assert shell("echo hello").read() == b"hello\n"
+        return shell("echo fail >&2; exit 5")
+
+    builder.output = run()
+    with pytest.raises(StepFailure, match="exit 5"):
+        asyncio.run(
+            scheduler.run_async(
+                builder, Source(None, SourceType.UnTyped), Executor(None)
+            )
+        )
@@ -0,0 +1,113 @@
+import fud.stages.vcdump as vcdump
+from fud.stages.vcdump import read_vcd
+from hypothesis import given, strategies as st  # type: ignore
+from io import BytesIO
+from pathlib import Path
+import json
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+VCD = b"""$date today $end
+$timescale
+  1ps
+$end
+$scope module TOP $end
+$scope module main $end
+$var wire 1 ! clk $end
+$var wire 4 " x [3:0] $end
+$scope module acc $end
+$var wire 4 " out [3:0] $end
+$var real 64 # r $end
+$upscope $end
+$upscope $end
+$upscope $end
+$enddefinitions $end
+#0
+$dumpvars
+0!
+bx "
+r0.5 #
+$end
+#1
+1!
+b101 "
+#2
+0!
+#3
+1! b11 "
+#4
+0!
+"""
+
+
+def test_nested():
+    """Signals are sampled at every time and nested by scope."""
+    assert read_vcd(BytesIO(VCD)) == {
+        "TOP": {
+            "main": {
+                "clk": [0, 1, 0, 1, 0],
+                "x": [None, 5, 5, 3, 3],
+                "acc": {"out": [None, 5, 5, 3, 3], "r": [0.5] * 5},
+            }
+        }
+    }
+
+
+def test_vcdump_layout():
+    """The nested output of a Verilator trace has the layout that
+    `vcdump --pretty` prints for it."""
+    with open(FIXTURES / "counter.vcd", "rb") as vcd:
+        nested = read_vcd(vcd)
+    expected = json.loads((FIXTURES / "counter.json").read_text())
+    assert nested == expected
+    # Cycles are counted by adding up the samples of the clock.
+    assert sum(nested["TOP"]["TOP"]["main"]["clk"]) == 3
+
+
+def test_columnar():
+    """Columnar outputs only hold the changes of the selected signals."""
+    assert read_vcd(BytesIO(VCD), ["*.x", "TOP.main.acc"], 2, 3, True) == {
+        "timescale": "1ps",
+        "signals": {
+            "TOP.main.x": {"width": 4, "times": [2, 3], "values": [5, 3]},
+            "TOP.main.acc.out": {"width": 4, "times": [2, 3], "values": [5, 3]},
+            "TOP.main.acc.r": {"width": 64, "times": [2], "values": [0.5]},
+        },
+    }
+
+
+values = st.integers(0, 15).map(lambda v: f"b{v:b}") | st.just("bx")
+
+
+@given(
+    steps=st.lists(
+        st.lists(st.tuples(st.sampled_from('!"'), values), max_size=3), max_size=10
+    ),
+    read_size=st.integers(1, 16),
+)
+def test_columnar_matches_nested(steps, read_size):
+    """Replaying the changes of the columnar output gives the nested output,
+    independently of how the file is read."""
+    body = "".join(
+        f"#{t}\n" + "".join(f"{v} {code}\n" for code, v in changes)
+        for t, changes in enumerate(steps)
+    )
+    vcd = (
+        "$scope module main $end\n"
+        '$var wire 4 ! a $end\n$var wire 4 " b $end\n'
+        "$upscope $end\n$enddefinitions $end\n" + body
+    ).encode()
+    vcdump.READ_SIZE, old = read_size, vcdump.READ_SIZE
+    try:
+        nested = read_vcd(BytesIO(vcd))
+        columnar = read_vcd(BytesIO(vcd), columnar=True)
+    finally:
+        vcdump.READ_SIZE = old
+    for name in ["a", "b"]:
+        changes = columnar["signals"][f"main.{name}"]
+        replayed, value = [], None
+        for t in range(len(steps)):
+            if t in changes["times"]:
+                value = changes["values"][changes["times"].index(t)]
+            replayed.append(value)
+        assert nested["main"][name] == replayed
@@ -1,14 +1,19 @@
-from typing import Dict
+from typing import TYPE_CHECKING, Dict, List, Optional
 import sys
 import logging as log
 import shutil
-from tempfile import TemporaryDirectory, NamedTemporaryFile, TemporaryFile
-from io import BytesIO, IOBase
+from tempfile import TemporaryDirectory, NamedTemporaryFile, TemporaryFile, mkstemp
+from io import BytesIO, FileIO, IOBase, RawIOBase
 from pathlib import Path
 import subprocess
+from contextvars import ContextVar
+import signal
 import os
 
-from . import errors
+from . import errors, executor
+
+if TYPE_CHECKING:
+    import asyncio
 
 
 def eprint(*args, **kwargs):
@@ -34,13 +39,23 @@ def unwrap_or(val, default):
     return default
 
 
+def option_list(val) -> List[str]:
+    """
+    The values of a stage option that holds a list. Options set with `-s`
+    are strings, so they may also separate the values with commas.
+    """
+    if val is None:
+        return []
+    if isinstance(val, str):
+        return val.replace(",", " ").split()
+    return [str(v) for v in val]
+
+
 def logging_setup(args):
     # Color for warning, error, and info messages.
-    log.addLevelName(log.INFO, "\033[1;34m%s\033[1;0m" % log.getLevelName(log.INFO))
-    log.addLevelName(
-        log.WARNING, "\033[1;33m%s\033[1;0m" % log.getLevelName(log.WARNING)
-    )
-    log.addLevelName(log.ERROR, "\033[1;31m%s\033[1;0m" % log.getLevelName(log.ERROR))
+    log.addLevelName(log.INFO, "\033[1;34m%s\033[1;0m" % "INFO")
+    log.addLevelName(log.WARNING, "\033[1;33m%s\033[1;0m" % "WARNING")
+    log.addLevelName(log.ERROR, "\033[1;31m%s\033[1;0m" % "ERROR")
 
     # Set verbosity level.
     level = None
@@ -51,8 +66,13 @@ def logging_setup(args):
     elif args.verbose >= 2:
         level = log.DEBUG
 
+    # Replace existing handlers since `fud server` sets up logging again for
+    # each command it executes.
     log.basicConfig(
-        format="[fud] %(levelname)s: %(message)s", stream=sys.stderr, level=level
+        format="[fud] %(levelname)s: %(message)s",
+        stream=sys.stderr,
+        level=level,
+        force=True,
     )
 
     try:
@@ -115,6 +135,10 @@ class FreshDir(Directory):
         self.name = os.path.abspath(name)
 
 
+# Size of the chunks copied from streams to files.
+COPY_SIZE = 1 << 20
+
+
 class Conversions:
     @staticmethod
     def path_to_directory(data: Path):
@@ -127,14 +151,25 @@ class Conversions:
     def path_to_stream(data: Path):
         return open(data, "rb")
 
+    @staticmethod
+    def path_to_bytes(data: Path) -> bytes:
+        out = data.read_bytes()
+        executor.record_io(read=len(out), copied=len(out))
+        return out
+
     @staticmethod
     def stream_to_path(data: IOBase) -> Path:
         assert (
             not data.closed
         ), "Closed stream. This probably means that a previous stage used this up."
+        if isinstance(data, NamedOutput) and data.tell() == 0:
+            return data.hand_over()
         with NamedTemporaryFile("wb", delete=False) as tmpfile:
-            tmpfile.write(data.read())
+            # Copy in chunks to avoid holding the whole stream in memory.
+            shutil.copyfileobj(data, tmpfile, COPY_SIZE)
             data.close()
+            size = tmpfile.tell()
+            executor.record_io(read=size, written=size, copied=size)
             return Path(tmpfile.name)
 
     @staticmethod
@@ -145,31 +180,169 @@ class Conversions:
         ), "Closed stream. This probably means that a previous stage used this up."
         out = data.read()
         data.close()
+        executor.record_io(read=len(out), copied=len(out))
         return out
 
     @staticmethod
     def bytes_to_stream(data: bytes) -> IOBase:
+        # Shares the buffer of `data` until the stream is written to.
         return BytesIO(data)
 
+    @staticmethod
+    def bytes_to_path(data: bytes) -> Path:
+        with NamedTemporaryFile("wb", delete=False) as tmpfile:
+            tmpfile.write(data)
+            executor.record_io(written=len(data), copied=len(data))
+            return Path(tmpfile.name)
+
     @staticmethod
     def bytes_to_string(data: bytes) -> str:
         try:
-            return data.decode("UTF-8")
+            out = data.decode("UTF-8")
         except UnicodeDecodeError:
             raise errors.SourceConversion("string")
+        executor.record_io(copied=len(data))
+        return out
 
     @staticmethod
     def string_to_bytes(data: str) -> bytes:
-        return data.encode("UTF-8")
+        out = data.encode("UTF-8")
+        executor.record_io(copied=len(out))
+        return out
 
 
-def shell(cmd, stdin=None, stdout_as_debug=False, capture_stdout=True, env=None, cwd=None):
-    """Run `cmd` as a shell command.
+class NamedOutput(FileIO):
+    """
+    A stream over a named temporary file that holds the output of a command.
+    Converting it to a path hands over the file instead of copying it.
+    Otherwise, the file is removed when the stream is closed.
+    """
 
-    Return an output stream (or None if stdout is not captured). Raise
-    `errors.StepFailure` if the command fails.
+    def __init__(self):
+        fd, name = mkstemp(prefix="fud-")
+        super().__init__(fd, "r+")
+        self.path = Path(name)
+        self.handed_over = False
+
+    def hand_over(self) -> Path:
+        """
+        Close the stream and return the path of the file. The caller is
+        responsible for removing the file.
+        """
+        self.handed_over = True
+        self.close()
+        return self.path
+
+    def close(self):
+        if not self.closed and not self.handed_over:
+            self.path.unlink(missing_ok=True)
+        super().close()
+
+
+class ShellStream(RawIOBase):
     """
+    The standard output of a command started with `shell(..., stream=True)`.
 
+    Reading the stream reads the output of the command while it runs. Once the
+    output is exhausted, `wait` is called which raises `errors.StepFailure` if
+    the command, or a command that it reads from, failed.
+    When the stream is passed as the standard input of another command, the
+    two commands are connected with a pipe and run at the same time.
+    """
+
+    def __init__(self, proc, cmd, stderr, upstream=None, span=None):
+        super().__init__()
+        self.proc = proc
+        self.cmd = cmd
+        self.stderr = stderr
+        # The profiling span of the command, ended once it is waited for.
+        self.span = span
+        # The stream read by this command, if it is a `ShellStream` as well.
+        self.upstream = upstream
+        # Set once the output is handed off to another command or closed
+        # before it was exhausted; the reader may then legitimately stop
+        # the command with SIGPIPE.
+        self.abandoned = False
+        self.waited = False
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def readinto(self, b):
+        n = self.proc.stdout.readinto(b)
+        if not n:
+            self.wait()
+        return n
+
+    def hand_off(self):
+        """
+        Returns the pipe to pass as the standard input of another command.
+        Call `release` once the command has started.
+        """
+        assert not self.closed, "Stream was already used by a previous step."
+        self.abandoned = True
+        return self.proc.stdout
+
+    def release(self):
+        """Close our end of the pipe once another command reads from it."""
+        self.proc.stdout.close()
+        super().close()
+
+    def wait(self):
+        """
+        Wait for the command and for the commands it reads from. Raise
+        `errors.StepFailure` if any of them failed.
+        """
+        if self.waited:
+            return
+        self.waited = True
+        executor.wait_process(self.proc, self.span)
+        # Report the failure of the command that produced the input first.
+        if self.upstream is not None:
+            self.upstream.wait()
+        status = self.proc.returncode
+        if status and not (
+            self.abandoned and status in (-signal.SIGPIPE, 128 + signal.SIGPIPE)
+        ):
+            if self.stderr:
+                self.stderr.seek(0)
+            raise errors.StepFailure(
+                self.cmd,
+                "Output was streamed to the next step.",
+                self.stderr.read().decode("UTF-8")
+                if self.stderr
+                else "No stderr captured.",
+            )
+
+    def close(self):
+        if not self.closed and not self.waited:
+            # The reader stopped early; don't leave the command behind.
+            self.abandoned = True
+            self.proc.stdout.close()
+            executor.wait_process(self.proc, self.span)
+        super().close()
+
+
+# Set while a step executes whose output is converted to a path. The commands
+# it starts with `shell(..., stream=True)` then write their output to a named
+# file instead of a pipe so that the file can be handed over without a copy.
+named_output: ContextVar[bool] = ContextVar("named_output", default=False)
+
+# The event loop of the asyncio engine (see `scheduler.run_async`) executing
+# the current step, if any. `shell` runs its commands on this loop.
+event_loop: ContextVar[Optional["asyncio.AbstractEventLoop"]] = ContextVar(
+    "event_loop", default=None
+)
+
+
+def _shell_setup(cmd, stdin, stdout_as_debug, capture_stdout, env, stream=False):
+    """
+    Prepare the command, standard input, outputs, and environment of a shell
+    command. Returns them along with the `ShellStream` read by the command.
+    """
     if isinstance(cmd, list):
         cmd = " ".join(cmd)
 
@@ -181,19 +354,24 @@ def shell(cmd, stdin=None, stdout_as_debug=False, capture_stdout=True, env=None,
 
     log.debug(f"Stdin is `{type(stdin)}`")
 
+    upstream = None
+    if isinstance(stdin, ShellStream):
+        upstream = stdin
+        stdin = upstream.hand_off()
+
     # In debug mode, let stderr stream to the terminal (and the same
     # with stdout, unless we need it for capture). Otherwise, capture
     # stderr to a temporary file for error reporting (and stdout
-    # unconditionally).
+    # unconditionally). Streamed outputs go to a pipe instead.
     if is_debug():
         stderr = None
         if capture_stdout:
-            stdout = TemporaryFile()
+            stdout = subprocess.PIPE if stream else NamedOutput()
         else:
             stdout = None
     else:
         stderr = TemporaryFile()
-        stdout = TemporaryFile()
+        stdout = subprocess.PIPE if stream else NamedOutput()
 
     # Set up environment variables, merging the current environment with
     # any new settings.
@@ -201,20 +379,19 @@ def shell(cmd, stdin=None, stdout_as_debug=False, capture_stdout=True, env=None,
     if env:
         new_env.update(env)
 
-    proc = subprocess.Popen(
-        cmd,
-        shell=True,
-        stdin=stdin,
-        stdout=stdout,
-        stderr=stderr,
-        env=new_env,
-        cwd=cwd,
-    )
-    proc.wait()
+    return cmd, stdin, upstream, stdout, stderr, new_env
+
+
+def _shell_result(cmd, returncode, upstream, stdout, stderr):
+    """
+    Check the outcome of a finished shell command and return its output.
+    """
+    if upstream is not None:
+        upstream.wait()
     if stdout:
         stdout.seek(0)
 
-    if proc.returncode:
+    if returncode:
         if stderr:
             stderr.seek(0)
         raise errors.StepFailure(
@@ -226,6 +403,103 @@ def shell(cmd, stdin=None, stdout_as_debug=False, capture_stdout=True, env=None,
     return stdout
 
 
+def shell(
+    cmd,
+    stdin=None,
+    stdout_as_debug=False,
+    capture_stdout=True,
+    env=None,
+    cwd=None,
+    stream=False,
+):
+    """Run `cmd` as a shell command.
+
+    Return an output stream (or None if stdout is not captured). Raise
+    `errors.StepFailure` if the command fails.
+
+    With `stream`, return a `ShellStream` of the output immediately instead of
+    waiting for the command to finish. Errors are then raised when the
+    stream is exhausted.
+    If `stdin` is a `ShellStream`, the command reads directly from the pipe
+    of the previous command.
+    """
+    stream = (
+        stream and capture_stdout and not stdout_as_debug and not named_output.get()
+    )
+
+    # Steps executed by the asyncio engine run on threads; wait for their
+    # commands on the event loop instead.
+    loop = event_loop.get()
+    if loop is not None and not stream:
+        import asyncio
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run_coroutine_threadsafe(
+                shell_async(cmd, stdin, stdout_as_debug, capture_stdout, env, cwd),
+                loop,
+            ).result()
+
+    cmd, stdin, upstream, stdout, stderr, new_env = _shell_setup(
+        cmd, stdin, stdout_as_debug, capture_stdout, env, stream
+    )
+
+    span = executor.start_process(cmd)
+    proc = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdin=stdin,
+        stdout=stdout,
+        stderr=stderr,
+        env=new_env,
+        cwd=cwd,
+    )
+    if upstream is not None:
+        upstream.release()
+
+    if stream:
+        return ShellStream(proc, cmd, stderr, upstream, span)
+
+    executor.wait_process(proc, span)
+    return _shell_result(cmd, proc.returncode, upstream, stdout, stderr)
+
+
+async def shell_async(
+    cmd, stdin=None, stdout_as_debug=False, capture_stdout=True, env=None, cwd=None
+):
+    """
+    Like `shell`, but run `cmd` as an asyncio subprocess so that the event
+    loop can do other work while the command runs. The command is killed if
+    the coroutine is cancelled.
+    """
+    import asyncio
+
+    cmd, stdin, upstream, stdout, stderr, new_env = _shell_setup(
+        cmd, stdin, stdout_as_debug, capture_stdout, env
+    )
+
+    span = executor.start_process(cmd)
+    proc = await asyncio.create_subprocess_shell(
+        cmd,
+        stdin=stdin,
+        stdout=stdout,
+        stderr=stderr,
+        env=new_env,
+        cwd=cwd,
+    )
+    if upstream is not None:
+        upstream.release()
+
+    try:
+        await proc.wait()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    executor.end_process(span, proc.returncode)
+    return _shell_result(cmd, proc.returncode, upstream, stdout, stderr)
+
+
 def transparent_shell(cmd):
     """
     Runs `cmd` in the shell. Does not capture output or input. Does nothing
@@ -243,21 +517,55 @@ def transparent_shell(cmd):
     proc.wait()
 
 
-def profiling_dump(durations: Dict[str, float]) -> str:
+# Columns of the memory and I/O usage of steps with the factor that converts
+# them to megabytes.
+USAGE_COLUMNS = {
+    "heap_peak_bytes": ("heap peak (MB)", 1e-6),
+    "max_rss_kb": ("max rss (MB)", 1e-3),
+    "read_bytes": ("read (MB)", 1e-6),
+    "written_bytes": ("written (MB)", 1e-6),
+}
+
+
+def _usage_values(usage, p):
+    return [
+        round(usage.get(p, {}).get(key, 0) * factor, 3)
+        for key, (_, factor) in USAGE_COLUMNS.items()
+    ]
+
+
+def profiling_dump(
+    durations: Dict[str, float], usage: Optional[Dict[str, Dict[str, int]]] = None
+) -> str:
     """
     Returns time elapsed during each stage or step of the fud execution.
+    With `usage`, also returns the memory and I/O usage of each step.
     """
 
-    def name_and_space(s: str) -> str:
-        # Return a string containing `s` followed by max(32 - len(s), 1) spaces.
-        return "".join((s, max(32 - len(s), 1) * " "))
+    def name_and_space(s: str, width: int = 32) -> str:
+        # Return a string containing `s` followed by max(width - len(s), 1) spaces.
+        return "".join((s, max(width - len(s), 1) * " "))
+
+    if usage:
+        columns = ["elapsed time (s)"] + [c for c, _ in USAGE_COLUMNS.values()]
+        header = "".join(name_and_space(c, 18) for c in columns).rstrip()
+        return f"{name_and_space('step')}{header}\n" + "\n".join(
+            name_and_space(p)
+            + "".join(
+                name_and_space(str(v), 18)
+                for v in [round(t, 3)] + _usage_values(usage, p)
+            ).rstrip()
+            for p, t in durations.items()
+        )
 
     return f"{name_and_space('step')}elapsed time (s)\n" + "\n".join(
         f"{name_and_space(p)}{round(t, 3)}" for p, t in durations.items()
     )
 
 
-def profiling_csv(durations: Dict[str, float]) -> str:
+def profiling_csv(
+    durations: Dict[str, float], usage: Optional[Dict[str, Dict[str, int]]] = None
+) -> str:
     """
     Dumps the profiling information into a CSV format.
     For example, with
@@ -270,13 +578,26 @@ def profiling_csv(durations: Dict[str, float]) -> str:
     x,b,2.0
     x,c,3.444
     ```
+    With `usage`, the memory and I/O usage of each step in megabytes follows
+    its duration.
     """
+    if usage:
+        return "\n".join(
+            ",".join([p] + [str(v) for v in [round(t, 3)] + _usage_values(usage, p)])
+            for (p, t) in durations.items()
+        )
     return "\n".join([f"{p},{round(t, 3)}" for (p, t) in durations.items()])
 
 
-def profile_stages(durations: Dict[str, float], is_csv) -> str:
+def profile_stages(
+    durations: Dict[str, float],
+    is_csv,
+    usage: Optional[Dict[str, Dict[str, int]]] = None,
+) -> str:
     """
     Returns either a human-readable or CSV format profiling information,
     depending on `is_csv`.
     """
-    return profiling_csv(durations) if is_csv else profiling_dump(durations)
+    if is_csv:
+        return profiling_csv(durations, usage)
+    return profiling_dump(durations, usage)
@@ -3,8 +3,19 @@ import simplejson as sjson
 from pathlib import Path
 
 from fud.stages import Stage, SourceType, Source
-from fud.utils import shell, TmpDir, log
-from fud.stages.verilator.json_to_dat import convert2dat, convert2json
+from fud.cache import BuildCache, file_digest, tool_fingerprint
+from fud.utils import shell, Directory, TmpDir, log
+from fud.stages.verilator.json_to_dat import convert2dat, load_memories
+from fud.stages.verilator.stage import (
+    binary_memories,
+    data_format,
+    dumps_memories,
+    simulation_json,
+    simulation_outputs,
+    trace_options,
+    write_design,
+    write_testbench,
+)
 from fud.stages import futil
 import fud.errors as errors
 
@@ -39,14 +50,35 @@ class IcarusBaseStage(Stage):
             "exec": "iverilog",
             "testbench": str(test_bench.resolve()),
             "round_float_to_fixed": True,
+            "reuse_build": False,
+            "data_format": "dat",
+            "trace_scopes": None,
+            "trace_start": None,
+            "trace_end": None,
+            "outputs": None,
         }
 
     def known_opts(self):
-        return ["exec", "testbench", "round_float_to_fixed"]
+        return [
+            "exec",
+            "testbench",
+            "round_float_to_fixed",
+            "reuse_build",
+            "data_format",
+            "trace_scopes",
+            "trace_start",
+            "trace_end",
+            "outputs",
+        ]
 
     def _define_steps(self, input_data, builder, config):
         testbench = config["stages", self.name, "testbench"]
         cmd = config["stages", self.name, "exec"]
+        binary = data_format(config, self.name) == "bin"
+        trace = trace_options(config, self.name) if self.is_vcd else None
+        outputs = simulation_outputs(config, self.name)
+        # Memories are never read back from VCD simulations.
+        dump = dumps_memories(outputs) and not self.is_vcd
 
         # Step 1: Make a new temporary directory
         @builder.step()
@@ -56,6 +88,13 @@ class IcarusBaseStage(Stage):
             """
             return TmpDir()
 
+        @builder.step()
+        def mkdatadir() -> SourceType.Directory:
+            """
+            Make temporary directory to store the memory files of the design.
+            """
+            return TmpDir()
+
         # Step 2a: Dynamically retrieve the value of stages.verilog.data
         @builder.step(
             description="Dynamically retrieve the value of stages.verilog.data"
@@ -79,19 +118,25 @@ class IcarusBaseStage(Stage):
 
         # Step 2: Transform data from JSON to Dat.
         @builder.step()
-        def json_to_dat(tmp_dir: SourceType.Directory, json_path: SourceType.Path):
+        def json_to_dat(
+            tmp_dir: SourceType.Directory,
+            json_path: SourceType.Path,
+            verilog_path: SourceType.Path,
+        ):
             """
             Converts a `json` data format into a series of `.dat` files.
             """
             round_float_to_fixed = config["stages", self.name, "round_float_to_fixed"]
             # if verilog.data was not given, do nothing
             if json_path.data:
-                convert2dat(
-                    tmp_dir.name,
-                    sjson.load(open(json_path.data), use_decimal=True),
-                    "dat",
-                    round_float_to_fixed,
-                )
+                with open(json_path.data, "rb") as f:
+                    convert2dat(
+                        tmp_dir.name,
+                        load_memories(f),
+                        "dat",
+                        round_float_to_fixed,
+                        binary_memories(verilog_path) if binary else (),
+                    )
 
         # Step 3: compile with verilator
         cmd = " ".join(
@@ -100,34 +145,66 @@ class IcarusBaseStage(Stage):
                 "-g2012",
                 "-o",
                 "{exec_path}",
-                testbench,
+                "{testbench}",
                 "{input_path}",
             ]
         )
 
-        @builder.step(description=cmd)
-        def compile_with_iverilog(
-            input_path: SourceType.Path, tmpdir: SourceType.Directory
-        ) -> SourceType.Stream:
+        def compile(input_path, build_dir):
             return shell(
                 cmd.format(
-                    input_path=str(input_path),
-                    exec_path=f"{tmpdir.name}/{self.object_name}",
+                    input_path=write_design(input_path, build_dir, dump, binary),
+                    exec_path=f"{build_dir}/{self.object_name}",
+                    testbench=write_testbench(
+                        testbench, input_path, build_dir, binary, trace, dump
+                    ),
                 ),
                 stdout_as_debug=True,
             )
 
+        @builder.step(description=cmd)
+        def compile_with_iverilog(
+            input_path: SourceType.Path, tmpdir: SourceType.Directory
+        ) -> SourceType.Stream:
+            return compile(input_path, tmpdir.name)
+
+        # Step 3 (reuse_build == True): compile into a persistent build
+        # directory keyed by the design, unless it has been compiled before.
+        @builder.step(description=f"{cmd} (reusing earlier builds)")
+        def compile_or_reuse(input_path: SourceType.Path) -> SourceType.Directory:
+            """
+            Compile the design into a persistent build directory that is shared
+            by all runs of the same design, testbench, and compiler.
+            """
+            key = BuildCache.key(
+                design=file_digest(input_path),
+                testbench=file_digest(testbench),
+                cmd=cmd,
+                tool=tool_fingerprint(config["stages", self.name, "exec"]),
+                data_format="bin" if binary else "dat",
+                trace=trace,
+                dump=dump,
+            )
+            build = BuildCache.from_config(config).get_or_build(
+                key, lambda build_dir: compile(input_path, build_dir)
+            )
+            return Directory(str(build))
+
         # Step 4: simulate
         @builder.step()
-        def simulate(tmpdir: SourceType.Directory) -> SourceType.Stream:
+        def simulate(
+            builddir: SourceType.Directory,
+            tmpdir: SourceType.Directory,
+            datadir: SourceType.Directory,
+        ) -> SourceType.Stream:
             """
             Simulates compiled icarus verilog program.
             """
             cycle_limit = config["stages", "verilog", "cycle_limit"]
             return shell(
                 [
-                    f"{tmpdir.name}/{self.object_name}",
-                    f"+DATA={tmpdir.name}",
+                    f"{builddir.name}/{self.object_name}",
+                    f"+DATA={datadir.name}",
                     f"+CYCLE_LIMIT={str(cycle_limit)}",
                     f"+OUT={tmpdir.name}/output.vcd",
                     f"+NOTRACE={0 if self.is_vcd else 1}",
@@ -147,7 +224,9 @@ class IcarusBaseStage(Stage):
         # Step 5(self.vcd == False): extract cycles + data
         @builder.step()
         def output_json(
-            simulated_output: SourceType.String, tmpdir: SourceType.Directory
+            simulated_output: SourceType.String,
+            tmpdir: SourceType.Directory,
+            datadir: SourceType.Directory,
         ) -> SourceType.Stream:
             """
             Convert .dat files back into a json file
@@ -160,10 +239,7 @@ class IcarusBaseStage(Stage):
             cycle_count = int(r.group(1)) if r is not None else 0
             if cycle_count < 0:
                 log.warn("Cycle count is less than 0")
-            data = {
-                "cycles": cycle_count,
-                "memories": convert2json(tmpdir.name, "out"),
-            }
+            data = simulation_json(cycle_count, datadir.name, outputs)
 
             # Write to a file so we can return a stream.
             out = Path(tmpdir.name) / "output.json"
@@ -172,14 +248,16 @@ class IcarusBaseStage(Stage):
             return out.open("rb")
 
         @builder.step()
-        def cleanup(tmpdir: SourceType.Directory):
+        def cleanup(tmpdir: SourceType.Directory, datadir: SourceType.Directory):
             """
             Cleanup build files
             """
             tmpdir.remove()
+            datadir.remove()
 
         # Schedule
         tmpdir = mktmp()
+        datadir = mkdatadir()
         data_path = get_verilog_data()
         # data_path_exists: bool = (
         #     config.get(["stages", "verilog", "data"]) or
@@ -189,16 +267,20 @@ class IcarusBaseStage(Stage):
         # if we need to, convert dynamically sourced json to dat
         check_verilog_for_mem_read(input_data, data_path)
         # otherwise, convert
-        json_to_dat(tmpdir, data_path)
+        json_to_dat(datadir, data_path, input_data)
 
-        compile_with_iverilog(input_data, tmpdir)
-        stdout = simulate(tmpdir)
+        if config.get(["stages", self.name, "reuse_build"]):
+            builddir = compile_or_reuse(input_data)
+        else:
+            compile_with_iverilog(input_data, tmpdir)
+            builddir = tmpdir
+        stdout = simulate(builddir, tmpdir, datadir)
         result = None
         if self.is_vcd:
             result = output_vcd(tmpdir)
         else:
-            result = output_json(stdout, tmpdir)
-        cleanup(tmpdir)
+            result = output_json(stdout, tmpdir, datadir)
+        cleanup(tmpdir, datadir)
         return result
 
 